@@ -1,4 +1,5 @@
 import os
+import threading
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -18,14 +19,29 @@ CLOUD_SQL_IP_TYPE = (os.getenv("CLOUD_SQL_IP_TYPE", "PUBLIC") or "PUBLIC").upper
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+_connector = None
+_connector_lock = threading.Lock()
+
+
+def _get_connector():
+    # Connector は証明書の取得・更新を抱えるので、接続ごとに作らずプロセスで1つを使い回す
+    global _connector
+    if _connector is None:
+        with _connector_lock:
+            if _connector is None:
+                from google.cloud.sql.connector import Connector  # lazy import
+
+                _connector = Connector()
+    return _connector
+
 
 def _create_engine():
     if CONNECTION_NAME and DB_USER and DB_NAME:
         # Cloud SQL connector via pg8000
         def getconn():
-            from google.cloud.sql.connector import Connector, IPTypes  # lazy import
+            from google.cloud.sql.connector import IPTypes  # lazy import
 
-            connector = Connector()
+            connector = _get_connector()
             kwargs = {
                 "driver": "pg8000",
                 "user": DB_USER,
@@ -1,7 +1,12 @@
 import os
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import RedirectResponse
+from .services import startup
+
+startup.mark("main")
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, RedirectResponse
 from sqlalchemy import text
 from .db.session import engine
 from fastapi.middleware.cors import CORSMiddleware
@@ -12,8 +17,30 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from .routers import api_v1 as v1
+from .routers import books_static
+from .services import generation_queue, llm_scheduler, log_writer, quotas, thumbnails, veo_poller
+
+startup.mark("imports")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # DB プール・クライアントを先に用意してから待ち受ける（最初のリクエストに初期化を払わせない）
+    await startup.warm_up()
+    log_writer.start_all()
+    # 生成ジョブのワーカー（GENERATION_WORKERS=0 なら別プロセス `python -m apps.api.worker` に任せる）
+    generation_queue.start_worker()
+    startup.mark("ready")
+    print(f"startup: {startup.summary()}")
+    yield
+    # 実行中のジョブはキューに戻し、未書き込みのログを書き切る
+    await generation_queue.stop_worker()
+    await veo_poller.poller.aclose()
+    thumbnails.shutdown()
+    await log_writer.stop_all()
 
-app = FastAPI(title="AI Bunko Reader API", version="0.1.0")
+
+app = FastAPI(title="AI Bunko Reader API", version="0.1.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,6 +49,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# LLM 呼び出しを interactive として、リクエスト元ごとに公平に並べる
+app.add_middleware(llm_scheduler.RequestContextMiddleware)
+
+
+@app.exception_handler(quotas.QuotaExceeded)
+async def quota_exceeded(request: Request, exc: quotas.QuotaExceeded):
+    # 上限超過は待たせずに返す（クライアントは Retry-After 秒後に再試行）
+    return JSONResponse(
+        status_code=429,
+        content={"detail": exc.detail, "feature": exc.feature, "reason": exc.reason},
+        headers={"Retry-After": str(exc.retry_after_s)},
+    )
 
 
 @app.get("/healthz")
@@ -30,6 +69,8 @@ def healthz():
 
 
 app.include_router(v1.router, prefix="/v1")
+# 本文 HTML は StaticFiles より先に、事前圧縮版を返すハンドラで受ける
+app.include_router(books_static.router)
 
 # Serve static web (simple MVP)
 app.mount("/web", StaticFiles(directory="web", html=True), name="web")
@@ -40,6 +81,12 @@ def root_redirect():
     return RedirectResponse(url="/web/index.html")
 
 
+@app.get("/healthz/startup")
+def healthz_startup():
+    """起動の経過（プロセス開始からの各段階の時刻とウォームアップの所要時間）。"""
+    return {"warmup": startup.WARMUP, "timeline": startup.timeline()}
+
+
 @app.get("/healthz/db")
 def healthz_db():
     try:
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON, Numeric, Boolean
+from sqlalchemy import Column, Integer, String, Text, Date, DateTime, ForeignKey, JSON, Numeric, Boolean
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import ARRAY
 
@@ -49,6 +49,70 @@ class Translation(Base):
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
 
+class ParagraphTranslation(Base):
+    __tablename__ = "paragraph_translations"
+    para_id = Column(Integer, ForeignKey("paragraphs.id", ondelete="CASCADE"), primary_key=True)
+    book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), nullable=False)
+    text = Column(Text, nullable=False)
+    model = Column(String(128), nullable=True)
+    prompt_version = Column(String(32), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class CannedAnswer(Base):
+    __tablename__ = "canned_answers"
+    book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), primary_key=True)
+    question_key = Column(String(64), primary_key=True)
+    question = Column(Text, nullable=False)
+    answer = Column(Text, nullable=False)
+    model = Column(String(128), nullable=True)
+    prompt_version = Column(String(32), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class ScenePrompt(Base):
+    __tablename__ = "scene_prompts"
+    book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), primary_key=True)
+    text_hash = Column(String(64), primary_key=True)
+    characters_version = Column(String(16), primary_key=True)
+    prompt = Column(Text, nullable=False)
+    character_names = Column(JSON, nullable=False, default=list)
+    model = Column(String(128), nullable=True)
+    prompt_version = Column(String(32), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class ParagraphCharacters(Base):
+    __tablename__ = "paragraph_characters"
+    para_id = Column(Integer, ForeignKey("paragraphs.id", ondelete="CASCADE"), primary_key=True)
+    book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), nullable=False)
+    character_names = Column(JSON, nullable=False, default=list)
+    ambiguous = Column(Boolean, nullable=False, default=False)
+    characters_version = Column(String(16), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class GenerationAsset(Base):
+    __tablename__ = "generation_assets"
+    dedup_key = Column(String(64), primary_key=True)
+    job_type = Column(String(16), nullable=False)  # image or video
+    book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), nullable=True)
+    asset_url = Column(String(1024), nullable=False)
+    result = Column(JSON, nullable=False)
+    gallery_id = Column(Integer, ForeignKey("gallery.id", ondelete="SET NULL"), nullable=True)
+    shared_count = Column(Integer, nullable=False, default=1)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class UsageCounter(Base):
+    __tablename__ = "usage_counters"
+    user_id = Column(String(128), primary_key=True)
+    feature = Column(String(32), primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
 class Highlight(Base):
     __tablename__ = "highlights"
     id = Column(Integer, primary_key=True)
@@ -136,5 +200,8 @@ class GenerationJob(Base):
     payload = Column(JSON, nullable=True)
     result = Column(JSON, nullable=True)
     attempts = Column(Integer, nullable=False, default=0)
+    heartbeat_at = Column(DateTime, nullable=True)
+    worker_id = Column(String(64), nullable=True)
+    error = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
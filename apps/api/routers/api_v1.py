@@ -1,6 +1,6 @@
 from fastapi import APIRouter
 
-from .v1 import books, search, recommendations, translate, qa, highlights, generate, gallery, progress, feedback, translations, librarian_proxy
+from .v1 import books, search, recommendations, translate, qa, highlights, generate, gallery, progress, feedback, translations, librarian_proxy, metrics, quotas
 
 router = APIRouter()
 
@@ -16,3 +16,5 @@ router.include_router(gallery.router, prefix="", tags=["gallery"])
 router.include_router(progress.router, prefix="", tags=["progress"])
 router.include_router(feedback.router, prefix="", tags=["feedback"])
 router.include_router(librarian_proxy.router, prefix="", tags=["librarian_proxy"])
+router.include_router(metrics.router, prefix="", tags=["metrics"])
+router.include_router(quotas.router, prefix="", tags=["quotas"])
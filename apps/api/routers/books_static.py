@@ -0,0 +1,35 @@
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import FileResponse
+
+from ..services import book_files
+
+router = APIRouter()
+
+
+def respond(request: Request, v: book_files.Variant):
+    """事前圧縮済みのファイルを返す（If-None-Match が一致すれば 304）。"""
+    headers = {
+        "ETag": v.etag,
+        "Cache-Control": v.cache_control,
+        "Vary": "Accept-Encoding",
+    }
+    inm = request.headers.get("if-none-match", "")
+    if v.etag in (t.strip() for t in inm.split(",")) or inm.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    if v.encoding:
+        headers["Content-Encoding"] = v.encoding
+    # FileResponse はファイルを読み込まずに送る（サーバーが対応していれば pathsend で送信を任せる）
+    return FileResponse(v.path, media_type=v.media_type, headers=headers)
+
+
+@router.get("/web/books_html/{name}", include_in_schema=False)
+async def book_html(name: str, request: Request):
+    """本文 HTML。事前圧縮版を Accept-Encoding に合わせて返す（services/book_files.py）。"""
+    v = book_files.resolve(name, request.headers.get("accept-encoding", ""))
+    if v is None:
+        # ビルド前（dist が無い）なら元の HTML をそのまま返す
+        path = book_files.source_path(name)
+        if path is None:
+            raise HTTPException(status_code=404, detail="Not Found")
+        return FileResponse(path, media_type="text/html; charset=utf-8")
+    return respond(request, v)
@@ -1,14 +1,62 @@
-from fastapi import APIRouter, Depends, Query
-from typing import Optional, List
+import os
+import time
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from typing import Dict, Optional, List
 from sqlalchemy.orm import Session
 from sqlalchemy import or_, text
 
 from ...security.auth import get_current_user_optional
-from ...db.session import get_db
+from ...db.session import SessionLocal, get_db
 from ...models.models import Book, Paragraph
+from ...services import book_files
+from ..books_static import respond
 
 router = APIRouter()
 
+# book_id → slug（slug は変わらないので、分割の配信では DB を1回しか引かない）
+_slugs: Dict[int, str] = {}
+
+
+def _slug(book_id: int) -> Optional[str]:
+    slug = _slugs.get(book_id)
+    if slug is None:
+        with SessionLocal() as db:
+            b = db.get(Book, book_id)
+            slug = b.slug if b else None
+        if slug:
+            _slugs[book_id] = slug
+    return slug
+
+
+# 段落 ID の対応ファイルと DB の照合結果を使い回す秒数（04 で DB を入れ直すと ID が変わる）
+PARA_IDS_CHECK_TTL_S = float(os.getenv("PARA_IDS_CHECK_TTL_S", "60"))
+# (book_id, ハッシュ) → (一致したか, 確かめた時刻)
+_para_ids_checked: Dict[tuple, tuple] = {}
+
+
+def _para_ids_match(db: Session, book_id: int, ids: dict) -> Optional[bool]:
+    """対応ファイルの件数・ID の範囲が DB と一致するか。DB に聞けなければ None。"""
+    key = (book_id, ids["hash"])
+    now = time.monotonic()
+    cached = _para_ids_checked.get(key)
+    if cached and now - cached[1] < PARA_IDS_CHECK_TTL_S:
+        return cached[0]
+    try:
+        row = db.execute(
+            text("SELECT COUNT(*), MIN(id), MAX(id) FROM paragraphs WHERE book_id = :b"),
+            {"b": book_id},
+        ).one()
+    except Exception as e:
+        print(f"para_index check failed for book {book_id}: {e}")
+        return None
+    ok = ids.get("book_id") == book_id and (ids.get("count"), ids.get("min_id"), ids.get("max_id")) == tuple(row)
+    if not ok and (cached is None or cached[0]):
+        print(f"para_ids for book {book_id} is stale; run preprocessing/15_export_para_ids.py")
+    _para_ids_checked[key] = (ok, now)
+    return ok
+
 
 @router.get("")
 def list_books(
@@ -78,9 +126,59 @@ def get_book(book_id: int, db: Session = Depends(get_db)):
         "tags": b.tags,
         "length_chars": b.length_chars,
         "citation": b.citation,
+        # 内容ハッシュ付きの本文 HTML（無ければ従来の /web/books_html/<slug>.html）
+        "html_url": book_files.html_url(b.slug) if b.slug else None,
+        # 章ごとの分割の目次（?v= が内容のハッシュ。分割が無ければ None）
+        "segments_url": _segments_url(b.id, b.slug),
+        # 段落インデックス → 段落 ID（ビルド済みなら ?v= 付きでキャッシュできる）
+        "para_index_url": _para_index_url(db, b.id, b.slug),
     }
 
 
+def _para_index_url(db: Session, book_id: int, slug: Optional[str]) -> str:
+    """DB と一致した対応ファイルがあるときだけ ?v= を付ける（ブラウザは ?v= 付きを使い続ける）。"""
+    ids = book_files.para_ids(slug) if slug else None
+    url = f"/v1/books/{book_id}/para_index"
+    return f"{url}?v={ids['hash']}" if ids and _para_ids_match(db, book_id, ids) else url
+
+
+def _segments_url(book_id: int, slug: Optional[str]) -> Optional[str]:
+    v = book_files.version(slug) if slug else None
+    return f"/v1/books/{book_id}/segments?v={v}" if v else None
+
+
+@router.get("/{book_id}/segments")
+async def get_segments(book_id: int, request: Request, v: Optional[str] = None):
+    """分割の目録（各分割の段落インデックス・文字オフセットの範囲）と目次。"""
+    slug = await run_in_threadpool(_slug, book_id)
+    m = book_files.segment_manifest(slug) if slug else None
+    if m is None:
+        raise HTTPException(status_code=404, detail="segments not built")
+    path = book_files.DIST_DIR / f"{slug}.{m['hash']}.segments.json"
+    variant = book_files.Variant(
+        path=path,
+        encoding=None,
+        etag=f'"{m["hash"]}-segments"',
+        cache_control=book_files.IMMUTABLE if v == m["hash"] else book_files.REVALIDATE,
+        media_type="application/json",
+    )
+    return respond(request, variant)
+
+
+@router.get("/{book_id}/segments/{index}")
+async def get_segment(book_id: int, index: int, request: Request, v: Optional[str] = None):
+    """index 番目の分割の本文 HTML（事前圧縮版）。"""
+    slug = await run_in_threadpool(_slug, book_id)
+    variant = (
+        book_files.segment(slug, index, request.headers.get("accept-encoding", ""), v)
+        if slug
+        else None
+    )
+    if variant is None:
+        raise HTTPException(status_code=404, detail="segment not found")
+    return respond(request, variant)
+
+
 @router.get("/{book_id}/paragraphs")
 def get_paragraphs(
     book_id: int,
@@ -125,8 +223,29 @@ def get_paragraphs(
 
 
 @router.get("/{book_id}/para_index")
-def get_para_index(book_id: int, db: Session = Depends(get_db)):
-    """段落IDとインデックスだけを返す軽量エンドポイント。静的HTMLと併用。"""
+def get_para_index(
+    book_id: int,
+    request: Request,
+    response: Response,
+    v: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """段落IDとインデックスだけを返す軽量エンドポイント。静的HTMLと併用。
+
+    DB と一致するビルド済みの対応ファイル（{"runs": [[idx, id, 長さ], ...]}）があればそれを返し
+    （DB に聞けないときは immutable にしない）、無ければ DB から {"items": [{"id", "idx"}, ...]} を返す。
+    """
+    try:
+        slug = _slug(book_id)
+    except Exception:
+        slug = None
+    ids = book_files.para_ids(slug) if slug else None
+    match = _para_ids_match(db, book_id, ids) if ids else False
+    if match is not False:
+        accept_encoding = request.headers.get("accept-encoding", "")
+        return respond(request, book_files.para_index(slug, accept_encoding, v if match else None))
+    # 古い ?v= の URL に DB の結果がキャッシュされないように
+    response.headers["Cache-Control"] = "no-store"
     try:
         rows = (
             db.query(Paragraph.id, Paragraph.idx)
@@ -1,70 +1,61 @@
 import os
-import time
+import asyncio
 from typing import Optional, Tuple
 from pydantic import BaseModel
 import uuid
-from io import BytesIO
 import json
-import shutil
 import base64
 
-from PIL import Image
-import httpx
 from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from google.cloud import storage
-from google import genai
-from google.genai import types
-from sqlalchemy import text
 
 from ...security.auth import get_current_user
 from ...db.session import get_db, SessionLocal
 from ...models.models import GenerationJob, Gallery
 from ...services.llm import get_client_for_nano_banana as get_client
+from ...services import (
+    assets,
+    bulkhead,
+    generation_dedup,
+    generation_queue,
+    llm_telemetry,
+    mentions,
+    metrics,
+    model_router,
+    quotas,
+    resilience,
+    scene_cache,
+    thumbnails,
+    veo_poller,
+)
 
 router = APIRouter()
 
-client = get_client()
-
 PROJECT_ID = os.getenv("PROJECT_ID")
 VERTEX_LOCATION = os.getenv("VERTEX_LOCATION", "us-central1")
-ASSETS_BUCKET = os.getenv("ASSETS_BUCKET")
-ASSETS_URL_PREFIX = os.getenv(
-    "ASSETS_URL_PREFIX"
-)  # e.g., https://storage.googleapis.com/<bucket>
-CHARACTER_BUCKET = os.getenv("CHARACTERS_BUCKET")
+ASSETS_BUCKET = assets.ASSETS_BUCKET
 VEO_MODEL_ID = os.getenv("VEO_MODEL_ID", "veo-3.0-fast-generate-001")
+# Veo は秒課金（USD / 生成秒）。コスト見積もり用
+VEO_PRICE_PER_SECOND = float(os.getenv("VEO_PRICE_PER_SECOND", "0.40"))
+VEO_DURATION_SECONDS = 8
 
-os.makedirs("/tmp", exist_ok=True)
+# リクエスト全体の締め切り（入れ子の呼び出し・再試行にも伝わる）
+IMAGE_DEADLINE_S = 240.0
+VIDEO_DEADLINE_S = 600.0
+# index: 登場人物は名前の照合（mentions）で決め、プロンプトだけを flash-lite で作る。曖昧なときだけ
+# pro で登場人物ごと聞く / llm: 常に pro。どちらも結果は scene_prompts にキャッシュ
+CHARACTER_DETECTION = os.getenv("CHARACTER_DETECTION", "index")
+# 画像・動画のプロンプトテンプレートを変えたら上げる（生成結果の使い回しのキーに入る）
+GENERATION_TEMPLATE_VERSION = "v1"
 
 
-def _auth_headers() -> Tuple[str, dict]:
-    base = f"https://{VERTEX_LOCATION}-aiplatform.googleapis.com"
-    # Prefer ADC (OAuth); fallback to API key
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if api_key:
-        return base, {}
-    try:
-        import google.auth
-        import google.auth.transport.requests
+def _vertex_base() -> str:
+    return f"https://{VERTEX_LOCATION}-aiplatform.googleapis.com"
 
-        creds, _ = google.auth.default(
-            scopes=["https://www.googleapis.com/auth/cloud-platform"]
-        )
-        auth_req = google.auth.transport.requests.Request()
-        creds.refresh(auth_req)
-        return base, {"Authorization": f"Bearer {creds.token}"}
-    except Exception:
-        # last resort: require API key
-        return base, {}
 
-
-def _upload_to_gcs(local_path, bucket_name, gcs_path):
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(gcs_path)
-    blob.upload_from_filename(local_path)
-    print(f"Uploaded to gs://{bucket_name}/{gcs_path}")
+class IncompleteGeneration(RuntimeError):
+    """応答に画像（またはテキスト）が含まれていなかった"""
 
 
 class CheckCharactersOutput(BaseModel):
@@ -72,7 +63,7 @@ class CheckCharactersOutput(BaseModel):
     character_names: list[str]
 
 
-def _check_characters(title, text, character_names):
+async def _check_characters(title, text, character_names):
     # Geminiを用いて登場人物を抽出
     system = (
         f"「{title}」の一部本文が与えられます。そのシーンを画像化するためのプロンプトと、その中に登場する人物名を、JSON形式で返してください。\n"
@@ -85,39 +76,161 @@ def _check_characters(title, text, character_names):
         f"# 本文:\n{text}"
         f"# 登場人物ホワイトリスト:\n{character_names}\n"
     )
-    retry_count = 0
-    while retry_count < 3:
+
+    async def attempt(n: int):
+        async def call(model: str):
+            # Q&A と同じモデルでも、生成系は別プールで同時実行数を制限
+            async with bulkhead.limit(model, pool="generate"), llm_telemetry.atrack(
+                model, "check_characters", attempt=n
+            ) as t:
+                resp = await get_client().aio.models.generate_content(
+                    model=model,
+                    contents=system,
+                    config={
+                        "response_mime_type": "application/json",
+                        "response_schema": CheckCharactersOutput,
+                        "temperature": 0.05,
+                    },
+                )
+                t.record(resp)
+            return resp
+
+        # pro が遅い・失敗続きなら flash へフォールバック
+        resp, model = await model_router.arun("check_characters", call)
+        resp_json = json.loads(resp.text)
+        names = [c for c in (resp_json.get("character_names") or []) if c != "others"]
+        return resp_json.get("prompt"), names, model
+
+    try:
+        image_prompt, checked_character_names, model = await resilience.aretry(
+            "check_characters", attempt
+        )
+    except Exception as e:
+        # 抽出できなくても、本文そのものをプロンプトにして生成は続ける（キャッシュはしない）
+        print(f"登場人物の抽出に失敗しました: {e}")
+        image_prompt, checked_character_names, model = text, [], None
+    print(image_prompt, checked_character_names)
+    return image_prompt, checked_character_names, model
+
+
+class ScenePromptOutput(BaseModel):
+    prompt: str
+
+
+async def _scene_prompt(title, text, character_names) -> Tuple[str, Optional[str]]:
+    """登場人物が決まっている場面の、画像化のためのプロンプトだけを作る。Returns (プロンプト, 使ったモデル)。"""
+    system = (
+        f"「{title}」の一部本文が与えられます。そのシーンを画像化するためのプロンプトを、JSON形式で返してください。\n"
+        "# 制約条件:\n"
+        "- 画像化のためのプロンプトは、英語で出力してください。"
+        "- 本文中の要素を、すべてプロンプトに盛り込む必要はありません。印象的なシーンを選び、簡潔に表現してください。\n"
+        "- 本文に文脈的な情報が不足する場合でも、本文がどういった場面かを推測してプロンプトに盛り込んでください。\n"
+        "- 「# 登場人物」に挙げた人物が「誰が」何をしているか、キャラクター名を明示してください。\n"
+        f"# 本文:\n{text}"
+        f"# 登場人物:\n{character_names}\n"
+    )
+
+    async def attempt(n: int):
+        async def call(model: str):
+            async with bulkhead.limit(model, pool="generate"), llm_telemetry.atrack(
+                model, "scene_prompt", attempt=n
+            ) as t:
+                resp = await get_client().aio.models.generate_content(
+                    model=model,
+                    contents=system,
+                    config={
+                        "response_mime_type": "application/json",
+                        "response_schema": ScenePromptOutput,
+                        "temperature": 0.05,
+                    },
+                )
+                t.record(resp)
+            return resp
+
+        resp, model = await model_router.arun("scene_prompt", call)
+        return json.loads(resp.text).get("prompt"), model
+
+    try:
+        return await resilience.aretry("scene_prompt", attempt)
+    except Exception as e:
+        # 作れなくても、本文そのものをプロンプトにして生成は続ける（キャッシュはしない）
+        print(f"シーンのプロンプト生成に失敗しました: {e}")
+        return text, None
+
+
+async def _scene(
+    book_id: int,
+    book: scene_cache.BookCharacters,
+    source: str,
+    paragraph_ids: Optional[list] = None,
+) -> Tuple[str, list[str]]:
+    """選択テキストのプロンプトと登場人物。同じ箇所は scene_prompts から返し、LLM を呼ばない。
+
+    CHARACTER_DETECTION=index で名前の照合が登場人物を決められたら、プロンプトだけを安いモデル
+    （scene_prompt）で作り、pro の登場人物抽出は呼ばない。曖昧なとき・llm のときは pro で両方を作る。
+    """
+    cached = await run_in_threadpool(_in_session, scene_cache.get_scene, book_id, book, source)
+    if cached:
+        return cached
+    found = None
+    if CHARACTER_DETECTION == "index":
+        found = await run_in_threadpool(_mentions, book_id, book, source, paragraph_ids)
+    if found is not None:
+        names = [n for n in found.names if n in book.ref_uris]
+        image_prompt, model = await _scene_prompt(book.title, source, found.names)
+    else:
+        metrics.inc("character_detection_total", source="llm")
+        image_prompt, names, model = await _check_characters(book.title, source, book.names)
+    if model and image_prompt:
         try:
-            resp = client.models.generate_content(
-                model="gemini-2.5-pro",
-                contents=system,
-                config={
-                    "response_mime_type": "application/json",
-                    "response_schema": CheckCharactersOutput,
-                    "temperature": 0.05,
-                },
+            await run_in_threadpool(
+                _in_session, scene_cache.save_scene, book_id, book, source, image_prompt, names, model
             )
-            resp_json = json.loads(resp.text)
-            image_prompt = resp_json.get("prompt")
-            checked_character_names = resp_json.get("character_names")
-            if "others" in checked_character_names:
-                checked_character_names.remove("others")
-            break
         except Exception as e:
-            print(f"登場人物の抽出に失敗しました: {e}")
-            retry_count += 1
-            checked_character_names = []
-    print(image_prompt, checked_character_names)
-    return image_prompt, checked_character_names
-
+            print(f"シーンのキャッシュ保存に失敗しました: {e}")
+    return image_prompt, names
+
+
+def _mentions(
+    book_id: int, book: scene_cache.BookCharacters, source: str, paragraph_ids: Optional[list]
+) -> Optional[mentions.Detection]:
+    """名前の照合で登場人物を決める。曖昧なら None（LLM にフォールバック）。"""
+    found = mentions.detect(book_id, book.version, book.characters, source)
+    if found.names and not found.ambiguous:
+        metrics.inc("character_detection_total", source="matcher")
+        return found
+    # 選択範囲だけでは決まらない（代名詞のみ・「李徴」だけ等）ときは、段落全体の事前計算結果を使う
+    if paragraph_ids:
+        try:
+            para = _in_session(mentions.paragraph_detection, book_id, book.version, paragraph_ids)
+        except Exception as e:
+            print(f"段落の登場人物の取得に失敗しました: {e}")
+            para = None
+        if para is not None and not para.ambiguous and (para.names or not found.ambiguous):
+            metrics.inc("character_detection_total", source="index")
+            return para
+    if not found.ambiguous:
+        metrics.inc("character_detection_total", source="matcher")
+        return found
+    return None
+
+
+async def _generate_image_nano_banana(
+    book: scene_cache.BookCharacters,
+    content,
+    character_names,
+    prompt_template,
+    need_text: Optional[bool] = False,
+) -> Tuple[assets.Blob, str]:
+    """Generate image via Nano Banana. Returns (画像のバイト列, テキスト)。"""
+    from google.genai import types
 
-def _generate_image_nano_banana(
-    title, content, character_names, prompt_template, need_text: Optional[bool] = False
-) -> str:
-    """Generate image via Nano Banana"""
     # プロンプトの入れ物準備
     contents = [types.Content(role="user", parts=[])]
 
+    title = book.title
+    # 参照画像のある（ホワイトリストの）人物だけを使う。Image {i} の番号と画像の順を揃えるため先に絞る
+    character_names = [n for n in character_names if n in book.ref_uris]
     # テキストプロンプトの準備
     characters = "\n".join(
         [f"  - Image {i}: {name}" for i, name in enumerate(character_names)]
@@ -128,68 +241,57 @@ def _generate_image_nano_banana(
     # 入れ物に突っ込む
     contents[0].parts.append(types.Part.from_text(text=text_prompt))
 
-    # 画像の準備
+    # 画像の準備（参照画像の URI は作品ごとにキャッシュ済み）
     for character_name in character_names:
+        uri = book.ref_uris[character_name]
         # Partオブジェクト作成
-        image_part = types.Part.from_uri(
-            file_uri=f"gs://{CHARACTER_BUCKET}/{title}/{character_name}.png",
-            mime_type="image/png",
-        )
-        print(
-            f"gs://{CHARACTER_BUCKET}/{title}/{character_name}.png",
-        )
+        image_part = types.Part.from_uri(file_uri=uri, mime_type="image/png")
+        print(uri)
         # 入れ物に突っ込んでいく
         contents[0].parts.append(image_part)
 
-    retry_count = 0
-    local_path = f"/tmp/{uuid.uuid4().hex}.png"
-    img_flg = False
-    text_flg = False
-    while retry_count < 3:
+    async def attempt(n: int) -> Tuple[assets.Blob, str]:
         # 画像生成実行
-        resp = client.models.generate_content(
-            model="gemini-2.5-flash-image-preview",
-            contents=contents,
-            config={"temperature": 0.5, "response_modalities": ["TEXT", "IMAGE"]},
-        )
+        async with bulkhead.limit(
+            "gemini-2.5-flash-image-preview"
+        ), llm_telemetry.atrack(
+            "gemini-2.5-flash-image-preview", "image", attempt=n
+        ) as t:
+            resp = await get_client().aio.models.generate_content(
+                model="gemini-2.5-flash-image-preview",
+                contents=contents,
+                config={"temperature": 0.5, "response_modalities": ["TEXT", "IMAGE"]},
+            )
+            t.record(resp)
         return_text = ""
+        image = None
         for part in resp.candidates[0].content.parts:
             if part.text is not None:
                 return_text += part.text
-                text_flg = True
             if part.inline_data is not None:
-                image = Image.open(BytesIO(part.inline_data.data))
-                image.save(local_path)
-                img_flg = True
-
-        if need_text:
-            if img_flg and text_flg:
-                break
-        else:
-            if img_flg:
-                break
-
-        retry_count += 1
-        print(
-            f"{retry_count}回目 画像orテキスト生成に失敗しました。{title}_{content[:10]}"
-        )
-    if need_text:
-        if not (img_flg and text_flg):
-            raise HTTPException(
-                status_code=500, detail="画像またはテキスト生成に失敗しました"
-            )
-    else:
-        if not img_flg:
-            raise HTTPException(status_code=500, detail="画像生成に失敗しました")
-    return local_path, return_text
-
+                # デコードせず、モデルが返した形式のまま保持する
+                image = assets.Blob(
+                    part.inline_data.data, part.inline_data.mime_type or "image/png"
+                )
+        # 画像（動画用はプロンプトのテキストも）が揃わなければ再試行
+        if image is None or (need_text and not return_text):
+            raise IncompleteGeneration(f"画像orテキスト生成に失敗しました。{title}_{content[:10]}")
+        return image, return_text
 
-def _veo_generate_and_wait(img_path: str, prompt: str, timeout_s: int = 180) -> dict:
-    base, headers = _auth_headers()
-    # 1シーン目の画像読み込み
-    with open(img_path, "rb") as f:
-        encoded_str = base64.b64encode(f.read()).decode("utf-8")
-    mime_type = "image/png"
+    try:
+        return await resilience.aretry("image", attempt)
+    except IncompleteGeneration:
+        detail = "画像またはテキスト生成に失敗しました" if need_text else "画像生成に失敗しました"
+        raise HTTPException(status_code=500, detail=detail)
+
+
+async def _veo_generate_and_wait(
+    image: assets.Blob, prompt: str, timeout_s: int = 180
+) -> dict:
+    base = _vertex_base()
+    # 1シーン目の画像（生成したバイト列をそのまま渡す）
+    encoded_str = base64.b64encode(image.data).decode("utf-8")
+    mime_type = image.mime_type
     # 動画の生成
     gen_url = f"{base}/v1/projects/{PROJECT_ID}/locations/{VERTEX_LOCATION}/publishers/google/models/{VEO_MODEL_ID}:predictLongRunning"
     body = {
@@ -200,7 +302,7 @@ def _veo_generate_and_wait(img_path: str, prompt: str, timeout_s: int = 180) ->
             }
         ],
         "parameters": {
-            "durationSeconds": 8,
+            "durationSeconds": VEO_DURATION_SECONDS,
             "aspectRatio": "16:9",
             "resolution": "720p",
             "personGeneration": "allow_all",
@@ -209,11 +311,8 @@ def _veo_generate_and_wait(img_path: str, prompt: str, timeout_s: int = 180) ->
             "storageUri": f"gs://{ASSETS_BUCKET.rstrip('/')}/veo",
         },
     }
-    params = {}
-    if os.getenv("GOOGLE_API_KEY"):
-        params["key"] = os.getenv("GOOGLE_API_KEY")
-    with httpx.Client(timeout=60) as client:
-        r = client.post(gen_url, headers=headers, params=params, json=body)
+    async with bulkhead.limit(VEO_MODEL_ID), llm_telemetry.atrack(VEO_MODEL_ID, "video") as t:
+        r = await veo_poller.poller.post(gen_url, body)
         if r.status_code >= 300:
             raise HTTPException(
                 status_code=502, detail=f"Veo submit error: {r.text[:200]}"
@@ -224,72 +323,181 @@ def _veo_generate_and_wait(img_path: str, prompt: str, timeout_s: int = 180) ->
         if not name:
             raise HTTPException(status_code=502, detail="Veo operation name missing")
         op_url = f"{base}/v1/projects/{PROJECT_ID}/locations/{VERTEX_LOCATION}/publishers/google/models/{VEO_MODEL_ID}/:fetchPredictOperation"
-        deadline = time.time() + timeout_s
-        while time.time() < deadline:
-            rr = client.post(
-                op_url,
-                headers=headers,
-                params=params,
-                json={"operationName": name},
-            )
-            if rr.status_code >= 300:
-                raise HTTPException(
-                    status_code=502, detail=f"Veo poll error: {rr.text[:200]}"
-                )
-            od = rr.json()
-            if od.get("done"):
-                if od.get("error") and od.get("error").get("code") == 3:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"動画生成に失敗しました: {od.get('error').get('message')}",
-                    )
-                return od
-            time.sleep(2)
-        raise HTTPException(status_code=504, detail="Veo polling timeout")
-
-
-def _to_public_url(uri: str) -> str:
-    if uri.startswith("gs://"):
-        # translate gs://bucket/obj to prefix/obj if configured
-        if ASSETS_URL_PREFIX and uri.startswith(f"gs://{ASSETS_BUCKET}/"):
-            obj = uri[len(f"gs://{ASSETS_BUCKET}/") :]
-            return f"{ASSETS_URL_PREFIX.rstrip('/')}/{obj}"
-        # default to storage.googleapis.com
+        # 完了の確認は共有ポーラーがまとめて行う（ここではスレッドもループも占有しない）
         try:
-            if uri.startswith("gs://"):
-                _, rest = uri.split("gs://", 1)
-                bucket, obj = rest.split("/", 1)
-                return f"https://storage.googleapis.com/{bucket}/{obj}"
-        except Exception:
-            pass
-        return uri
-    return uri
+            od = await veo_poller.poller.wait(op_url, name, timeout_s)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Veo polling timeout")
+        except veo_poller.VeoPollError as e:
+            raise HTTPException(status_code=502, detail=str(e))
+        if od.get("error") and od.get("error").get("code") == 3:
+            raise HTTPException(
+                status_code=400,
+                detail=f"動画生成に失敗しました: {od.get('error').get('message')}",
+            )
+        t.add_cost(VEO_PRICE_PER_SECOND * VEO_DURATION_SECONDS)
+        return od
 
 
-@router.post("/image")
-def generate_image(
-    payload: dict, db: Session = Depends(get_db), user=Depends(get_current_user)
-):
+def _load_book(db: Session, book_id) -> scene_cache.BookCharacters:
+    # タイトルとキャラ一覧（プロセス内キャッシュ）
+    book = scene_cache.book_characters(db, book_id)
+    if book is None:
+        raise HTTPException(status_code=404, detail="book not found")
+    return book
+
+
+def _in_session(fn, *args, **kwargs):
+    # ワーカーはリクエストのセッションを持たないので都度開く
+    db = SessionLocal()
+    try:
+        return fn(db, *args, **kwargs)
+    finally:
+        db.close()
+
+
+def _save_gallery(db: Session, **kwargs) -> Optional[int]:
+    g = Gallery(**kwargs)
+    db.add(g)
+    db.commit()
+    return g.id
+
+
+def _validate(db: Session, payload: dict) -> Tuple[int, str, scene_cache.BookCharacters]:
     book_id = payload.get("book_id")
     source = payload.get("source")  # selected text or paragraph
-    # style = payload.get("style")
-    # aspect = payload.get("aspect")
     if not (book_id and source):
         raise HTTPException(status_code=400, detail="book_id and source are required")
-    # タイトルとキャラ一覧取得
-    result = db.execute(
-        text("SELECT title, characters FROM books WHERE id = :bid"),
-        {"bid": book_id},
-    )
-    row = result.mappings().first()
-    title = row["title"]
-    characters_json = row["characters"]
-    character_names = [c["name"] for c in characters_json]
-    # 出現キャラチェック
-    image_prompt, checked_character_names = _check_characters(
-        title, source, character_names
+    # 存在しない作品はキューに積む前に弾く
+    book = _load_book(db, book_id)
+    return book_id, source, book
+
+
+def _enqueue(db: Session, user_id: str, job_type: str, payload: dict) -> Tuple[int, str]:
+    """(job_id, status)。同じ入力の生成結果を使い回せたときは積まずに succeeded で返す。"""
+    book_id, source, book = _validate(db, payload)
+    body = {k: payload.get(k) for k in ("source", "style", "aspect", "paragraph_ids")}
+    if generation_dedup.ENABLED:
+        params = {"style": body["style"], "aspect": body["aspect"], "characters": book.version}
+        body["dedup_key"] = generation_dedup.dedup_key(
+            job_type, book_id, source, GENERATION_TEMPLATE_VERSION, params
+        )
+        body["force_new"] = bool(payload.get("force_new"))
+        if not body["force_new"]:
+            result = generation_dedup.reuse(
+                db, body["dedup_key"], user_id, job_type, paragraph_ids=body["paragraph_ids"]
+            )
+            if result:
+                job_id = generation_queue.record_succeeded(
+                    db, user_id, job_type, book_id, source, body, result
+                )
+                return job_id, "succeeded"
+    # 使い回せないものだけ利用上限に数える（超過・混雑時は積まずに 429）
+    body["quota_day"] = quotas.admit(db, user_id, job_type, queued=True)
+    try:
+        return generation_queue.enqueue(db, user_id, job_type, book_id, source, body), "queued"
+    except Exception:
+        db.rollback()
+        quotas.refund(db, user_id, job_type, body["quota_day"])
+        raise
+
+
+def _refund_on_failure(handler):
+    # 生成に失敗したジョブ（使い回しで済んだものも）は1日の回数に数えない
+    async def run(job: dict) -> dict:
+        payload = job["payload"] or {}
+        try:
+            result = await handler(job)
+        except Exception:
+            await _refund(job, payload)
+            raise
+        if result.get("reused"):
+            await _refund(job, payload)
+        return result
+
+    return run
+
+
+async def _refund(job: dict, payload: dict) -> None:
+    try:
+        await run_in_threadpool(
+            _in_session,
+            quotas.refund,
+            job["user_id"],
+            job["job_type"],
+            payload.get("quota_day"),
+        )
+    except Exception as e:
+        print(f"利用回数の払い戻しに失敗しました: {e}")
+
+
+async def _reuse(job: dict) -> Optional[dict]:
+    # 積んでいる間に同じ入力の生成が終わっていれば、それを使う
+    payload = job["payload"] or {}
+    if not payload.get("dedup_key") or payload.get("force_new"):
+        return None
+    return await run_in_threadpool(
+        _in_session,
+        generation_dedup.reuse,
+        payload["dedup_key"],
+        job["user_id"],
+        job["job_type"],
+        job["id"],
+        payload.get("paragraph_ids"),
     )
-    prompt_template = """Please generate an illustration of the following scene from the novel 「{title}」
+
+
+async def _record(job: dict, result: dict) -> None:
+    key = (job["payload"] or {}).get("dedup_key")
+    if not key:
+        return
+    try:
+        await run_in_threadpool(
+            _in_session,
+            generation_dedup.record,
+            key,
+            job["job_type"],
+            job["book_id"],
+            result,
+            result.get("gallery_id"),
+        )
+    except Exception as e:
+        print(f"生成結果の記録に失敗しました: {e}")
+
+
+@router.post("/image", status_code=202)
+async def generate_image(
+    payload: dict, db: Session = Depends(get_db), user=Depends(get_current_user)
+):
+    """画像生成ジョブを積んで job_id を返す（結果は /{job_id}/status で取得）。"""
+    job_id, status = await run_in_threadpool(_enqueue, db, user["uid"], "image", payload)
+    return {"job_id": job_id, "status": status}
+
+
+@router.post("/video", status_code=202)
+async def generate_video(
+    payload: dict, db: Session = Depends(get_db), user=Depends(get_current_user)
+):
+    """動画生成ジョブを積んで job_id を返す（Nano Banana → Veo で数分かかる）。"""
+    job_id, status = await run_in_threadpool(_enqueue, db, user["uid"], "video", payload)
+    return {"job_id": job_id, "status": status}
+
+
+async def _run_image_job(job: dict) -> dict:
+    reused = await _reuse(job)
+    if reused:
+        return reused
+    payload = job["payload"] or {}
+    book_id = job["book_id"]
+    source = payload.get("source") or job["prompt"]
+    book = await run_in_threadpool(_in_session, _load_book, book_id)
+    # 画像生成まで含めた全体の締め切り（各段の再試行もこの中に収める）
+    with resilience.deadline(IMAGE_DEADLINE_S):
+        # 出現キャラチェック（同じ箇所の再生成はキャッシュから）
+        image_prompt, checked_character_names = await _scene(
+            book_id, book, source, payload.get("paragraph_ids")
+        )
+        prompt_template = """Please generate an illustration of the following scene from the novel 「{title}」
 - {content}
 
 # Notes
@@ -298,60 +506,58 @@ def generate_image(
 {characters}
 - In the style of a novel illustration: monochrome or soft colors, delicate linework with gentle shading, and a calm, literary, and lyrical atmosphere.
 """
-    img_path, _ = _generate_image_nano_banana(
-        title, image_prompt, checked_character_names, prompt_template
+        image, _ = await _generate_image_nano_banana(
+            book, image_prompt, checked_character_names, prompt_template
+        )
+    # GCSにアップロード（メモリ上のバイト列をそのまま）
+    uri = await run_in_threadpool(
+        assets.upload_bytes,
+        image.data,
+        f"imagen/{uuid.uuid4().hex}.{image.extension}",
+        image.mime_type,
     )
-    # GCSにアップロード
-    _upload_to_gcs(img_path, ASSETS_BUCKET, f"imagen/{os.path.basename(img_path)}")
     # URIを返す
-    url = _to_public_url(f"gs://{ASSETS_BUCKET}/imagen/{os.path.basename(img_path)}")
-    # img_pathの削除
-    shutil.rmtree(img_path, ignore_errors=True)
+    url = assets.public_url(uri)
     # ギャラリーへ保存
     try:
         paragraph_ids = payload.get("paragraph_ids")
-        meta = {"paragraph_ids": paragraph_ids}
-        g = Gallery(
-            user_id=user["uid"],
+        meta = {"paragraph_ids": paragraph_ids, "job_id": job["id"]}
+        gid = await run_in_threadpool(
+            _in_session,
+            _save_gallery,
+            user_id=job["user_id"],
             book_id=book_id,
             asset_url=url,
             type="image",
             prompt=source,
             meta=meta,
         )
-        db.add(g)
-        db.commit()
-        gid = g.id
     except Exception:
         gid = None
-    return {"asset_url": url, "gallery_id": gid}
-
-
-@router.post("/video")
-def generate_video(
-    payload: dict, db: Session = Depends(get_db), user=Depends(get_current_user)
-):
-    book_id = payload.get("book_id")
-    source = payload.get("source")
+    # サムネイルは裏で作る（手元のバイト列を使い、再ダウンロードしない）
+    thumbnails.schedule(gid, url, "image", image.data)
+    result = {"asset_url": url, "gallery_id": gid}
+    await _record(job, result)
+    return result
+
+
+async def _run_video_job(job: dict) -> dict:
+    reused = await _reuse(job)
+    if reused:
+        return reused
+    payload = job["payload"] or {}
+    book_id = job["book_id"]
+    source = payload.get("source") or job["prompt"]
     style = payload.get("style")
     aspect = payload.get("aspect")
-    if not (book_id and source):
-        raise HTTPException(status_code=400, detail="book_id and source are required")
-
-    # タイトルとキャラ一覧取得
-    result = db.execute(
-        text("SELECT title, characters FROM books WHERE id = :bid"),
-        {"bid": book_id},
-    )
-    row = result.mappings().first()
-    title = row["title"]
-    characters_json = row["characters"]
-    character_names = [c["name"] for c in characters_json]
-    # 出現キャラチェック
-    image_prompt, checked_character_names = _check_characters(
-        title, source, character_names
-    )
-    prompt_template = """Generate a prompt for creating a video of the following scene, and also generate an image for the beginning of the video.
+    book = await run_in_threadpool(_in_session, _load_book, book_id)
+    # 動画生成まで含めた全体の締め切り（各段の再試行もこの中に収める）
+    with resilience.deadline(VIDEO_DEADLINE_S):
+        # 出現キャラチェック（同じ箇所の再生成はキャッシュから）
+        image_prompt, checked_character_names = await _scene(
+            book_id, book, source, payload.get("paragraph_ids")
+        )
+        prompt_template = """Generate a prompt for creating a video of the following scene, and also generate an image for the beginning of the video.
 title: {title}
 scene: {content}
 
@@ -363,25 +569,27 @@ scene: {content}
 {characters}
 - Describe human subjects using age-neutral terms like 'person' or 'figure' to avoid contents filtering issues.
 """
-    retry_count = 0
-    while retry_count < 3:
+        # 画像と Veo はそれぞれの段階で再試行する（入れ子にすると画像生成が最大9回になるため）
+        image, veo_prompt = await _generate_image_nano_banana(
+            book,
+            image_prompt,
+            checked_character_names,
+            prompt_template,
+            need_text=True,
+        )
+        print(f"{image.mime_type} {len(image.data)} bytes", veo_prompt.strip())
+        veo_prompt = veo_prompt.strip().replace("boy", "person").replace("girl", "person")
         try:
-            img_path, veo_prompt = _generate_image_nano_banana(
-                title,
-                image_prompt,
-                checked_character_names,
-                prompt_template,
-                need_text=True,
-            )
-            print(img_path, veo_prompt.strip())
-            result = _veo_generate_and_wait(
-                img_path,
-                veo_prompt.strip().replace("boy", "person").replace("girl", "person"),
+            result = await resilience.aretry(
+                "veo",
+                lambda n: _veo_generate_and_wait(image, veo_prompt),
+                resilience.RetryPolicy(max_attempts=2, base_delay_s=2.0),
             )
-            break
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"動画生成に失敗しました: {e}")
-            retry_count += 1
+            raise HTTPException(status_code=502, detail="動画生成に失敗しました")
     # extract uris robustly
     uris: list[str] = []
     if isinstance(result, dict):
@@ -400,28 +608,41 @@ scene: {content}
                     uris = [ulist]
                 elif isinstance(ulist, list):
                     uris = [u for u in ulist if isinstance(u, str)]
-    public = [_to_public_url(u) for u in uris]
+    public = [assets.public_url(u) for u in uris]
     primary = public[0] if public else None
     # ギャラリーへ保存
     try:
         paragraph_ids = payload.get("paragraph_ids")
-        meta = {"style": style, "aspect": aspect, "paragraph_ids": paragraph_ids}
+        meta = {
+            "style": style,
+            "aspect": aspect,
+            "paragraph_ids": paragraph_ids,
+            "job_id": job["id"],
+        }
         gid = None
         if primary:
-            g = Gallery(
-                user_id=user["uid"],
+            gid = await run_in_threadpool(
+                _in_session,
+                _save_gallery,
+                user_id=job["user_id"],
                 book_id=book_id,
                 asset_url=primary,
                 type="video",
                 prompt=source,
                 meta=meta,
             )
-            db.add(g)
-            db.commit()
-            gid = g.id
     except Exception:
         gid = None
-    return {"asset_url": primary, "video_uris": public, "done": True, "gallery_id": gid}
+    if not primary:
+        raise HTTPException(status_code=502, detail="動画のURIが取得できませんでした")
+    thumbnails.schedule(gid, primary, "video")
+    result = {"asset_url": primary, "video_uris": public, "done": True, "gallery_id": gid}
+    await _record(job, result)
+    return result
+
+
+generation_queue.register("image", _refund_on_failure(_run_image_job))
+generation_queue.register("video", _refund_on_failure(_run_video_job))
 
 
 @router.get("/{job_id}/status")
@@ -431,4 +652,11 @@ def job_status(
     job = db.get(GenerationJob, job_id)
     if not job or job.user_id != user["uid"]:
         raise HTTPException(status_code=404, detail="job not found")
-    return {"job_id": job.id, "status": job.status, "result": job.result}
+    return {
+        "job_id": job.id,
+        "job_type": job.job_type,
+        "status": job.status,
+        "attempts": job.attempts,
+        "result": job.result,
+        "error": job.error if job.status == "failed" else None,
+    }
@@ -1,6 +1,5 @@
 from fastapi import APIRouter, Body, Query
 from fastapi.responses import StreamingResponse
-import httpx
 
 router = APIRouter()
 
@@ -14,6 +13,8 @@ async def init_session(user_id: str = Query(..., description="Firebaseのuid")):
     """初回チャット時のセッション初期化（DELETE→POST）。
     ブラウザからは同一オリジンにPOSTするため、CORSプリフライトを回避。
     """
+    import httpx
+
     async with httpx.AsyncClient(timeout=20.0) as client:
         # ボディ無しでOK
         try:
@@ -36,6 +37,8 @@ async def proxy_run_sse(payload: dict = Body(...)):
     同一オリジン→本API→外部サービス で中継し、ブラウザ側のOPTIONSエラーを回避。
     """
 
+    import httpx
+
     async def gen():
         async with httpx.AsyncClient(timeout=None) as client:
             async with client.stream(
@@ -0,0 +1,19 @@
+import os
+
+from fastapi import APIRouter, Depends, HTTPException
+
+from ...security.auth import get_current_user
+from ...services import metrics, model_router
+
+router = APIRouter()
+
+# 見てよいユーザー（カンマ区切りの uid）。未設定ならログイン済みなら誰でも見られる
+METRICS_ALLOWED_UIDS = {u.strip() for u in os.getenv("METRICS_ALLOWED_UIDS", "").split(",") if u.strip()}
+
+
+@router.get("/metrics")
+def get_metrics(user=Depends(get_current_user)):
+    """プロセス内メトリクス（LLM の待ち行列・待ち時間など）とモデルごとの健全性を返す。"""
+    if METRICS_ALLOWED_UIDS and user["uid"] not in METRICS_ALLOWED_UIDS:
+        raise HTTPException(status_code=403, detail="forbidden")
+    return {**metrics.snapshot(), "models": model_router.health.snapshot()}
@@ -1,68 +1,266 @@
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
 from ...security.auth import get_current_user
-from ...db.session import get_db
+from ...db.session import get_db, SessionLocal
 from ...models.models import Book
-from ...services import llm
+from ...services import canned_qa, llm, log_writer, metrics, quotas, semantic_cache
+from ...services.sse import SSE_HEADERS, sse_comment, sse_event
 
 router = APIRouter()
 
 
+def _as_int(value) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+async def _log(user: dict, payload: dict, answer: str, latency_ms: int) -> None:
+    # qa_logs への書き込みはバックグラウンドでまとめて行う（リクエストは待たない）。
+    # 値はクライアントから来るので、列の型にそろえてから積む
+    question = payload.get("question")
+    await log_writer.qa_logs.put(
+        {
+            "user_id": user["uid"],
+            "book_id": _as_int(payload.get("book_id")),
+            "para_id": _as_int(payload.get("para_id")),
+            "question": question if isinstance(question, str) else str(question or ""),
+            "answer": answer,
+            "citations": [],
+            "latency_ms": latency_ms,
+        }
+    )
+
+
+# 上流からトークンが来ない間に送るハートビートの間隔（秒）
+HEARTBEAT_INTERVAL_S = 10.0
+
+
 @router.post("/qa")
-def qa(payload: dict, db: Session = Depends(get_db), user=Depends(get_current_user)):
+async def qa(payload: dict, db: Session = Depends(get_db), user=Depends(get_current_user)):
     book_id = payload.get("book_id")
     question = payload.get("question")
     context = payload.get("context")
     history = payload.get("history")
     if not (book_id and question):
         raise HTTPException(status_code=400, detail="book_id and question are required")
-    book = db.get(Book, book_id)
+    book = await run_in_threadpool(db.get, Book, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="book not found")
-    text, latency_ms = llm.answer_question(
-        book.title, question, context=context, history=history
-    )
+    canned_key = canned_qa.match(question, context, history)
+    if canned_key:
+        hit = await _serve_canned(db, book, canned_key)
+        if hit:
+            row, _ = hit
+            await _log(user, payload, row.answer, 0)
+            return {
+                "answer": row.answer,
+                "citations": [],
+                "model": row.model,
+                "latency_ms": 0,
+                "confidence": 0.5,
+                "canned": True,
+                "cached": False,
+            }
+    entry, vec, ctx_hash = await _semantic_lookup(book.id, question, context, history)
+    if entry:
+        await _log(user, payload, entry.answer, 0)
+        return {
+            "answer": entry.answer,
+            "citations": [],
+            "model": entry.model,
+            "latency_ms": 0,
+            "confidence": 0.5,
+            "canned": False,
+            "cached": True,
+        }
+    # LLM を呼ぶものだけ利用上限に数える（超過・混雑時は待たせずに 429）。
+    # 枠を先に取り、混雑で断るときは利用回数を消費しない
+    with quotas.slot("qa"):
+        await run_in_threadpool(quotas.admit, db, user["uid"], "qa")
+        text, latency_ms, model = await llm.aanswer_question(
+            book.title, question, context=context, history=history
+        )
+    if vec is not None and text:
+        semantic_cache.cache.put(book.id, ctx_hash, question, vec, text, model, latency_ms)
+    if canned_key and text:
+        # 未計算の定型質問は、この回答を保存して次回以降に使う
+        try:
+            await run_in_threadpool(canned_qa.save, db, book.id, canned_key, text, model)
+        except Exception as e:
+            print(f"定型回答の保存に失敗しました: {e}")
+    await _log(user, payload, text, latency_ms)
     return {
         "answer": text,
         "citations": [],
-        "model": llm.LLM_MODEL,
+        "model": model,
         "latency_ms": latency_ms,
         "confidence": 0.5,
+        "canned": False,
+        "cached": False,
     }
 
 
-# @router.post("/qa/stream")
-# def qa_stream(
-#     payload: dict, db: Session = Depends(get_db), user=Depends(get_current_user)
-# ):
-#     book_id = payload.get("book_id")
-#     question = payload.get("question")
-#     context = payload.get("context")
-#     history = payload.get("history")
-#     if not (book_id and question):
-#         raise HTTPException(status_code=400, detail="book_id and question are required")
-#     book = db.get(Book, book_id)
-#     if not book:
-#         raise HTTPException(status_code=404, detail="book not found")
-
-#     def gen():
-#         # 初期パディングでプロキシ/ブラウザのバッファリングを回避
-#         yield ": " + (" " * 2048) + "\n\n"
-#         yield "event: start\n\n"
-#         for chunk in llm.stream_answer_question(
-#             book.title, question, context=context, history=history
-#         ):
-#             if chunk:
-#                 # SSE形式でdataを送出
-#                 print(chunk)
-#                 yield f"data: {chunk}\n\n"
-#         yield "event: end\n\n"
-
-#     headers = {
-#         "Cache-Control": "no-cache, no-transform",
-#         "X-Accel-Buffering": "no",
-#         "Connection": "keep-alive",
-#     }
-#     return StreamingResponse(gen(), media_type="text/event-stream", headers=headers)
+async def _semantic_lookup(book_id: int, question: str, context, history):
+    """意味的キャッシュを引く。(ヒットした回答 or None, 質問ベクトル, 文脈ハッシュ) を返す。
+    埋め込みに失敗した・履歴付きの場合はベクトルが None（キャッシュしない）。
+    """
+    if not semantic_cache.cacheable(history):
+        return None, None, None
+    vec = await semantic_cache.aembed_question(question)
+    if vec is None:
+        return None, None, None
+    ctx_hash = semantic_cache.context_hash(context)
+    hit = semantic_cache.cache.lookup(book_id, ctx_hash, vec)
+    return (hit[0] if hit else None), vec, ctx_hash
+
+
+def _replay(answer: str, model: str, **flags) -> StreamingResponse:
+    """保存済み・キャッシュ済みの回答を1イベントで再生する。"""
+
+    async def gen():
+        yield sse_event({"model": model, **flags}, event="start")
+        yield sse_event({"text": answer})
+        yield sse_event({"model": model, **flags, "ttft_ms": 0, "latency_ms": 0}, event="end")
+
+    return StreamingResponse(gen(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+async def _serve_canned(db: Session, book: Book, key: str):
+    """保存済みの定型回答を返す。古ければ裏で再生成を予約する。"""
+    hit = await run_in_threadpool(canned_qa.get, db, book.id, key)
+    metrics.inc("canned_qa_total", result="hit" if hit else "miss")
+    if hit and hit[1]:
+        canned_qa.schedule_refresh(book.id, book.title, key)
+    return hit
+
+
+@router.post("/qa/stream")
+async def qa_stream(
+    payload: dict,
+    request: Request,
+    db: Session = Depends(get_db),
+    user=Depends(get_current_user),
+):
+    """Q&A の回答を SSE で逐次返す。
+    - event: start → data（{"text": 差分}）×N → end（model, latency_ms, ttft_ms）
+    - トークン待ちの間は `: ping` コメントを送る
+    - クライアント切断時は上流の生成を即座に打ち切る
+    - 文脈・履歴なしの定型質問は保存済み回答を、言い換えが意味的キャッシュにあればその回答を
+      即座に1イベントで再生
+    """
+    book_id = payload.get("book_id")
+    question = payload.get("question")
+    context = payload.get("context")
+    history = payload.get("history")
+    if not (book_id and question):
+        raise HTTPException(status_code=400, detail="book_id and question are required")
+    book = await run_in_threadpool(db.get, Book, book_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="book not found")
+    title = book.title
+    canned_key = canned_qa.match(question, context, history)
+    hit = await _serve_canned(db, book, canned_key) if canned_key else None
+    if hit:
+        await _log(user, payload, hit[0].answer, 0)
+        return _replay(hit[0].answer, hit[0].model, canned=True, cached=False)
+    entry, vec, ctx_hash = await _semantic_lookup(book.id, question, context, history)
+    if entry:
+        await _log(user, payload, entry.answer, 0)
+        return _replay(entry.answer, entry.model, canned=False, cached=True)
+    # 429 はストリームを開く前に返す（枠は生成中だけ数える）
+    quotas.check_slot("qa")
+    await run_in_threadpool(quotas.admit, db, user["uid"], "qa")
+    book_id = book.id
+
+    def persist_canned(text: str, model: str) -> None:
+        s = SessionLocal()
+        try:
+            canned_qa.save(s, book_id, canned_key, text, model)
+        except Exception as e:
+            print(f"定型回答の保存に失敗しました: {e}")
+        finally:
+            s.close()
+
+    async def gen():
+        start = time.time()
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+        info: dict = {}
+
+        async def pump():
+            try:
+                async for chunk in llm.stream_answer_question(
+                    title, question, context=context, history=history, info=info
+                ):
+                    await queue.put(chunk)
+                await queue.put(done)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await queue.put(e)
+
+        quotas.acquire_slot("qa", enforce=False)
+        task = asyncio.create_task(pump())
+        ttft_ms = None
+        buf: list[str] = []
+        try:
+            # 第一候補を示す（フォールバック後に実際に使ったモデルは end で返す）
+            yield sse_event(
+                {"model": llm.LLM_MODEL, "canned": False, "cached": False}, event="start"
+            )
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=HEARTBEAT_INTERVAL_S)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield sse_comment("ping")
+                    continue
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    print(f"Q&Aストリームに失敗しました: {item}")
+                    yield sse_event({"detail": "回答の生成に失敗しました"}, event="error")
+                    return
+                if ttft_ms is None:
+                    ttft_ms = int((time.time() - start) * 1000)
+                buf.append(item)
+                yield sse_event({"text": item})
+            answer = "".join(buf).strip()
+            latency_ms = int((time.time() - start) * 1000)
+            model = info.get("model", llm.LLM_MODEL)
+            await _log(user, payload, answer, latency_ms)
+            if vec is not None and answer:
+                semantic_cache.cache.put(
+                    book_id, ctx_hash, question, vec, answer, model, latency_ms
+                )
+            if canned_key and answer:
+                await run_in_threadpool(persist_canned, answer, model)
+            yield sse_event(
+                {
+                    "model": model,
+                    "canned": False,
+                    "cached": False,
+                    "ttft_ms": ttft_ms,
+                    "latency_ms": latency_ms,
+                },
+                event="end",
+            )
+        finally:
+            # 切断（CancelledError）や途中終了時は上流の生成を打ち切る
+            if not task.done():
+                task.cancel()
+            quotas.release_slot("qa")
+
+    return StreamingResponse(gen(), media_type="text/event-stream", headers=SSE_HEADERS)
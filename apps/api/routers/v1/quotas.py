@@ -0,0 +1,15 @@
+from fastapi import APIRouter, Depends
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from ...security.auth import get_current_user
+from ...db.session import get_db
+from ...services import quotas
+
+router = APIRouter()
+
+
+@router.get("/quotas")
+async def get_quotas(db: Session = Depends(get_db), user=Depends(get_current_user)):
+    """画像・動画生成と Q&A の利用状況（本日の残り回数・短時間の残り回数）。"""
+    return await run_in_threadpool(quotas.status, db, user["uid"])
@@ -1,6 +1,9 @@
-from fastapi import APIRouter, Depends
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException
 
 from ...security.auth import get_current_user
+from ...services import log_writer
 
 router = APIRouter()
 
@@ -10,3 +13,34 @@ def get_recommendations(user=Depends(get_current_user)):
     # TODO: compute recommendations from tastes vector and diversity constraints
     return {"items": []}
 
+
+def _as_int(value) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_str(value) -> Optional[str]:
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+@router.post("/recommendations/click")
+async def record_click(payload: dict, user=Depends(get_current_user)):
+    """レコメンドのクリックを記録（recommendations_log へはバックグラウンドでまとめて書く）。
+    値はクライアントから来るので、列の型にそろえてから積む（1行の型違いでバッチを落とさない）"""
+    book_id = _as_int(payload.get("book_id"))
+    if book_id is None:
+        raise HTTPException(status_code=400, detail="book_id is required")
+    accepted = await log_writer.recommendation_logs.put(
+        {
+            "user_id": user["uid"],
+            "book_id": book_id,
+            "quote": _as_str(payload.get("quote")),
+            "one_liner": _as_str(payload.get("one_liner")),
+            "clicked": True,
+        }
+    )
+    return {"ok": True, "accepted": accepted}
@@ -1,16 +1,20 @@
+import time
+
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
 from ...security.auth import get_current_user
-from ...db.session import get_db
-from ...models.models import Book, Paragraph, Translation
+from ...db.session import get_db, SessionLocal
+from ...models.models import Book, Paragraph, Translation, ParagraphTranslation
 from ...services import llm
+from ...services.sse import SSE_HEADERS, sse_event
 
 router = APIRouter()
 
 
-@router.post("/translate")
-def translate(payload: dict, db: Session = Depends(get_db), user=Depends(get_current_user)):
+def _load_book_and_para(db: Session, payload: dict):
     book_id = payload.get("book_id")
     para_id = payload.get("para_id")
     if not (book_id and para_id):
@@ -19,23 +23,156 @@ def translate(payload: dict, db: Session = Depends(get_db), user=Depends(get_cur
     para = db.get(Paragraph, para_id)
     if not book or not para or para.book_id != book.id:
         raise HTTPException(status_code=404, detail="book/paragraph not found")
-    text, latency_ms = llm.translate_paragraph(book.title, para.text)
+    return book, para
+
+
+def _get_cached_translation(db: Session, para_id: int):
+    """共有キャッシュ（事前翻訳バッチ or 他ユーザーの翻訳）を参照。プロンプト版が古いものは無視。"""
+    try:
+        row = db.get(ParagraphTranslation, para_id)
+    except Exception:
+        return None
+    if row and row.prompt_version == llm.TRANSLATE_PROMPT_VERSION and row.text:
+        return row
+    return None
+
+
+def _save_translation(
+    db: Session,
+    user_id: str,
+    book_id: int,
+    para_id: int,
+    text: str,
+    model: str,
+    save_cache: bool,
+) -> None:
+    if save_cache and text:
+        db.merge(
+            ParagraphTranslation(
+                para_id=para_id,
+                book_id=book_id,
+                text=text,
+                model=model,
+                prompt_version=llm.TRANSLATE_PROMPT_VERSION,
+            )
+        )
     # 永続化（同一ユーザー×段落は最新を1件保持）
     tr = Translation(
-        user_id=user["uid"],
-        book_id=book.id,
-        para_id=para.id,
+        user_id=user_id,
+        book_id=book_id,
+        para_id=para_id,
         text=text,
-        model=getattr(llm, "LLM_MODEL", None),
+        model=model,
     )
     try:
         # 既存があれば削除して差し替え（簡易）
         db.query(Translation).filter(
-            Translation.user_id == user["uid"],
-            Translation.para_id == para.id,
+            Translation.user_id == user_id,
+            Translation.para_id == para_id,
         ).delete()
     except Exception:
         pass
     db.add(tr)
     db.commit()
-    return {"translation": text, "model": llm.LLM_MODEL, "latency_ms": latency_ms}
+
+
+def _load(db: Session, payload: dict):
+    book, para = _load_book_and_para(db, payload)
+    return book, para, _get_cached_translation(db, para.id)
+
+
+@router.post("/translate")
+async def translate(payload: dict, db: Session = Depends(get_db), user=Depends(get_current_user)):
+    # DB アクセスはスレッドプールで、LLM 呼び出しは非同期クライアントでイベントループ上で待つ
+    book, para, cached = await run_in_threadpool(_load, db, payload)
+    chunk_latencies: list[int] = []
+    if cached:
+        text, latency_ms, model = cached.text, 0, cached.model
+    else:
+        # 長い段落は文境界で分割して並列に訳す（キャッシュは段落単位のまま）
+        text, latency_ms, chunk_latencies, model = await llm.atranslate_paragraph(
+            book.title, para.text
+        )
+    await run_in_threadpool(
+        _save_translation,
+        db, user["uid"], book.id, para.id, text, model, cached is None,
+    )
+    return {
+        "translation": text,
+        "model": model,
+        "latency_ms": latency_ms,
+        "cached": cached is not None,
+        "chunks": len(chunk_latencies) or 1,
+        # 塊を逐次に訳した場合の目安（並列化による短縮幅の確認用）
+        "sequential_latency_ms": sum(chunk_latencies) or latency_ms,
+    }
+
+
+@router.post("/translate/stream")
+async def translate_stream(
+    payload: dict, db: Session = Depends(get_db), user=Depends(get_current_user)
+):
+    """現代語訳を SSE で逐次返す。
+    - event: start（model, cached） → data（{"text": 差分}）×N → end（latency_ms, ttft_ms）
+    - キャッシュ済みなら即座に全文を1イベントで再生
+    - 長い段落は塊ごとに並列に訳し、原文の順に流す
+    - 生成完了後に全文を保存（途中で切断された場合は保存しない）
+    """
+    book, para, cached = await run_in_threadpool(_load, db, payload)
+    user_id = user["uid"]
+    book_id, para_id = book.id, para.id
+    title, source = book.title, para.text
+    cached_text = cached.text if cached else None
+    cached_model = cached.model if cached else None
+
+    def persist(text: str, model: str) -> None:
+        # 依存関係のセッションはレスポンス開始前に閉じられるため、新しいセッションで保存
+        s = SessionLocal()
+        try:
+            _save_translation(
+                s, user_id, book_id, para_id, text, model,
+                save_cache=cached_text is None,
+            )
+        except Exception as e:
+            print(f"翻訳の保存に失敗しました: {e}")
+        finally:
+            s.close()
+
+    async def gen():
+        start = time.time()
+        if cached_text is not None:
+            yield sse_event({"model": cached_model, "cached": True}, event="start")
+            yield sse_event({"text": cached_text})
+            ttft_ms = int((time.time() - start) * 1000)
+            text, model = cached_text, cached_model
+        else:
+            model = llm.TRANSLATE_MODEL
+            yield sse_event({"model": model, "cached": False}, event="start")
+            buf: list[str] = []
+            ttft_ms = None
+            info: dict = {}
+            try:
+                async for chunk in llm.stream_translate_paragraph(title, source, info=info):
+                    if ttft_ms is None:
+                        ttft_ms = int((time.time() - start) * 1000)
+                    buf.append(chunk)
+                    yield sse_event({"text": chunk})
+            except Exception as e:
+                print(f"翻訳ストリームに失敗しました: {e}")
+                yield sse_event({"detail": "翻訳に失敗しました"}, event="error")
+                return
+            text = "".join(buf).strip()
+            model = info.get("model", model)
+        latency_ms = int((time.time() - start) * 1000)
+        await run_in_threadpool(persist, text, model)
+        yield sse_event(
+            {
+                "model": model,
+                "cached": cached_text is not None,
+                "ttft_ms": ttft_ms,
+                "latency_ms": latency_ms,
+            },
+            event="end",
+        )
+
+    return StreamingResponse(gen(), media_type="text/event-stream", headers=SSE_HEADERS)
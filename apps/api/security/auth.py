@@ -12,13 +12,13 @@ AUTH_DISABLED = os.getenv("AUTH_DISABLED", "false").lower() == "true"
 firebase_initialized = False
 
 
-def _init_firebase():
+def init_firebase():
     global firebase_initialized
     if firebase_initialized:
         return
     try:
         import firebase_admin
-        from firebase_admin import credentials
+        from firebase_admin import auth, credentials  # noqa: F401  検証用モジュールも読み込んでおく
 
         if not firebase_admin._apps:
             # If running on GCP, ADC is used; otherwise this falls back to default
@@ -32,7 +32,7 @@ def _init_firebase():
 def verify_token(id_token: str) -> Optional[dict]:
     if AUTH_DISABLED:
         return {"uid": "dev-user"}
-    _init_firebase()
+    init_firebase()
     try:
         from firebase_admin import auth
 
@@ -0,0 +1,92 @@
+"""生成アセット（画像・動画・サムネイル）の GCS 保存と公開 URL。
+
+- モデルが返したバイト列をそのまま（デコード・再エンコード・一時ファイルなしで）アップロードする
+- storage.Client はプロセスで1つを使い回す（接続プール・認証情報の再利用）
+"""
+import os
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+ASSETS_BUCKET = os.getenv("ASSETS_BUCKET")
+ASSETS_URL_PREFIX = os.getenv("ASSETS_URL_PREFIX")  # e.g., https://storage.googleapis.com/<bucket>
+
+_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+    "video/mp4": "mp4",
+}
+
+_client = None
+_lock = threading.Lock()
+
+
+@dataclass
+class Blob:
+    """メモリ上のアセット（モデル出力のバイト列と MIME タイプ）。"""
+
+    data: bytes
+    mime_type: str
+
+    @property
+    def extension(self) -> str:
+        return _EXTENSIONS.get(self.mime_type, "bin")
+
+
+def storage_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                from google.cloud import storage
+
+                _client = storage.Client()
+    return _client
+
+
+def upload_bytes(
+    data: bytes, path: str, content_type: str, bucket: Optional[str] = None
+) -> str:
+    """バイト列を gs://<bucket>/<path> に保存して URI を返す。"""
+    bucket = bucket or ASSETS_BUCKET
+    blob = storage_client().bucket(bucket).blob(path)
+    blob.upload_from_string(data, content_type=content_type)
+    print(f"Uploaded to gs://{bucket}/{path}")
+    return f"gs://{bucket}/{path}"
+
+
+def public_url(uri: str) -> str:
+    if uri.startswith("gs://"):
+        # translate gs://bucket/obj to prefix/obj if configured
+        if ASSETS_URL_PREFIX and uri.startswith(f"gs://{ASSETS_BUCKET}/"):
+            obj = uri[len(f"gs://{ASSETS_BUCKET}/") :]
+            return f"{ASSETS_URL_PREFIX.rstrip('/')}/{obj}"
+        # default to storage.googleapis.com
+        try:
+            _, rest = uri.split("gs://", 1)
+            bucket, obj = rest.split("/", 1)
+            return f"https://storage.googleapis.com/{bucket}/{obj}"
+        except Exception:
+            pass
+    return uri
+
+
+def gs_uri(url: str) -> Optional[str]:
+    """public_url の逆変換（既存アセットの再取得用）。GCS 以外の URL は None。"""
+    if url.startswith("gs://"):
+        return url
+    if ASSETS_URL_PREFIX and url.startswith(ASSETS_URL_PREFIX.rstrip("/") + "/"):
+        return f"gs://{ASSETS_BUCKET}/{url[len(ASSETS_URL_PREFIX.rstrip('/')) + 1:]}"
+    for host in ("https://storage.googleapis.com/", "https://storage.cloud.google.com/"):
+        if url.startswith(host):
+            return f"gs://{url[len(host):]}"
+    return None
+
+
+def download_bytes(url: str) -> bytes:
+    uri = gs_uri(url)
+    if uri is None:
+        raise ValueError(f"not a GCS asset: {url}")
+    bucket, path = uri[len("gs://") :].split("/", 1)
+    return storage_client().bucket(bucket).blob(path).download_as_bytes()
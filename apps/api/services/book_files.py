@@ -0,0 +1,423 @@
+"""web/books_html の配信（事前圧縮・内容ハッシュ付きの名前・強い ETag・章ごとの分割）。
+
+- build() が各 HTML から dist/<slug>.<hash>.html と .gz / .br（brotli が入っていれば）を作り、
+  dist/manifest.json に slug → ハッシュ・サイズを書く。08_build_full_html.py の最後と
+  14_precompress_books_html.py（Docker ビルド時にも実行）から呼ぶ
+- 同時に本を見出し（data-heading、無ければ「第一章」「一」のような短い段落）で区切り、
+  SEGMENT_MAX_BYTES を超えないよう分割した dist/<slug>.<hash>.seg<i>.html と、目次・各分割の
+  段落インデックスと文字オフセットの範囲を持つ dist/<slug>.<hash>.segments.json を作る
+- GET /web/books_html/<slug>.<hash>.html は Accept-Encoding を見て br → gzip → 無圧縮の順に選び、
+  圧縮済みのファイルをそのまま返す（Cache-Control: immutable、ETag はハッシュ＋符号化）
+- ハッシュ無しの <slug>.html も同じ中身を返すが、Cache-Control: no-cache（ETag で再検証）
+- マニフェストに無いファイルは元の HTML をそのまま返す（ビルド前の開発環境）
+- html_url(slug) はハッシュ付きの URL（GET /v1/books/{id} の html_url）。分割は
+  GET /v1/books/{id}/segments（目次）と /segments/{i}（本文）で、?v=<hash> が一致すれば immutable
+- 段落インデックス → DB の段落 ID の対応は 15_export_para_ids.py が DB から para_ids/<slug>.json に
+  書き出し、build() が dist/<slug>.<hash>.ids.json として置く（GET /v1/books/{id}/para_index?v=<hash>）。
+  ID は 04_copy_csv_to_db.py で振り直されるので、本文とは別のハッシュを持つ
+"""
+import gzip
+import hashlib
+import html
+import json
+import os
+import re
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import quote
+
+ROOT = Path(__file__).resolve().parents[3]
+BOOKS_HTML_DIR = ROOT / "web" / "books_html"
+DIST_DIR = BOOKS_HTML_DIR / "dist"
+PARA_IDS_DIR = "para_ids"
+MANIFEST = "manifest.json"
+URL_PREFIX = "/web/books_html"
+HASH_CHARS = 12
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "public, no-cache"
+# 優先順（同じ q 値なら小さくなる方）
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# 分割の大きさ（無圧縮の HTML のバイト数）。見出しでは SEGMENT_MIN_BYTES を超えていれば区切る
+SEGMENT_MAX_BYTES = int(os.getenv("BOOK_SEGMENT_MAX_BYTES", str(128 * 1024)))
+SEGMENT_MIN_BYTES = int(os.getenv("BOOK_SEGMENT_MIN_BYTES", str(16 * 1024)))
+
+_PARA_START = re.compile(r'^<div class="para[ "][^>]*>', re.M)
+_ATTR = re.compile(r'([\w-]+)="([^"]*)"')
+_TAG = re.compile(r"<[^>]+>")
+_BR = re.compile(r"<br\s*/?>", re.I)
+# data-heading の無い古い HTML 用。段落全体が章番号だけのものを見出しとみなす
+_NUMERAL = "一二三四五六七八九十百千〇零壱弐参0-9０-９"
+_HEADING_1 = re.compile(rf"^(第[{_NUMERAL}]+[篇編部巻幕]|[上中下]巻|[前後]編)$")
+_HEADING_2 = re.compile(rf"^(第[{_NUMERAL}]+[章回話節場]|[{_NUMERAL}]+|序[章文幕]?|終章|プロローグ|エピローグ)$")
+HEADING_MAX_CHARS = 20
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:HASH_CHARS]
+
+
+# ---- ビルド ----
+
+
+def _write(path: Path, data: bytes) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _compressors():
+    out = {"gzip": lambda b: gzip.compress(b, compresslevel=9, mtime=0)}
+    try:
+        import brotli  # type: ignore
+
+        out["br"] = lambda b: brotli.compress(b, quality=11, mode=brotli.MODE_TEXT)
+    except ImportError:
+        print("brotli が無いので .br は作りません（pip install brotli）")
+    return out
+
+
+def _publish(out_dir: Path, name: str, data: bytes, compressors, keep: set) -> dict:
+    """name とその圧縮版を置き、各サイズを返す（既にあれば作り直さない）。"""
+    if not (out_dir / name).exists():
+        _write(out_dir / name, data)
+    keep.add(name)
+    sizes = {"size": len(data)}
+    for encoding, suffix in ENCODINGS:
+        path = out_dir / (name + suffix)
+        if not path.exists():
+            if encoding not in compressors:
+                continue
+            packed = compressors[encoding](data)
+            # 小さくならないなら置かない（無圧縮で返す）
+            if len(packed) >= len(data):
+                continue
+            _write(path, packed)
+        sizes[encoding] = path.stat().st_size
+        keep.add(path.name)
+    return sizes
+
+
+def encode_para_ids(book_id: int, rows) -> dict:
+    """(idx, 段落 ID) の並びを para_ids/<slug>.json の中身にする。
+
+    idx と ID がそろって1ずつ増える区間を [先頭の idx, 先頭の ID, 長さ] にまとめる
+    （04 でまとめて投入した本は区間1つになる）。count・min_id・max_id は配信時の DB との照合用。
+    """
+    runs: List[List[int]] = []
+    for idx, pid in sorted(rows):
+        last = runs[-1] if runs else None
+        if last and idx == last[0] + last[2] and pid == last[1] + last[2]:
+            last[2] += 1
+        else:
+            runs.append([idx, pid, 1])
+    ids = [pid for _, pid in rows]
+    return {
+        "book_id": book_id,
+        "count": len(ids),
+        "min_id": min(ids, default=None),
+        "max_id": max(ids, default=None),
+        "runs": runs,
+    }
+
+
+def _publish_para_ids(src: Path, slug: str, out_dir: Path, compressors, keep: set) -> Optional[dict]:
+    """para_ids/<slug>.json を dist/<slug>.<hash>.ids.json として置き、マニフェストの項目を返す。"""
+    try:
+        data = src.read_bytes()
+        doc = json.loads(data)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"{src.name} を読めないので段落 ID の対応は DB から返します: {e}")
+        return None
+    h = content_hash(data)
+    return {
+        "hash": h,
+        **{k: doc.get(k) for k in ("book_id", "count", "min_id", "max_id")},
+        **_publish(out_dir, f"{slug}.{h}.ids.json", data, compressors, keep),
+    }
+
+
+@dataclass
+class _Block:
+    html: str
+    idx: Optional[int]
+    text: str
+    heading: Optional[int]
+
+
+def _blocks(doc: str) -> List[_Block]:
+    """段落の div ごとに切り出す（先頭のコメントは最初の段落に付ける）。"""
+    starts = [m.start() for m in _PARA_START.finditer(doc)]
+    if not starts:
+        return []
+    starts[0] = 0
+    marked = "data-heading" in doc
+    out = []
+    for i, start in enumerate(starts):
+        chunk = doc[start : starts[i + 1] if i + 1 < len(starts) else len(doc)]
+        m = _PARA_START.search(chunk)
+        attrs = dict(_ATTR.findall(m.group(0))) if m else {}
+        text = html.unescape(_TAG.sub("", _BR.sub("\n", chunk[m.end() :] if m else chunk))).strip()
+        idx = int(attrs["data-idx"]) if attrs.get("data-idx", "").isdigit() else None
+        heading = None
+        if attrs.get("data-heading", "").isdigit():
+            heading = int(attrs["data-heading"])
+        elif idx is not None and not marked and len(text) <= HEADING_MAX_CHARS:
+            if _HEADING_1.match(text):
+                heading = 1
+            elif _HEADING_2.match(text):
+                heading = 2
+        out.append(_Block(chunk, idx, text, heading))
+    return out
+
+
+def split(doc: str):
+    """本の HTML を (分割ごとの HTML, 目録) に分ける。目録は段落数・文字数・各分割の範囲・目次。
+
+    文字オフセットは 03_ingest_aozora_html.py と同じ数え方（段落の間に2文字）。
+    """
+    parts: List[List[_Block]] = []
+    cur: List[_Block] = []
+    cur_bytes = 0
+    for b in _blocks(doc):
+        size = len(b.html.encode("utf-8"))
+        # 段落インデックスの無い末尾（底本の追記など）は直前の分割に付ける
+        if cur and b.idx is not None and (
+            (b.heading is not None and cur_bytes >= SEGMENT_MIN_BYTES)
+            or cur_bytes + size > SEGMENT_MAX_BYTES
+        ):
+            parts.append(cur)
+            cur, cur_bytes = [], 0
+        cur.append(b)
+        cur_bytes += size
+    if cur:
+        parts.append(cur)
+    htmls, segments, toc = [], [], []
+    offset = paragraphs = 0
+    for i, blocks in enumerate(parts):
+        idxs = [b.idx for b in blocks if b.idx is not None]
+        start = offset
+        for b in blocks:
+            if b.idx is None:
+                continue
+            paragraphs += 1
+            if b.heading is not None:
+                toc.append({"title": b.text, "level": b.heading, "idx": b.idx, "segment": i, "char_start": offset})
+            offset += len(b.text) + 2
+        htmls.append("".join(b.html for b in blocks))
+        segments.append(
+            {
+                "first_idx": min(idxs) if idxs else None,
+                "last_idx": max(idxs) if idxs else None,
+                "char_start": start,
+                "char_end": max(start, offset - 2),
+            }
+        )
+    return htmls, {
+        "paragraphs": paragraphs,
+        "chars": segments[-1]["char_end"] if segments else 0,
+        "segments": segments,
+        "toc": toc,
+    }
+
+
+def build(src_dir: Path = BOOKS_HTML_DIR, out_dir: Path = DIST_DIR) -> dict:
+    """src_dir/*.html から圧縮版・分割とマニフェストを作る。内容が同じ本は作り直さない。"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    compressors = _compressors()
+    books: Dict[str, dict] = {}
+    keep = {MANIFEST}
+    for src in sorted(src_dir.glob("*.html")):
+        data = src.read_bytes()
+        h = content_hash(data)
+        base = f"{src.stem}.{h}"
+        entry = {"hash": h, **_publish(out_dir, f"{base}.html", data, compressors, keep)}
+        htmls, seg_manifest = split(data.decode("utf-8"))
+        for i, (seg_html, seg) in enumerate(zip(htmls, seg_manifest["segments"])):
+            seg.update(_publish(out_dir, f"{base}.seg{i}.html", seg_html.encode("utf-8"), compressors, keep))
+        seg_manifest = {"hash": h, **seg_manifest}
+        _write(out_dir / f"{base}.segments.json", json.dumps(seg_manifest, ensure_ascii=False).encode("utf-8"))
+        keep.add(f"{base}.segments.json")
+        entry["segments"] = len(htmls)
+        ids = _publish_para_ids(src_dir / PARA_IDS_DIR / f"{src.stem}.json", src.stem, out_dir, compressors, keep)
+        if ids:
+            entry["ids"] = ids
+        books[src.stem] = entry
+    # 前回のビルドの残り（内容が変わった本の古いハッシュ）を消す
+    for p in out_dir.iterdir():
+        if p.is_file() and p.name not in keep:
+            p.unlink()
+    manifest = {"books": books}
+    _write(out_dir / MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=0).encode("utf-8"))
+    return manifest
+
+
+# ---- 配信 ----
+
+_manifest: Dict[str, dict] = {}
+_manifest_mtime = 0.0
+_segment_manifests: Dict[str, dict] = {}
+_lock = threading.Lock()
+
+
+def _books() -> Dict[str, dict]:
+    """マニフェスト（更新されていれば読み直す）。"""
+    global _manifest, _manifest_mtime
+    path = DIST_DIR / MANIFEST
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
+        return {}
+    if mtime != _manifest_mtime:
+        with _lock:
+            if mtime != _manifest_mtime:
+                try:
+                    _manifest = json.loads(path.read_text(encoding="utf-8")).get("books") or {}
+                except (OSError, ValueError) as e:
+                    print(f"books_html manifest の読み込みに失敗しました: {e}")
+                    return _manifest
+                _manifest_mtime = mtime
+                _segment_manifests.clear()
+    return _manifest
+
+
+def html_url(slug: str) -> Optional[str]:
+    entry = _books().get(slug)
+    if not entry:
+        return None
+    return f"{URL_PREFIX}/{quote(slug)}.{entry['hash']}.html"
+
+
+def version(slug: str) -> Optional[str]:
+    """本の内容のハッシュ（分割の URL の ?v=）。分割が無ければ None。"""
+    entry = _books().get(slug)
+    return entry["hash"] if entry and entry.get("segments") else None
+
+
+def _accepted(accept_encoding: str) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for item in (accept_encoding or "").split(","):
+        token, _, params = item.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        for p in params.split(";"):
+            k, _, v = p.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        out[token] = q
+    return out
+
+
+def negotiate(accept_encoding: str, available) -> Optional[str]:
+    """使う符号化（None は無圧縮）。"""
+    accepted = _accepted(accept_encoding)
+    best, best_q = None, 0.0
+    for encoding, _ in ENCODINGS:
+        if encoding not in available:
+            continue
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+@dataclass
+class Variant:
+    path: Path
+    encoding: Optional[str]
+    etag: str
+    cache_control: str
+    media_type: str = "text/html; charset=utf-8"
+
+
+def _variant(
+    path: Path,
+    tag: str,
+    sizes: dict,
+    accept_encoding: str,
+    immutable: bool,
+    media_type: str = Variant.media_type,
+) -> Variant:
+    encoding = negotiate(accept_encoding, sizes)
+    suffix = dict(ENCODINGS).get(encoding, "")
+    return Variant(
+        path=path.with_name(path.name + suffix),
+        encoding=encoding,
+        etag=f'"{tag}-{encoding or "identity"}"',
+        cache_control=IMMUTABLE if immutable else REVALIDATE,
+        media_type=media_type,
+    )
+
+
+def resolve(name: str, accept_encoding: str) -> Optional[Variant]:
+    """/web/books_html/<name> に返すファイル。マニフェストに無ければ None。"""
+    if not name.endswith(".html") or "/" in name or "\\" in name:
+        return None
+    stem = name[: -len(".html")]
+    books = _books()
+    slug, _, h = stem.rpartition(".")
+    entry = books.get(slug) if slug else None
+    immutable = entry is not None and entry["hash"] == h
+    if not immutable:
+        slug, entry = stem, books.get(stem)
+        if entry is None:
+            return None
+    path = DIST_DIR / f"{slug}.{entry['hash']}.html"
+    return _variant(path, entry["hash"], entry, accept_encoding, immutable)
+
+
+def segment_manifest(slug: str) -> Optional[dict]:
+    """分割の目録と目次（segments.json の中身）。"""
+    h = version(slug)
+    if h is None:
+        return None
+    key = f"{slug}.{h}"
+    m = _segment_manifests.get(key)
+    if m is None:
+        try:
+            m = json.loads((DIST_DIR / f"{key}.segments.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        with _lock:
+            _segment_manifests[key] = m
+    return m
+
+
+def segment(slug: str, index: int, accept_encoding: str, v: Optional[str]) -> Optional[Variant]:
+    """index 番目の分割。v が今のハッシュと一致すれば immutable。"""
+    m = segment_manifest(slug)
+    if m is None or not 0 <= index < len(m["segments"]):
+        return None
+    path = DIST_DIR / f"{slug}.{m['hash']}.seg{index}.html"
+    return _variant(path, f"{m['hash']}.{index}", m["segments"][index], accept_encoding, v == m["hash"])
+
+
+def source_path(name: str) -> Optional[Path]:
+    """マニフェストに無いときに返す元の HTML（ディレクトリの外は返さない）。"""
+    path = (BOOKS_HTML_DIR / name).resolve()
+    if path.parent != BOOKS_HTML_DIR.resolve() or not path.is_file():
+        return None
+    return path
+
+
+def para_ids(slug: str) -> Optional[dict]:
+    """段落 ID の対応ファイルのマニフェスト項目（hash, book_id, count, min_id, max_id, サイズ）。"""
+    entry = _books().get(slug)
+    return entry.get("ids") if entry else None
+
+
+def para_index(slug: str, accept_encoding: str, v: Optional[str]) -> Optional[Variant]:
+    """段落 ID の対応ファイル。v が今のハッシュと一致すれば immutable。"""
+    ids = para_ids(slug)
+    if ids is None:
+        return None
+    path = DIST_DIR / f"{slug}.{ids['hash']}.ids.json"
+    return _variant(path, f"{ids['hash']}-ids", ids, accept_encoding, v == ids["hash"], "application/json")
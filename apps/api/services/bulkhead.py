@@ -0,0 +1,98 @@
+"""モデル（＋用途）ごとの同時実行数制限（バルクヘッド）。
+
+画像・動画生成が翻訳や Q&A の枠を食い潰さないよう、プールを分けて asyncio.Semaphore で制限する。
+上限は環境変数 `LLM_CONCURRENCY` で上書きできる（例: "gemini-2.5-pro=8,generate:gemini-2.5-pro=2,veo=1"）。
+枠を取る前に llm_scheduler で開始のペース（毎分のリクエスト数）と優先度の順番を待つ。
+"""
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from . import llm_scheduler, metrics
+
+DEFAULT_LIMIT = 8
+DEFAULT_LIMITS: Dict[str, int] = {
+    "gemini-2.5-flash-lite": 32,
+    "gemini-2.5-flash": 16,
+    "gemini-2.5-pro": 16,
+    "gemini-embedding-001": 16,
+    # 生成系（/v1/generate）は Q&A と同じモデルでも別プール
+    "generate:gemini-2.5-pro": 4,
+    "generate:gemini-2.5-flash": 4,
+    "gemini-2.5-flash-image-preview": 4,
+    "veo": 2,
+}
+
+
+def _load_limits() -> Dict[str, int]:
+    limits = dict(DEFAULT_LIMITS)
+    raw = os.getenv("LLM_CONCURRENCY", "")
+    for item in raw.split(","):
+        if "=" not in item:
+            continue
+        k, v = item.split("=", 1)
+        try:
+            limits[k.strip()] = max(1, int(v))
+        except ValueError:
+            continue
+    return limits
+
+
+LIMITS = _load_limits()
+
+
+def pool_name(model: str, pool: Optional[str] = None) -> str:
+    # Veo はモデルIDが複数あるため1つのプールにまとめる
+    base = "veo" if model.startswith("veo") else model
+    return f"{pool}:{base}" if pool else base
+
+
+class Bulkhead:
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.waiting = 0
+        self.in_flight = 0
+        self._sem = asyncio.Semaphore(limit)
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.waiting += 1
+        metrics.set_gauge("llm_queue_depth", self.waiting, pool=self.name)
+        t0 = time.perf_counter()
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+            metrics.set_gauge("llm_queue_depth", self.waiting, pool=self.name)
+        metrics.observe("llm_queue_wait_ms", (time.perf_counter() - t0) * 1000, pool=self.name)
+        self.in_flight += 1
+        metrics.set_gauge("llm_in_flight", self.in_flight, pool=self.name)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            metrics.set_gauge("llm_in_flight", self.in_flight, pool=self.name)
+            self._sem.release()
+
+
+_bulkheads: Dict[str, Bulkhead] = {}
+
+
+def get_bulkhead(model: str, pool: Optional[str] = None) -> Bulkhead:
+    name = pool_name(model, pool)
+    bh = _bulkheads.get(name)
+    if bh is None:
+        limit = LIMITS.get(name) or LIMITS.get(pool_name(model)) or DEFAULT_LIMIT
+        bh = _bulkheads[name] = Bulkhead(name, limit)
+    return bh
+
+
+@asynccontextmanager
+async def limit(model: str, pool: Optional[str] = None):
+    """`async with bulkhead.limit(model):` の形で使う。"""
+    await llm_scheduler.aacquire(model)
+    async with get_bulkhead(model, pool).acquire():
+        yield
@@ -0,0 +1,136 @@
+"""定型質問（「本書の背景を説明して」等）の事前計算済み回答。
+
+- 質問セットは CANNED_QUESTIONS（"key=質問|key=質問"）で差し替え可能
+- 回答は preprocessing/11_precompute_canned_answers.py で作品ごとに生成し canned_answers に保存
+- /v1/qa は文脈・履歴なしの定型質問に保存済み回答を即時返し、古ければ裏で再生成する
+"""
+import asyncio
+import os
+import unicodedata
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from ..db.session import SessionLocal
+from ..models.models import CannedAnswer
+from . import llm, llm_scheduler, metrics
+
+DEFAULT_QUESTIONS: Dict[str, str] = {
+    "background": "本書の背景を説明して",
+    "characters": "登場人物を解説して",
+}
+
+# この日数を過ぎた回答は返しつつ裏で再生成する
+MAX_AGE_DAYS = float(os.getenv("CANNED_QA_MAX_AGE_DAYS", "30"))
+
+
+def _load_questions() -> Dict[str, str]:
+    raw = os.getenv("CANNED_QUESTIONS")
+    if not raw:
+        return dict(DEFAULT_QUESTIONS)
+    out: Dict[str, str] = {}
+    for item in raw.split("|"):
+        key, _, question = item.partition("=")
+        if key.strip() and question.strip():
+            out[key.strip()] = question.strip()
+    return out or dict(DEFAULT_QUESTIONS)
+
+
+QUESTIONS = _load_questions()
+
+
+def normalize(question: str) -> str:
+    """全角/半角・空白・末尾の句読点や「。」「？」の揺れを吸収する。"""
+    s = unicodedata.normalize("NFKC", question or "")
+    s = "".join(s.split())
+    return s.rstrip("。.!?！？")
+
+
+_BY_TEXT = {normalize(q): k for k, q in QUESTIONS.items()}
+
+
+def match(
+    question: str, context: Optional[str] = None, history: Optional[list] = None
+) -> Optional[str]:
+    """文脈・履歴なしの定型質問なら question_key を返す。"""
+    if (context or "").strip() or history:
+        return None
+    return _BY_TEXT.get(normalize(question))
+
+
+def _is_current(row: CannedAnswer) -> bool:
+    return row.model == llm.LLM_MODEL and row.prompt_version == llm.QA_PROMPT_VERSION
+
+
+def _is_stale(row: CannedAnswer) -> bool:
+    return not _is_current(row) or (
+        datetime.utcnow() - row.created_at > timedelta(days=MAX_AGE_DAYS)
+    )
+
+
+def get(db, book_id: int, key: str) -> Optional[Tuple[CannedAnswer, bool]]:
+    """保存済み回答と、再生成が必要かどうかを返す。"""
+    try:
+        row = db.get(CannedAnswer, (book_id, key))
+    except Exception:
+        return None
+    if not row or not row.answer:
+        return None
+    # プロンプト版が違う回答も、再生成までの間は返す（モデル違いも同様）
+    return row, _is_stale(row)
+
+
+def save(db, book_id: int, key: str, answer: str, model: str = llm.LLM_MODEL) -> None:
+    # フォールバックした（LLM_MODEL 以外の）回答も保存するが、古い扱いになり次回に再生成される
+    db.merge(
+        CannedAnswer(
+            book_id=book_id,
+            question_key=key,
+            question=QUESTIONS[key],
+            answer=answer,
+            model=model,
+            prompt_version=llm.QA_PROMPT_VERSION,
+            created_at=datetime.utcnow(),
+        )
+    )
+    db.commit()
+
+
+def _save_new_session(book_id: int, key: str, answer: str, model: str) -> None:
+    s = SessionLocal()
+    try:
+        save(s, book_id, key, answer, model)
+    finally:
+        s.close()
+
+
+_refreshing: Set[Tuple[int, str]] = set()
+_tasks: Set[asyncio.Task] = set()
+
+
+def schedule_refresh(book_id: int, book_title: str, key: str) -> None:
+    """古い回答をバックグラウンドで再生成する（同一作品×質問は1本だけ）。"""
+    ident = (book_id, key)
+    if ident in _refreshing:
+        return
+    _refreshing.add(ident)
+
+    async def run():
+        try:
+            # 裏での再生成は利用者を待たせないよう batch で流す
+            with llm_scheduler.context(priority=llm_scheduler.BATCH, user="canned_refresh"):
+                text, _, model = await llm.aanswer_question(book_title, QUESTIONS[key])
+            if text:
+                await run_in_threadpool(_save_new_session, book_id, key, text, model)
+                metrics.inc("canned_qa_refresh_total", result="ok")
+        except Exception as e:
+            metrics.inc("canned_qa_refresh_total", result="error")
+            print(f"定型回答の再生成に失敗しました: {e}")
+        finally:
+            _refreshing.discard(ident)
+
+    task = asyncio.create_task(run())
+    # タスクへの参照を保持して GC で消えないようにする
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
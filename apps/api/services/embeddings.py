@@ -1,6 +1,8 @@
 import os
 from typing import Optional, List, Any
 
+from . import bulkhead, llm_telemetry
+
 EMBED_MODEL = os.getenv("EMBED_MODEL", "gemini-embedding-001")
 PROJECT_ID = os.getenv("PROJECT_ID")
 VERTEX_LOCATION = os.getenv("VERTEX_LOCATION", "asia-northeast1")
@@ -19,19 +21,36 @@ def get_client():
     return _client
 
 
+def _extract_vector(resp) -> Optional[List[float]]:
+    # google-genai returns .embeddings[0].values or .data depending on version; try common fields
+    if hasattr(resp, "embeddings") and resp.embeddings:
+        vec = resp.embeddings[0].values
+    elif hasattr(resp, "data") and resp.data:
+        vec = resp.data[0]["embedding"]["values"]
+    else:
+        return None
+    return list(vec)
+
+
 def embed_text(text: str) -> Optional[List[float]]:
     """Return embedding vector for text, or None on failure."""
     try:
-        resp = get_client().models.embed_content(
-            model=EMBED_MODEL, contents=[text], config={"output_dimensionality": 768}
-        )
-        # google-genai returns .embeddings[0].values or .data depending on version; try common fields
-        if hasattr(resp, "embeddings") and resp.embeddings:
-            vec = resp.embeddings[0].values
-        elif hasattr(resp, "data") and resp.data:
-            vec = resp.data[0]["embedding"]["values"]
-        else:
-            return None
-        return list(vec)
+        with llm_telemetry.track(EMBED_MODEL, "embed"):
+            resp = get_client().models.embed_content(
+                model=EMBED_MODEL, contents=[text], config={"output_dimensionality": 768}
+            )
+        return _extract_vector(resp)
+    except Exception:
+        return None
+
+
+async def aembed_text(text: str) -> Optional[List[float]]:
+    """Async version of embed_text (API 用)."""
+    try:
+        async with bulkhead.limit(EMBED_MODEL), llm_telemetry.atrack(EMBED_MODEL, "embed"):
+            resp = await get_client().aio.models.embed_content(
+                model=EMBED_MODEL, contents=[text], config={"output_dimensionality": 768}
+            )
+        return _extract_vector(resp)
     except Exception:
         return None
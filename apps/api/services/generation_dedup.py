@@ -0,0 +1,133 @@
+"""同じ入力の生成結果（画像・動画）の使い回し（GENERATION_DEDUP=1 のときだけ有効）。
+
+- キーは (種類, 作品, 正規化した本文のハッシュ, テンプレートの版, 生成パラメータ)。パラメータには
+  登場人物一覧の版も含めるので、参照画像が変わった作品の古いアセットは使われない
+- 直近 DEDUP_TTL_S 秒以内に成功したアセットがあれば生成せず、依頼したユーザーのギャラリーに同じアセットを登録する
+  （既に自分のギャラリーにあればその行を返す）
+- 1つのアセットを共有するユーザーは DEDUP_MAX_SHARES 人まで。超えたら新しく生成し、以降はそちらを使い回す
+- リクエストに force_new=true を付けると使い回さずに生成する（結果は次の使い回し候補になる）
+- メトリクス: generation_dedup_total{job_type,result=hit|owned|full|miss}
+"""
+import hashlib
+import json
+import os
+from typing import Optional
+
+from sqlalchemy import text
+
+from ..models.models import Gallery
+from . import metrics, scene_cache
+
+ENABLED = os.getenv("GENERATION_DEDUP", "0") == "1"
+DEDUP_TTL_S = float(os.getenv("GENERATION_DEDUP_TTL_S", str(7 * 24 * 3600)))
+DEDUP_MAX_SHARES = int(os.getenv("GENERATION_DEDUP_MAX_SHARES", "20"))
+
+
+def dedup_key(job_type: str, book_id: int, source: str, template_version: str, params: dict) -> str:
+    raw = json.dumps(
+        {
+            "type": job_type,
+            "book": book_id,
+            "text": scene_cache.text_hash(source),
+            "template": template_version,
+            "params": params,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def reuse(
+    db,
+    key: str,
+    user_id: str,
+    job_type: str,
+    job_id: Optional[int] = None,
+    paragraph_ids: Optional[list] = None,
+) -> Optional[dict]:
+    """使い回せるアセットがあればユーザーのギャラリーに登録して結果を返す（無ければ None）。
+
+    作品は generation_assets から、段落は依頼したユーザーの paragraph_ids から取る
+    （元のギャラリー行が削除されていても、リーダーの作品ごとの一覧に出て段落に結び付く）。
+    """
+    row = db.execute(
+        text(
+            """
+            SELECT asset_url, result, gallery_id, book_id FROM generation_assets
+            WHERE dedup_key = :key AND created_at > now() - :ttl * interval '1 second'
+            """
+        ),
+        {"key": key, "ttl": DEDUP_TTL_S},
+    ).mappings().first()
+    if not row:
+        metrics.inc("generation_dedup_total", job_type=job_type, result="miss")
+        return None
+    result = dict(row["result"] or {})
+    owned = db.execute(
+        text(
+            "SELECT id FROM gallery WHERE user_id = :uid AND asset_url = :url ORDER BY id DESC LIMIT 1"
+        ),
+        {"uid": user_id, "url": row["asset_url"]},
+    ).scalar()
+    if owned:
+        metrics.inc("generation_dedup_total", job_type=job_type, result="owned")
+        return {**result, "gallery_id": owned, "reused": True}
+    # 共有数の上限チェックと加算を1文で行う（同時に来ても上限を超えない）
+    claimed = db.execute(
+        text(
+            """
+            UPDATE generation_assets SET shared_count = shared_count + 1
+            WHERE dedup_key = :key AND asset_url = :url AND shared_count < :max
+            RETURNING shared_count
+            """
+        ),
+        {"key": key, "url": row["asset_url"], "max": DEDUP_MAX_SHARES},
+    ).first()
+    if not claimed:
+        db.rollback()
+        metrics.inc("generation_dedup_total", job_type=job_type, result="full")
+        return None
+    origin = db.get(Gallery, row["gallery_id"]) if row["gallery_id"] else None
+    meta = dict(origin.meta or {}) if origin else {}
+    meta.update({"paragraph_ids": paragraph_ids, "job_id": job_id, "reused_from": row["gallery_id"]})
+    g = Gallery(
+        user_id=user_id,
+        book_id=row["book_id"],
+        asset_url=row["asset_url"],
+        thumb_url=origin.thumb_url if origin else None,
+        type=job_type,
+        prompt=origin.prompt if origin else None,
+        meta=meta,
+    )
+    db.add(g)
+    db.commit()
+    metrics.inc("generation_dedup_total", job_type=job_type, result="hit")
+    return {**result, "gallery_id": g.id, "reused": True}
+
+
+def record(db, key: str, job_type: str, book_id: int, result: dict, gallery_id: Optional[int]) -> None:
+    """生成に成功したアセットを使い回し候補にする（同じキーの古いアセットは置き換える）。"""
+    if not gallery_id or not result.get("asset_url"):
+        return
+    stored = {k: v for k, v in result.items() if k not in ("gallery_id", "reused")}
+    db.execute(
+        text(
+            """
+            INSERT INTO generation_assets (dedup_key, job_type, book_id, asset_url, result, gallery_id)
+            VALUES (:key, :type, :bid, :url, CAST(:result AS JSONB), :gid)
+            ON CONFLICT (dedup_key) DO UPDATE SET
+              asset_url = EXCLUDED.asset_url, result = EXCLUDED.result,
+              gallery_id = EXCLUDED.gallery_id, shared_count = 1, created_at = now()
+            """
+        ),
+        {
+            "key": key,
+            "type": job_type,
+            "bid": book_id,
+            "url": result["asset_url"],
+            "result": json.dumps(stored, ensure_ascii=False),
+            "gid": gallery_id,
+        },
+    )
+    db.commit()
@@ -0,0 +1,320 @@
+"""generation_jobs テーブルを使った画像・動画生成の永続ジョブキュー。
+
+- API は行を queued で積んで job_id を即返し、クライアントは /v1/generate/{job_id}/status をポーリングする
+- ワーカーは `FOR UPDATE SKIP LOCKED` で1件ずつ取得するため、複数インスタンスで並べても同じジョブを取り合わない
+  （API プロセス内で GENERATION_WORKERS 本、または `python -m apps.api.worker` で別プロセスとして起動）
+- 実行中は heartbeat_at を定期更新。更新が STALE_S 秒途絶えたジョブ（落ちたワーカー）は再取得される。
+  取り直されたと分かった元のワーカーは処理を打ち切り、結果も書かない（同じ生成を2回払わない）
+- 取り直しは落ちた・停止したワーカーの分だけ（MAX_ATTEMPTS 回まで）。処理中の失敗は各段で再試行済みなので
+  そのまま failed にして error に理由を残す（ジョブ単位でも再試行すると生成回数が掛け算になるため）
+- メトリクス: generation_jobs_total{job_type,status}（lost は取り直されて打ち切った分）, generation_job_ms{job_type},
+  generation_queue_wait_ms{job_type}, generation_jobs_recovered_total
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+
+from ..db.session import engine
+from . import llm_scheduler, metrics, quotas
+
+WORKERS = int(os.getenv("GENERATION_WORKERS", "2"))
+POLL_INTERVAL_S = float(os.getenv("GENERATION_POLL_INTERVAL_S", "1.0"))
+HEARTBEAT_S = float(os.getenv("GENERATION_HEARTBEAT_S", "15"))
+STALE_S = float(os.getenv("GENERATION_STALE_S", "120"))
+MAX_ATTEMPTS = int(os.getenv("GENERATION_MAX_ATTEMPTS", "2"))
+# 取り残されたジョブの回収間隔
+SWEEP_INTERVAL_S = 30.0
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+_handlers: Dict[str, Handler] = {}
+
+
+def register(job_type: str, handler: Handler) -> None:
+    """job_type のジョブを処理する関数を登録する（routers/v1/generate.py が登録）。"""
+    _handlers[job_type] = handler
+
+
+def enqueue(
+    db, user_id: str, job_type: str, book_id: Optional[int], prompt: str, payload: dict
+) -> int:
+    row = db.execute(
+        text(
+            """
+            INSERT INTO generation_jobs (user_id, job_type, status, book_id, prompt, payload)
+            VALUES (:uid, :type, 'queued', :bid, :prompt, CAST(:payload AS JSONB))
+            RETURNING id
+            """
+        ),
+        {
+            "uid": user_id,
+            "type": job_type,
+            "bid": book_id,
+            "prompt": prompt,
+            "payload": json.dumps(payload, ensure_ascii=False),
+        },
+    ).first()
+    db.commit()
+    metrics.inc("generation_jobs_total", job_type=job_type, status="queued")
+    return int(row[0])
+
+
+def record_succeeded(
+    db, user_id: str, job_type: str, book_id: Optional[int], prompt: str, payload: dict, result: dict
+) -> int:
+    """実行せずに結果が決まったジョブ（生成結果の使い回し）を succeeded で記録する。"""
+    row = db.execute(
+        text(
+            """
+            INSERT INTO generation_jobs (user_id, job_type, status, book_id, prompt, payload, result)
+            VALUES (:uid, :type, 'succeeded', :bid, :prompt, CAST(:payload AS JSONB),
+                    CAST(:result AS JSONB))
+            RETURNING id
+            """
+        ),
+        {
+            "uid": user_id,
+            "type": job_type,
+            "bid": book_id,
+            "prompt": prompt,
+            "payload": json.dumps(payload, ensure_ascii=False),
+            "result": json.dumps(result, ensure_ascii=False),
+        },
+    ).first()
+    db.commit()
+    metrics.inc("generation_jobs_total", job_type=job_type, status="succeeded")
+    return int(row[0])
+
+
+# 古い順に1件。心拍が途絶えた running も取り直す（試行回数の上限内のみ）
+_CLAIM = text(
+    """
+    UPDATE generation_jobs j
+    SET status = 'running', attempts = j.attempts + 1, heartbeat_at = now(),
+        worker_id = :worker
+    WHERE j.id = (
+        SELECT id FROM generation_jobs
+        WHERE job_type = ANY(:types)
+          AND (status = 'queued'
+               OR (status = 'running' AND heartbeat_at < now() - :stale * interval '1 second'
+                   AND attempts < :max_attempts))
+        ORDER BY created_at
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING j.id, j.user_id, j.job_type, j.book_id, j.prompt, j.payload, j.attempts,
+              EXTRACT(EPOCH FROM (now() - j.created_at)) AS waited_s
+    """
+)
+
+
+def claim(worker_id: str, job_types: List[str]) -> Optional[Dict[str, Any]]:
+    with engine.begin() as conn:
+        row = conn.execute(
+            _CLAIM,
+            {
+                "worker": worker_id,
+                "types": job_types,
+                "stale": STALE_S,
+                "max_attempts": MAX_ATTEMPTS,
+            },
+        ).mappings().first()
+    if not row:
+        return None
+    job = dict(row)
+    if job["attempts"] > 1:
+        metrics.inc("generation_jobs_recovered_total")
+    metrics.observe(
+        "generation_queue_wait_ms", float(job.pop("waited_s") or 0) * 1000, job_type=job["job_type"]
+    )
+    return job
+
+
+def sweep() -> int:
+    """心拍が途絶え、試行回数も使い切った running を failed にし、1日の利用回数を戻す。"""
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text(
+                """
+                UPDATE generation_jobs
+                SET status = 'failed', error = 'worker lost (heartbeat timeout)'
+                WHERE status = 'running'
+                  AND heartbeat_at < now() - :stale * interval '1 second'
+                  AND attempts >= :max_attempts
+                RETURNING user_id, job_type, payload->>'quota_day' AS quota_day
+                """
+            ),
+            {"stale": STALE_S, "max_attempts": MAX_ATTEMPTS},
+        ).all()
+    for user_id, job_type, quota_day in rows:
+        try:
+            with engine.connect() as conn:
+                quotas.refund(conn, user_id, job_type, quota_day)
+        except Exception as e:
+            print(f"利用回数の払い戻しに失敗しました: {e}")
+    return len(rows)
+
+
+def heartbeat(job_id: int, worker_id: str) -> bool:
+    """False なら別のワーカーに取り直されている。"""
+    with engine.begin() as conn:
+        res = conn.execute(
+            text(
+                "UPDATE generation_jobs SET heartbeat_at = now() "
+                "WHERE id = :id AND worker_id = :worker AND status = 'running'"
+            ),
+            {"id": job_id, "worker": worker_id},
+        )
+    return bool(res.rowcount)
+
+
+def _finish(job_id: int, worker_id: str, status: str, result=None, error=None) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                UPDATE generation_jobs
+                SET status = :status, result = CAST(:result AS JSONB), error = :error,
+                    heartbeat_at = NULL
+                WHERE id = :id AND worker_id = :worker
+                """
+            ),
+            {
+                "id": job_id,
+                "worker": worker_id,
+                "status": status,
+                "result": json.dumps(result, ensure_ascii=False) if result is not None else None,
+                "error": error,
+            },
+        )
+
+
+def _error_message(e: BaseException) -> str:
+    detail = getattr(e, "detail", None)
+    return str(detail or e or type(e).__name__)[:500]
+
+
+class Worker:
+    """concurrency 本のループがそれぞれジョブを取得して実行する。"""
+
+    def __init__(self, concurrency: int = WORKERS, worker_id: Optional[str] = None):
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._stopping = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._stopping.clear()
+        self._tasks = [asyncio.create_task(self._loop(i)) for i in range(self.concurrency)]
+        print(f"generation worker {self.worker_id}: {self.concurrency} slots {sorted(_handlers)}")
+
+    async def stop(self) -> None:
+        # 実行中のジョブはキャンセルして queued に戻す（他のワーカーが拾う）
+        self._stopping.set()
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _idle(self, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _loop(self, slot: int) -> None:
+        last_sweep = 0.0
+        while not self._stopping.is_set():
+            try:
+                if slot == 0 and time.monotonic() - last_sweep > SWEEP_INTERVAL_S:
+                    last_sweep = time.monotonic()
+                    n = await run_in_threadpool(sweep)
+                    if n:
+                        metrics.inc("generation_jobs_total", n, job_type="any", status="failed")
+                job = await run_in_threadpool(claim, self.worker_id, sorted(_handlers))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"ジョブの取得に失敗しました: {e}")
+                job = None
+            if job is None:
+                # 複数ワーカーのポーリングが揃わないよう少しずらす
+                await self._idle(POLL_INTERVAL_S * (0.5 + random.random()))
+                continue
+            await self._run(job)
+
+    async def _heartbeat(self, job_id: int) -> None:
+        """ジョブを持っている間は返らない。返ったら別のワーカーに取り直されている。"""
+        while True:
+            await asyncio.sleep(HEARTBEAT_S)
+            try:
+                if not await run_in_threadpool(heartbeat, job_id, self.worker_id):
+                    print(f"job {job_id}: 他のワーカーに取り直されました")
+                    return
+            except Exception as e:
+                print(f"job {job_id}: heartbeat に失敗しました: {e}")
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        job_id, job_type = job["id"], job["job_type"]
+        start = time.time()
+        # 生成はユーザーの操作なので interactive。ユーザーごとに公平に並べる（タスクに引き継がれる）
+        with llm_scheduler.context(
+            priority=llm_scheduler.INTERACTIVE,
+            user=llm_scheduler.fairness_key(job["user_id"]),
+        ):
+            task = asyncio.create_task(_handlers[job_type](job))
+        hb = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            done, _ = await asyncio.wait({task, hb}, return_when=asyncio.FIRST_COMPLETED)
+            if task not in done:
+                # 取り直したワーカーが続きを行うので、ここでは打ち切って何も書かない
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                metrics.inc("generation_jobs_total", job_type=job_type, status="lost")
+                return
+            result = task.result()
+        except asyncio.CancelledError:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await run_in_threadpool(
+                _finish, job_id, self.worker_id, "queued", None, "worker stopped"
+            )
+            raise
+        except Exception as e:
+            print(f"job {job_id} ({job_type}) に失敗しました: {e}")
+            await run_in_threadpool(
+                _finish, job_id, self.worker_id, "failed", None, _error_message(e)
+            )
+            metrics.inc("generation_jobs_total", job_type=job_type, status="failed")
+        else:
+            await run_in_threadpool(_finish, job_id, self.worker_id, "succeeded", result)
+            metrics.inc("generation_jobs_total", job_type=job_type, status="succeeded")
+        finally:
+            hb.cancel()
+            metrics.observe("generation_job_ms", (time.time() - start) * 1000, job_type=job_type)
+
+
+worker: Optional[Worker] = None
+
+
+def start_worker(concurrency: int = WORKERS) -> Optional[Worker]:
+    global worker
+    if concurrency <= 0 or not _handlers:
+        return None
+    worker = Worker(concurrency)
+    worker.start()
+    return worker
+
+
+async def stop_worker() -> None:
+    if worker is not None:
+        await worker.stop()
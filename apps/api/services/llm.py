@@ -1,12 +1,25 @@
 import os
 import time
-from typing import Optional, Any, Iterable, List, Dict
-from google import genai
+import asyncio
+from typing import Optional, Any, AsyncIterator, List, Dict
+
+from . import bulkhead, llm_scheduler, llm_telemetry, model_router, resilience
+from .singleflight import SingleFlight, make_key
 
 LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.5-pro")
+TRANSLATE_MODEL = os.getenv("TRANSLATE_MODEL", "gemini-2.5-flash-lite")
+# 翻訳プロンプトを変えたら上げる（paragraph_translations のキャッシュ無効化に使用）
+TRANSLATE_PROMPT_VERSION = "v1"
+# Q&A のシステムプロンプトを変えたら上げる（canned_answers の無効化に使用）
+QA_PROMPT_VERSION = "v1"
+# 翻訳1回あたりの入力上限（要件: 2,000字以内）。超える段落は文境界で分割して並列に訳す
+TRANSLATE_CHUNK_CHARS = int(os.getenv("TRANSLATE_CHUNK_CHARS", "1000"))
 PROJECT_ID = os.getenv("PROJECT_ID")
 VERTEX_LOCATION = os.getenv("VERTEX_LOCATION", "asia-northeast1")
 
+# 同一プロンプト×モデルの同時リクエストを1回の上流呼び出しにまとめる
+_flight = SingleFlight("llm")
+
 _client: Optional[Any] = None
 _client_banana: Optional[Any] = None
 
@@ -14,27 +27,36 @@ _client_banana: Optional[Any] = None
 def get_client():
     global _client
     if _client is None:
-        _client = genai.Client(
-            vertexai=True, project=PROJECT_ID, location=VERTEX_LOCATION
-        )
+        # google-genai は読み込みが重いので、最初に使うとき（またはウォームアップ）まで import しない
+        from google import genai
+
+        base_url = os.getenv("GENAI_BASE_URL")
+        if base_url:
+            # 検証用: ローカルの代替モデルサーバー（experiment/04_model_router）に向ける
+            _client = genai.Client(
+                api_key=os.getenv("GOOGLE_API_KEY", "local"),
+                http_options={"base_url": base_url},
+            )
+        else:
+            _client = genai.Client(
+                vertexai=True, project=PROJECT_ID, location=VERTEX_LOCATION
+            )
     return _client
 
 
 def get_client_for_nano_banana():
     global _client_banana
     if _client_banana is None:
+        from google import genai
+
         _client_banana = genai.Client(
             vertexai=True, project=PROJECT_ID, location="global"
         )
     return _client_banana
 
 
-def translate_paragraph(book_title: str, paragraph: str) -> tuple[str, int]:
-    """
-    Translate a paragraph into modern Japanese. Returns (translation, latency_ms).
-    """
-    start = time.time()
-    prompt = (
+def build_translate_prompt(book_title: str, paragraph: str) -> str:
+    return (
         "あなたは古典作品を現代日本語に訳す編集者です。\n"
         "- 高校教育レベルの、平易で自然な日本語にしてください。\n"
         f"作品名: {book_title}\n"
@@ -43,12 +65,184 @@ def translate_paragraph(book_title: str, paragraph: str) -> tuple[str, int]:
         "--- 出力 ---\n"
         "現代語訳のみを出力してください。"
     )
-    resp = get_client().models.generate_content(
-        model="gemini-2.5-flash-lite", contents=[prompt]
-    )
-    text = (resp.text or "").strip()
+
+
+_SENTENCE_ENDS = "。．！？!?\n"
+_CLOSING = "」』）)"
+_SOFT_BREAKS = "、，,；;："
+
+
+def split_for_translation(paragraph: str, max_chars: Optional[int] = None) -> List[str]:
+    """長い段落を文境界（。！？ 等、閉じ括弧は前の文に含める）で max_chars 以下の塊に分割する。
+    1文が max_chars を超える場合は読点、無ければ文字数で切る。結合すると元の文字列に戻る。
+    """
+    max_chars = max_chars or TRANSLATE_CHUNK_CHARS
+    if len(paragraph) <= max_chars:
+        return [paragraph]
+    sentences: List[str] = []
+    start = 0
+    i = 0
+    n = len(paragraph)
+    while i < n:
+        if paragraph[i] in _SENTENCE_ENDS:
+            j = i + 1
+            while j < n and paragraph[j] in _CLOSING:
+                j += 1
+            sentences.append(paragraph[start:j])
+            start = i = j
+            continue
+        i += 1
+    if start < n:
+        sentences.append(paragraph[start:])
+
+    pieces: List[str] = []
+    for s in sentences:
+        while len(s) > max_chars:
+            window = s[:max_chars]
+            cut = max(window.rfind(ch) for ch in _SOFT_BREAKS)
+            cut = cut + 1 if cut > 0 else max_chars
+            pieces.append(s[:cut])
+            s = s[cut:]
+        if s:
+            pieces.append(s)
+
+    chunks: List[str] = []
+    buf = ""
+    for p in pieces:
+        if buf and len(buf) + len(p) > max_chars:
+            chunks.append(buf)
+            buf = ""
+        buf += p
+    if buf:
+        chunks.append(buf)
+    return chunks
+
+
+def _join_translations(chunks: List[str], translations: List[str]) -> str:
+    # 原文の改行位置で分割した場合は訳文でも改行を保つ
+    out = []
+    for src, tr in zip(chunks, translations):
+        out.append(tr + ("\n" if src.endswith("\n") else ""))
+    return "".join(out).strip()
+
+
+def _translate_chunk(book_title: str, chunk: str) -> tuple[str, str]:
+    """Returns (translation, 使ったモデル)。失敗・サーキット開放時はルーターが次のモデルに切り替える。"""
+    prompt = build_translate_prompt(book_title, chunk.strip())
+
+    def call(model: str) -> str:
+        def once() -> str:
+            with llm_scheduler.slot(model), llm_telemetry.track(model, "translate") as t:
+                resp = get_client().models.generate_content(model=model, contents=[prompt])
+                t.record(resp)
+            return (resp.text or "").strip()
+
+        return _flight.do(make_key(model, prompt), once)
+
+    return model_router.run("translate", call)
+
+
+async def _atranslate_chunk(book_title: str, chunk: str) -> tuple[str, int, str]:
+    """Returns (translation, latency_ms, 使ったモデル)。遅い・失敗するモデルはルーターが切り替える。"""
+    start = time.time()
+    prompt = build_translate_prompt(book_title, chunk.strip())
+
+    async def call(model: str) -> str:
+        async def once() -> str:
+            async with bulkhead.limit(model), llm_telemetry.atrack(model, "translate") as t:
+                resp = await get_client().aio.models.generate_content(
+                    model=model, contents=[prompt]
+                )
+                t.record(resp)
+            return (resp.text or "").strip()
+
+        # 翻訳は安く冪等なので、直近 p95 を過ぎても返らなければ同じ呼び出しをもう1本投げる
+        return await _flight.ado(
+            make_key(model, prompt), lambda: resilience.ahedged(f"translate:{model}", once)
+        )
+
+    text, model = await model_router.arun("translate", call)
+    return text, int((time.time() - start) * 1000), model
+
+
+def _models_label(models: List[str]) -> str:
+    # 塊ごとに別モデルへフォールバックした場合は列挙する
+    return ",".join(dict.fromkeys(models))
+
+
+def translate_paragraph(book_title: str, paragraph: str) -> tuple[str, int, str]:
+    """
+    Translate a paragraph into modern Japanese. Returns (translation, latency_ms, 使ったモデル).
+    長い段落は文境界で分割して順に訳す（バッチ用。API は atranslate_paragraph で並列化）。
+    """
+    start = time.time()
+    chunks = split_for_translation(paragraph)
+    results = [_translate_chunk(book_title, c) for c in chunks]
+    text = _join_translations(chunks, [r[0] for r in results])
+    latency_ms = int((time.time() - start) * 1000)
+    return text, latency_ms, _models_label([r[1] for r in results])
+
+
+async def atranslate_paragraph(
+    book_title: str, paragraph: str
+) -> tuple[str, int, List[int], str]:
+    """Async version of translate_paragraph (API 用、バルクヘッドで同時実行数を制限).
+    長い段落は分割した塊を並列に訳して順に結合する。
+    Returns (translation, latency_ms, 塊ごとのレイテンシ, 使ったモデル)。塊ごとの合計が逐次実行時の目安。
+    """
+    start = time.time()
+    chunks = split_for_translation(paragraph)
+    results = await asyncio.gather(*[_atranslate_chunk(book_title, c) for c in chunks])
+    text = _join_translations(chunks, [r[0] for r in results])
     latency_ms = int((time.time() - start) * 1000)
-    return text, latency_ms
+    return text, latency_ms, [r[1] for r in results], _models_label([r[2] for r in results])
+
+
+async def _astream_chunk(book_title: str, chunk: str, model: str) -> AsyncIterator[str]:
+    prompt = build_translate_prompt(book_title, chunk.strip())
+    async with bulkhead.limit(model), llm_telemetry.atrack(model, "translate_stream") as t:
+        stream = await get_client().aio.models.generate_content_stream(
+            model=model, contents=[prompt]
+        )
+        try:
+            async for part in stream:
+                t.record(part)
+                text = getattr(part, "text", None)
+                if text:
+                    yield text
+        finally:
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+
+async def stream_translate_paragraph(
+    book_title: str, paragraph: str, info: Optional[dict] = None
+) -> AsyncIterator[str]:
+    """Yield translation text chunks as the model generates them.
+    長い段落は先頭の塊をトークン単位で流しつつ、残りの塊を並列に訳して出来た順ではなく原文順に流す。
+    使ったモデルは終了時に info["model"] に入れる。
+    """
+    chunks = split_for_translation(paragraph)
+    rest = [asyncio.create_task(_atranslate_chunk(book_title, c)) for c in chunks[1:]]
+    first: dict = {}
+    try:
+        async for text in model_router.astream(
+            "translate", lambda m: _astream_chunk(book_title, chunks[0], m), info=first
+        ):
+            yield text
+        models = [first.get("model", TRANSLATE_MODEL)]
+        for src, task in zip(chunks, rest):
+            text, _, model = await task
+            models.append(model)
+            # 前の塊との区切り（原文が改行で終わっていれば改行）
+            yield ("\n" if src.endswith("\n") else "") + text
+        if info is not None:
+            info["model"] = _models_label(models)
+    finally:
+        for task in rest:
+            if not task.done():
+                task.cancel()
 
 
 def _trim(s: str, max_chars: int) -> str:
@@ -92,61 +286,132 @@ def _build_contents(
     return contents
 
 
+def _qa_config(book_title: str, context: Optional[str]) -> dict:
+    from google.genai import types
+
+    grounding_tool = types.Tool(google_search=types.GoogleSearch())
+    return {
+        "tools": [grounding_tool],
+        "system_instruction": _build_system_instruction(book_title, context),
+    }
+
+
+def _qa_key(
+    book_title: str,
+    question: str,
+    context: Optional[str],
+    history: Optional[List[Dict[str, str]]],
+    model: str = LLM_MODEL,
+) -> str:
+    return make_key(
+        model,
+        _build_system_instruction(book_title, context),
+        _build_contents(history, question),
+    )
+
+
 def answer_question(
     book_title: str,
     question: str,
     context: Optional[str] = None,
     history: Optional[List[Dict[str, str]]] = None,
-) -> tuple[str, int]:
-    """Answer a user question with optional context and chat history using role-based messages."""
+) -> tuple[str, int, str]:
+    """Answer a user question with optional context and chat history using role-based messages.
+    失敗・サーキット開放時はルーターが pro → flash → flash-lite の順に切り替える（バッチ用）。
+    Returns (answer, latency_ms, 使ったモデル)。
+    """
     start = time.time()
-    system_instruction = _build_system_instruction(book_title, context)
-    contents = _build_contents(history, question)
-    grounding_tool = genai.types.Tool(google_search=genai.types.GoogleSearch())
-    resp = get_client().models.generate_content(
-        model=LLM_MODEL,
-        contents=contents,
-        config={
-            "tools": [grounding_tool],
-            "system_instruction": system_instruction,
-        },
-    )
-    text = (resp.text or "").strip()
+
+    def call(model: str) -> str:
+        def once() -> str:
+            with llm_scheduler.slot(model), llm_telemetry.track(model, "qa") as t:
+                resp = get_client().models.generate_content(
+                    model=model,
+                    contents=_build_contents(history, question),
+                    config=_qa_config(book_title, context),
+                )
+                t.record(resp)
+            return (resp.text or "").strip()
+
+        return _flight.do(_qa_key(book_title, question, context, history, model), once)
+
+    text, model = model_router.run("qa", call)
+    latency_ms = int((time.time() - start) * 1000)
+    return text, latency_ms, model
+
+
+async def aanswer_question(
+    book_title: str,
+    question: str,
+    context: Optional[str] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+    deadline_s: Optional[float] = None,
+) -> tuple[str, int, str]:
+    """Async version of answer_question (API 用).
+    遅い・失敗が続くモデルはルーターが pro → flash → flash-lite の順に切り替える。
+    Returns (answer, latency_ms, 使ったモデル)。
+    """
+    start = time.time()
+
+    async def call(model: str) -> str:
+        async def once() -> str:
+            async with bulkhead.limit(model), llm_telemetry.atrack(model, "qa") as t:
+                resp = await get_client().aio.models.generate_content(
+                    model=model,
+                    contents=_build_contents(history, question),
+                    config=_qa_config(book_title, context),
+                )
+                t.record(resp)
+            return (resp.text or "").strip()
+
+        return await _flight.ado(_qa_key(book_title, question, context, history, model), once)
+
+    text, model = await model_router.arun("qa", call, deadline_s=deadline_s)
     latency_ms = int((time.time() - start) * 1000)
-    return text, latency_ms
-
-
-# def stream_answer_question(
-#     book_title: str,
-#     question: str,
-#     context: Optional[str] = None,
-#     history: Optional[List[Dict[str, str]]] = None,
-# ) -> Iterable[str]:
-#     """Yield answer chunks (context/history-aware) using role-based messages. Fallback to non-streaming when unavailable."""
-#     # try:
-#     client = get_client()
-#     system_instruction = _build_system_instruction(book_title, context)
-#     contents = _build_contents(history, question)
-#     # google genai streaming API（利用可なら）
-#     grounding_tool = genai.types.Tool(google_search=genai.types.GoogleSearch())
-#     stream = client.models.generate_content_stream(
-#         model=LLM_MODEL,
-#         contents=contents,
-#         config={
-#             "tools": [grounding_tool],
-#             "system_instruction": system_instruction,
-#         },
-#     )
-#     for chunk in stream:
-#         try:
-#             yield chunk.text
-#         except Exception:
-#             continue
-#     return
-# except Exception:
-#     yield "[エラー] 回答の生成に失敗しました。"
-# # Fallback: non-streaming → 擬似チャンク
-# text, _ = answer_question(book_title, question, context=context, history=history)
-# step = 60
-# for i in range(0, len(text), step):
-#     yield text[i : i + step]
+    return text, latency_ms, model
+
+
+async def _astream_answer(
+    model: str,
+    book_title: str,
+    question: str,
+    context: Optional[str],
+    history: Optional[List[Dict[str, str]]],
+) -> AsyncIterator[str]:
+    async with bulkhead.limit(model), llm_telemetry.atrack(model, "qa_stream") as t:
+        stream = await get_client().aio.models.generate_content_stream(
+            model=model,
+            contents=_build_contents(history, question),
+            config=_qa_config(book_title, context),
+        )
+        try:
+            async for chunk in stream:
+                t.record(chunk)
+                text = getattr(chunk, "text", None)
+                if text:
+                    yield text
+        finally:
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+
+async def stream_answer_question(
+    book_title: str,
+    question: str,
+    context: Optional[str] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+    info: Optional[dict] = None,
+    deadline_s: Optional[float] = None,
+) -> AsyncIterator[str]:
+    """Yield answer chunks (context/history-aware) as they arrive.
+    呼び出し側がジェネレータを閉じる/キャンセルすると上流のストリームも閉じて生成を打ち切る。
+    最初のチャンクが届くまではルーターがモデルを切り替える。使ったモデルは info["model"] に入れる。
+    """
+    async for text in model_router.astream(
+        "qa",
+        lambda m: _astream_answer(m, book_title, question, context, history),
+        info=info,
+        deadline_s=deadline_s,
+    ):
+        yield text
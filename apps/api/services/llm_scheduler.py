@@ -0,0 +1,372 @@
+"""API と前処理スクリプトで共有する、優先度付きの LLM 呼び出しスケジューラ。
+
+- モデルごとにトークンバケット（LLM_RPM、毎分のリクエスト数）で呼び出しの開始を配る
+- 優先度クラスは interactive（API のリクエスト）と batch（前処理・裏での再生成）。トークンは
+  常に interactive の待ち行列から配り、batch は interactive の待ちが無いときだけ進む
+- 同じクラスの中はユーザー（fairness key）ごとの待ち行列を順番に回す（1人の連打で他人が待たされない）
+- 429 / RESOURCE_EXHAUSTED が報告されたモデルは batch だけを指数的に止める（interactive は止めない）。
+  報告は llm_telemetry の track/atrack が自動で行うので、別プロセスのバッチも自分の 429 で引く
+- 配分はプロセス内。batch しか流さないプロセス（configure(priority="batch")）は LLM_BATCH_RPM_SHARE
+  の割合だけを使い、API の分の余裕を残す
+- 同時実行数は bulkhead、開始のペースと順番はこのモジュールが受け持つ
+- メトリクス: llm_sched_wait_ms{model,priority}, llm_sched_queue_depth{model,priority},
+  llm_sched_batch_paused_total{model}, llm_sched_timeouts_total{model,priority}
+"""
+import asyncio
+import contextvars
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Deque, Dict, Optional
+
+from . import metrics, resilience
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+# 既定の毎分リクエスト数（Vertex のクォータに合わせて LLM_RPM="gemini-2.5-pro=120,..." で上書き）
+DEFAULT_RPM: Dict[str, float] = {
+    "gemini-2.5-pro": 300,
+    "gemini-2.5-flash": 600,
+    "gemini-2.5-flash-lite": 1200,
+    "gemini-embedding-001": 1500,
+    "gemini-2.5-flash-image-preview": 60,
+    "veo": 10,
+}
+# バケットの容量（何秒分まで溜められるか）
+BURST_S = float(os.getenv("LLM_BURST_S", "10"))
+BATCH_RPM_SHARE = float(os.getenv("LLM_BATCH_RPM_SHARE", "0.5"))
+# 429 を受けたときの batch の停止時間（倍々で最大まで）
+BATCH_BACKOFF_BASE_S = float(os.getenv("LLM_BATCH_BACKOFF_BASE_S", "5"))
+BATCH_BACKOFF_MAX_S = float(os.getenv("LLM_BATCH_BACKOFF_MAX_S", "300"))
+# 取りこぼしの保険（通常は付与時に起こされる）
+_MAX_SLEEP_S = 1.0
+
+
+def _load_rpm() -> Dict[str, float]:
+    rpm = dict(DEFAULT_RPM)
+    for item in os.getenv("LLM_RPM", "").split(","):
+        if "=" not in item:
+            continue
+        k, v = item.split("=", 1)
+        try:
+            rpm[k.strip()] = float(v)
+        except ValueError:
+            continue
+    return rpm
+
+
+RPM = _load_rpm()
+
+_priority: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "llm_sched_priority", default=None
+)
+_user: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "llm_sched_user", default=None
+)
+# contextvar が無いとき（スクリプトのスレッドなど）のプロセス既定
+_defaults = {"priority": INTERACTIVE, "user": "-", "rpm_share": 1.0}
+# configure(rpm=...) で明示したもの（割合を掛けない）
+_explicit_rpm: Dict[str, float] = {}
+
+
+def configure(priority: str = INTERACTIVE, user: str = "-", rpm: Optional[Dict[str, float]] = None) -> None:
+    """プロセス全体の既定を決める（前処理スクリプトは priority="batch", user=スクリプト名）。"""
+    _defaults["priority"] = priority
+    _defaults["user"] = user
+    _defaults["rpm_share"] = BATCH_RPM_SHARE if priority == BATCH else 1.0
+    _explicit_rpm.update({model_key(m): v for m, v in (rpm or {}).items()})
+    with _lock:
+        _schedulers.clear()
+
+
+@contextmanager
+def context(priority: Optional[str] = None, user: Optional[str] = None):
+    """この中の呼び出しの優先度・ユーザーを決める（asyncio のタスクにも引き継がれる）。"""
+    tokens = []
+    if priority is not None:
+        tokens.append((_priority, _priority.set(priority)))
+    if user is not None:
+        tokens.append((_user, _user.set(user)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def fairness_key(raw: str) -> str:
+    # 認証前のヘッダーからも作れるよう、中身は見ずにハッシュだけ使う
+    return hashlib.sha1(raw.encode("utf-8", "ignore")).hexdigest()[:12]
+
+
+def model_key(model: str) -> str:
+    # Veo はモデルIDが複数あるので1つにまとめる（bulkhead と同じ）
+    return "veo" if model.startswith("veo") else model
+
+
+class _Waiter:
+    __slots__ = ("priority", "user", "granted", "event", "loop", "future")
+
+    def __init__(self, priority: str, user: str, loop=None):
+        self.priority = priority
+        self.user = user
+        self.granted = False
+        self.loop = loop
+        self.future = loop.create_future() if loop else None
+        self.event = None if loop else threading.Event()
+
+    def wake(self) -> None:
+        self.granted = True
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+        else:
+            self.event.set()
+
+
+def _resolve(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(True)
+
+
+class ModelScheduler:
+    def __init__(self, model: str, rpm: Optional[float]):
+        self.model = model
+        self.rate = rpm / 60.0 if rpm else float("inf")
+        self.capacity = max(1.0, self.rate * BURST_S) if rpm else float("inf")
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        # クラス → ユーザー → 待ち行列（OrderedDict の順で1件ずつ回す）
+        self.queues: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {
+            p: OrderedDict() for p in PRIORITIES
+        }
+        self.batch_paused_until = 0.0
+        self.backoff_s = 0.0
+
+    # 以下はすべて self.lock の中で呼ぶ
+
+    def _refill(self, now: float) -> None:
+        if self.rate == float("inf"):
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def enqueue(self, w: _Waiter) -> None:
+        self.queues[w.priority].setdefault(w.user, deque()).append(w)
+        self._gauge(w.priority)
+
+    def remove(self, w: _Waiter) -> None:
+        users = self.queues[w.priority]
+        q = users.get(w.user)
+        if q is not None and w in q:
+            q.remove(w)
+            if not q:
+                del users[w.user]
+        self._gauge(w.priority)
+
+    def _gauge(self, priority: str) -> None:
+        depth = sum(len(q) for q in self.queues[priority].values())
+        metrics.set_gauge("llm_sched_queue_depth", depth, model=self.model, priority=priority)
+
+    def dispatch(self) -> Optional[float]:
+        """配れるだけ配り、次に配れるまでの秒数を返す（待ちが無ければ None）。"""
+        now = time.monotonic()
+        self._refill(now)
+        while True:
+            priority = None
+            for p in PRIORITIES:
+                if not self.queues[p]:
+                    continue
+                if p == BATCH and now < self.batch_paused_until:
+                    return self.batch_paused_until - now
+                priority = p
+                break
+            if priority is None:
+                return None
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            users = self.queues[priority]
+            user, q = next(iter(users.items()))
+            w = q.popleft()
+            # 次は別のユーザーの番（まだ待ちがあれば最後尾へ）
+            del users[user]
+            if q:
+                users[user] = q
+            self.tokens -= 1
+            self._gauge(priority)
+            w.wake()
+
+    def refund(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause_batch(self) -> float:
+        now = time.monotonic()
+        # 同じ波の 429 がまとめて返ってきても、止めている間は延ばさない
+        if now < self.batch_paused_until:
+            return self.batch_paused_until - now
+        self.backoff_s = min(
+            BATCH_BACKOFF_MAX_S, max(BATCH_BACKOFF_BASE_S, self.backoff_s * 2)
+        )
+        pause = self.backoff_s * random.uniform(0.8, 1.2)
+        self.batch_paused_until = now + pause
+        return pause
+
+
+_schedulers: Dict[str, ModelScheduler] = {}
+_lock = threading.Lock()
+
+
+def get(model: str) -> ModelScheduler:
+    key = model_key(model)
+    with _lock:
+        s = _schedulers.get(key)
+        if s is None:
+            rpm = _explicit_rpm.get(key)
+            if rpm is None and RPM.get(key):
+                rpm = RPM[key] * _defaults["rpm_share"]
+            s = _schedulers[key] = ModelScheduler(key, rpm)
+    return s
+
+
+def _resolve_who(priority: Optional[str], user: Optional[str]):
+    return (
+        priority or _priority.get() or _defaults["priority"],
+        user or _user.get() or _defaults["user"],
+    )
+
+
+def _timeout_error(s: ModelScheduler, priority: str) -> resilience.DeadlineExceeded:
+    metrics.inc("llm_sched_timeouts_total", model=s.model, priority=priority)
+    return resilience.DeadlineExceeded(f"{s.model}: timed out waiting for LLM budget")
+
+
+def acquire(model: str, priority: Optional[str] = None, user: Optional[str] = None,
+            timeout: Optional[float] = None) -> None:
+    """呼び出しを始めてよくなるまで待つ（スレッド用）。締め切りを過ぎたら DeadlineExceeded。"""
+    priority, user = _resolve_who(priority, user)
+    s = get(model)
+    limit = timeout if timeout is not None else resilience.remaining()
+    end = None if limit is None else time.monotonic() + limit
+    t0 = time.perf_counter()
+    w = _Waiter(priority, user)
+    with s.lock:
+        s.enqueue(w)
+        delay = s.dispatch()
+    while not w.granted:
+        wait = _MAX_SLEEP_S if delay is None else min(delay, _MAX_SLEEP_S)
+        if end is not None:
+            wait = min(wait, end - time.monotonic())
+        if wait > 0:
+            w.event.wait(wait)
+        with s.lock:
+            if w.granted:
+                break
+            delay = s.dispatch()
+            if not w.granted and end is not None and time.monotonic() >= end:
+                s.remove(w)
+                raise _timeout_error(s, priority)
+    metrics.observe("llm_sched_wait_ms", (time.perf_counter() - t0) * 1000, model=s.model, priority=priority)
+
+
+async def aacquire(model: str, priority: Optional[str] = None, user: Optional[str] = None,
+                   timeout: Optional[float] = None) -> None:
+    """acquire の asyncio 版。キャンセルされたら待ち行列から外す（配られた後ならトークンを戻す）。"""
+    priority, user = _resolve_who(priority, user)
+    s = get(model)
+    limit = timeout if timeout is not None else resilience.remaining()
+    end = None if limit is None else time.monotonic() + limit
+    t0 = time.perf_counter()
+    w = _Waiter(priority, user, asyncio.get_running_loop())
+    with s.lock:
+        s.enqueue(w)
+        delay = s.dispatch()
+    try:
+        while not w.granted:
+            wait = _MAX_SLEEP_S if delay is None else min(delay, _MAX_SLEEP_S)
+            if end is not None:
+                wait = min(wait, end - time.monotonic())
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(asyncio.shield(w.future), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+            with s.lock:
+                if w.granted:
+                    break
+                delay = s.dispatch()
+                if not w.granted and end is not None and time.monotonic() >= end:
+                    s.remove(w)
+                    raise _timeout_error(s, priority)
+    except asyncio.CancelledError:
+        with s.lock:
+            if w.granted:
+                s.refund()
+            else:
+                s.remove(w)
+            s.dispatch()
+        raise
+    metrics.observe("llm_sched_wait_ms", (time.perf_counter() - t0) * 1000, model=s.model, priority=priority)
+
+
+@contextmanager
+def slot(model: str, priority: Optional[str] = None, user: Optional[str] = None):
+    """`with llm_scheduler.slot(model):` の形で使う（スクリプトの同期呼び出し用）。"""
+    acquire(model, priority, user)
+    yield
+
+
+@asynccontextmanager
+async def aslot(model: str, priority: Optional[str] = None, user: Optional[str] = None):
+    await aacquire(model, priority, user)
+    yield
+
+
+def is_quota_error(e: BaseException) -> bool:
+    if resilience.status_code(e) == 429:
+        return True
+    msg = str(e)[:500]
+    return "RESOURCE_EXHAUSTED" in msg or "Quota exceeded" in msg
+
+
+def report(model: str, error: Optional[BaseException] = None) -> None:
+    """呼び出しの結果を伝える。クォータ超過なら batch を止め、成功なら停止時間を戻していく。"""
+    s = get(model)
+    with s.lock:
+        if error is not None and is_quota_error(error):
+            if time.monotonic() < s.batch_paused_until:
+                return
+            pause = s.pause_batch()
+            metrics.inc("llm_sched_batch_paused_total", model=s.model)
+            print(f"{s.model}: クォータ超過のため batch を {pause:.0f} 秒止めます")
+        elif error is None and s.backoff_s and time.monotonic() >= s.batch_paused_until:
+            s.backoff_s /= 2
+            if s.backoff_s < BATCH_BACKOFF_BASE_S:
+                s.backoff_s = 0.0
+
+
+class RequestContextMiddleware:
+    """API のリクエストを interactive とし、認証ヘッダー（無ければ接続元）ごとに公平に並べる。
+
+    ストリーミング応答を妨げないよう、BaseHTTPMiddleware ではなく素の ASGI ミドルウェアにしている。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or [])
+        raw = headers.get(b"authorization", b"").decode("latin-1")
+        if not raw:
+            client = scope.get("client")
+            raw = client[0] if client else "-"
+        with context(priority=INTERACTIVE, user=fairness_key(raw)):
+            await self.app(scope, receive, send)
@@ -0,0 +1,178 @@
+"""LLM / 生成モデル呼び出しの計測。
+
+API と前処理スクリプトの全呼び出しをこのラッパーで囲み、モデル×呼び出し箇所（site）ごとに
+- レイテンシ（llm_call_latency_ms、status=ok|error|cancelled）
+- トークン数（usage_metadata の prompt / output(+thinking)、llm_tokens_total{kind}）
+- リトライ回数（attempt>1 の呼び出しを llm_retries_total に計上）
+- 推定コスト（llm_cost_usd_total、単価は PRICES）
+を metrics（/v1/metrics）に記録し、1呼び出し1行の構造化ログ（JSON）を標準出力に出す。
+
+使い方:
+    with llm_telemetry.track(model, "translate") as call:
+        resp = client.models.generate_content(...)
+        call.record(resp)
+    async with llm_telemetry.atrack(model, "qa") as call: ...
+"""
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional, Tuple
+
+from . import llm_scheduler, metrics
+
+# USD / 1M tokens（入力, 出力）。思考トークンは出力として課金される
+PRICES: Dict[str, Tuple[float, float]] = {
+    "gemini-2.5-pro": (1.25, 10.0),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-flash-image-preview": (0.30, 30.0),
+    "gemini-embedding-001": (0.15, 0.0),
+}
+
+LOG_CALLS = os.getenv("LLM_CALL_LOG", "true").lower() == "true"
+
+
+def _price(model: str) -> Tuple[float, float]:
+    if model in PRICES:
+        return PRICES[model]
+    # バージョン付きのモデル名（gemini-2.5-flash-001 等）は最長一致で引く
+    for name in sorted(PRICES, key=len, reverse=True):
+        if model.startswith(name):
+            return PRICES[name]
+    return (0.0, 0.0)
+
+
+class Call:
+    def __init__(self, model: str, site: str, attempt: int = 1):
+        self.model = model
+        self.site = site
+        self.attempt = attempt
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.extra_cost_usd = 0.0
+        self.status = "ok"
+        self.start = time.time()
+
+    def record(self, resp) -> None:
+        """レスポンス（ストリームの各チャンクでも可）の usage_metadata を取り込む。
+        ストリームでは累計値が後のチャンクほど大きくなるので最大値を採る。
+        """
+        usage = getattr(resp, "usage_metadata", None)
+        if usage is None:
+            return
+        prompt = getattr(usage, "prompt_token_count", None) or 0
+        output = (getattr(usage, "candidates_token_count", None) or 0) + (
+            getattr(usage, "thoughts_token_count", None) or 0
+        )
+        self.prompt_tokens = max(self.prompt_tokens, prompt)
+        self.output_tokens = max(self.output_tokens, output)
+
+    def add_cost(self, usd: float) -> None:
+        """トークン課金でないモデル（Veo の秒課金、Imagen の枚数課金など）の費用を足す。"""
+        self.extra_cost_usd += usd
+
+    @property
+    def cost_usd(self) -> float:
+        price_in, price_out = _price(self.model)
+        return (
+            self.prompt_tokens * price_in + self.output_tokens * price_out
+        ) / 1_000_000 + self.extra_cost_usd
+
+
+def _finish(call: Call) -> None:
+    latency_ms = (time.time() - call.start) * 1000
+    labels = {"model": call.model, "site": call.site}
+    metrics.observe("llm_call_latency_ms", latency_ms, status=call.status, **labels)
+    metrics.inc("llm_calls_total", status=call.status, **labels)
+    if call.attempt > 1:
+        metrics.inc("llm_retries_total", **labels)
+    if call.prompt_tokens:
+        metrics.inc("llm_tokens_total", call.prompt_tokens, kind="prompt", **labels)
+    if call.output_tokens:
+        metrics.inc("llm_tokens_total", call.output_tokens, kind="output", **labels)
+    cost = call.cost_usd
+    if cost:
+        metrics.inc("llm_cost_usd_total", cost, **labels)
+    if LOG_CALLS:
+        print(
+            json.dumps(
+                {
+                    "severity": "INFO" if call.status == "ok" else "WARNING",
+                    "event": "llm_call",
+                    "model": call.model,
+                    "site": call.site,
+                    "status": call.status,
+                    "attempt": call.attempt,
+                    "latency_ms": int(latency_ms),
+                    "prompt_tokens": call.prompt_tokens,
+                    "output_tokens": call.output_tokens,
+                    "cost_usd": round(cost, 6),
+                },
+                ensure_ascii=False,
+            ),
+            flush=True,
+        )
+
+
+@contextmanager
+def track(model: str, site: str, attempt: int = 1):
+    call = Call(model, site, attempt)
+    try:
+        yield call
+    except BaseException as e:
+        call.status = "cancelled" if _is_cancel(e) else "error"
+        _report(model, e)
+        raise
+    else:
+        _report(model, None)
+    finally:
+        _finish(call)
+
+
+@asynccontextmanager
+async def atrack(model: str, site: str, attempt: int = 1):
+    call = Call(model, site, attempt)
+    try:
+        yield call
+    except BaseException as e:
+        call.status = "cancelled" if _is_cancel(e) else "error"
+        _report(model, e)
+        raise
+    else:
+        _report(model, None)
+    finally:
+        _finish(call)
+
+
+def _report(model: str, error: Optional[BaseException]) -> None:
+    # クォータ超過（429）をスケジューラに伝えて batch を止める
+    if error is not None and _is_cancel(error):
+        return
+    try:
+        llm_scheduler.report(model, error)
+    except Exception:
+        pass
+
+
+def _is_cancel(e: BaseException) -> bool:
+    return isinstance(e, (asyncio.CancelledError, GeneratorExit, KeyboardInterrupt))
+
+
+def totals(site: Optional[str] = None) -> Dict[str, float]:
+    """前処理スクリプトの最後に出す集計（呼び出し数・トークン・推定コスト）。"""
+    snap = metrics.snapshot()["counters"]
+    out = {"calls": 0.0, "prompt_tokens": 0.0, "output_tokens": 0.0, "cost_usd": 0.0}
+    for key, value in snap.items():
+        if site and f"site={site}," not in key and f"site={site}}}" not in key:
+            continue
+        if key.startswith("llm_calls_total{"):
+            out["calls"] += value
+        elif key.startswith("llm_tokens_total{") and "kind=prompt" in key:
+            out["prompt_tokens"] += value
+        elif key.startswith("llm_tokens_total{") and "kind=output" in key:
+            out["output_tokens"] += value
+        elif key.startswith("llm_cost_usd_total{"):
+            out["cost_usd"] += value
+    return out
@@ -0,0 +1,166 @@
+"""ログ系テーブルへの書き込みを遅延・一括化するライター（write-behind）。
+
+リクエストはレコード（dict）をキューに積むだけで DB を待たない。バックグラウンドタスクが
+件数（max_batch）か経過時間（flush_interval_s）のどちらかに達したら複数行 INSERT でまとめて書く。
+
+- キューが満杯のときは put が最大 put_timeout_s 待ち（背圧）、それでも空かなければ破棄して数える
+- 書き込み失敗時は数回リトライする。値の不正（外部キー違反・型違い）や、リトライしても通らないときは
+  1行ずつ書き直し、通らなかった行だけを破棄して数える（1行のせいでバッチ全体を失わない）
+- アプリ終了時（main.py の lifespan）に stop_all() でキューを書き切る
+- メトリクス: log_writer_queue_depth, log_writer_flush_rows, log_writer_flush_ms,
+  log_writer_written_total, log_writer_dropped_total{reason=full|error}（いずれも table ラベル付き）
+"""
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import exc, insert
+
+from ..db.session import engine
+from ..models.models import QALog, RecommendationLog
+from . import metrics
+
+_STOP = object()
+
+
+class BatchWriter:
+    def __init__(
+        self,
+        table,
+        max_batch: int = 200,
+        flush_interval_s: float = 1.0,
+        max_queue: int = 10000,
+        put_timeout_s: float = 0.5,
+        max_retries: int = 3,
+    ):
+        self.table = table
+        self.name = table.name
+        self.max_batch = max_batch
+        self.flush_interval_s = flush_interval_s
+        self.max_queue = max_queue
+        self.put_timeout_s = put_timeout_s
+        self.max_retries = max_retries
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._queue = self._queue or asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, record: Dict[str, Any]) -> bool:
+        """レコードを積む。満杯で put_timeout_s 以内に空かなければ破棄して False。"""
+        if self._task is None:
+            self.start()
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self._queue.put(record), timeout=self.put_timeout_s)
+            except asyncio.TimeoutError:
+                metrics.inc("log_writer_dropped_total", table=self.name, reason="full")
+                return False
+        metrics.set_gauge("log_writer_queue_depth", self._queue.qsize(), table=self.name)
+        return True
+
+    async def _next_batch(self) -> tuple[List[Dict[str, Any]], bool]:
+        """(バッチ, 停止要求を受け取ったか) を返す。"""
+        batch: List[Dict[str, Any]] = []
+        deadline = None
+        while len(batch) < self.max_batch:
+            if deadline is None:
+                item = await self._queue.get()
+                deadline = time.monotonic() + self.flush_interval_s
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _insert(self, rows: List[Dict[str, Any]]) -> None:
+        # 1文の複数行 INSERT（VALUES (...), (...), ...）
+        with engine.begin() as conn:
+            conn.execute(insert(self.table).values(rows))
+
+    def _insert_each(self, rows: List[Dict[str, Any]]) -> int:
+        """1行ずつ書き、書けた行数を返す（書けない行は捨てる）。"""
+        written = 0
+        for row in rows:
+            try:
+                self._insert([row])
+                written += 1
+            except Exception as e:
+                print(f"{self.name} の1行を破棄しました: {type(e).__name__}: {e}")
+        return written
+
+    async def _flush(self, rows: List[Dict[str, Any]]) -> None:
+        start = time.time()
+        written = len(rows)
+        for attempt in range(self.max_retries + 1):
+            try:
+                await run_in_threadpool(self._insert, rows)
+                break
+            except Exception as e:
+                # 値の不正はリトライしても通らないので、すぐ1行ずつに切り替える
+                bad_row = isinstance(e, (exc.IntegrityError, exc.DataError)) or (
+                    isinstance(e, exc.StatementError) and not isinstance(e, exc.DBAPIError)
+                )
+                if bad_row or attempt == self.max_retries:
+                    written = await run_in_threadpool(self._insert_each, rows) if len(rows) > 1 else 0
+                    if written < len(rows):
+                        print(f"{self.name} の書き込みに失敗しました（{len(rows) - written}件を破棄）: {e}")
+                        metrics.inc(
+                            "log_writer_dropped_total",
+                            len(rows) - written,
+                            table=self.name,
+                            reason="error",
+                        )
+                    break
+                await asyncio.sleep(min(5.0, 0.5 * 2**attempt))
+        if not written:
+            return
+        metrics.inc("log_writer_written_total", written, table=self.name)
+        metrics.observe("log_writer_flush_rows", len(rows), table=self.name)
+        metrics.observe("log_writer_flush_ms", (time.time() - start) * 1000, table=self.name)
+
+    async def _run(self) -> None:
+        while True:
+            batch, stop = await self._next_batch()
+            metrics.set_gauge("log_writer_queue_depth", self._queue.qsize(), table=self.name)
+            if batch:
+                await self._flush(batch)
+            if stop:
+                return
+
+    async def stop(self) -> None:
+        """受付済みのレコードをすべて書き切ってから止める。"""
+        if self._task is None:
+            return
+        # 停止マーカーは既存レコードの後ろに並ぶので、それまでの分は通常どおり書かれる
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+
+qa_logs = BatchWriter(QALog.__table__)
+recommendation_logs = BatchWriter(RecommendationLog.__table__)
+
+_WRITERS = (qa_logs, recommendation_logs)
+
+
+def start_all() -> None:
+    for w in _WRITERS:
+        w.start()
+
+
+async def stop_all() -> None:
+    for w in _WRITERS:
+        await w.stop()
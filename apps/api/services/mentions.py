@@ -0,0 +1,187 @@
+"""本文中の登場人物の言及を、LLM を使わずに検出する（Aho-Corasick による複数パターン照合）。
+
+- パターンは books.characters の name と aliases（任意）に加え、名前から機械的に作る別名
+  （「李徴（虎）」→「李徴」、「ロミオ・モンタギュー」→「ロミオ」「モンタギュー」）
+- 1つの別名が複数の人物に当たる（「李徴」→ 人間/虎）のに、より長い名前で特定できない場合は「曖昧」とし、
+  呼び出し側は LLM（_check_characters）にフォールバックする。特定できたときは、シーンのプロンプトだけを
+  安いモデルで作る（generate._scene_prompt）
+- 段落ごとの結果は preprocessing/13_build_character_mentions.py が paragraph_characters に事前計算する。
+  登場人物一覧の版（characters_version）が違う行は使わない
+- メトリクス: character_detection_total{source=index|matcher|llm}
+"""
+import re
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import text
+
+_PAREN = re.compile(r"[（(][^）)]*[）)]")
+_SEPARATORS = re.compile(r"[・･\s　＝=]+")
+# 1文字の別名は誤検出が多すぎるので使わない
+MIN_ALIAS_CHARS = 2
+
+
+class AhoCorasick:
+    """パターン → 値の集合。find() は本文に現れたパターンを (開始, 終了, パターン) で返す。"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[str]] = [[]]
+        for p in patterns:
+            self._add(p)
+        self._build()
+
+    def _add(self, pattern: str) -> None:
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        if pattern not in self._out[node]:
+            self._out[node].append(pattern)
+
+    def _build(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                cand = self._goto[f].get(ch, 0)
+                self._fail[nxt] = cand if cand != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text: str) -> List[Tuple[int, int, str]]:
+        hits = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for p in self._out[node]:
+                hits.append((i + 1 - len(p), i + 1, p))
+        return hits
+
+
+def aliases(name: str, extra: Iterable[str] = ()) -> Set[str]:
+    out = {name}
+    base = _PAREN.sub("", name).strip()
+    if base:
+        out.add(base)
+        parts = [p for p in _SEPARATORS.split(base) if p]
+        if len(parts) > 1:
+            out.update(parts)
+    out.update(a.strip() for a in extra if a and a.strip())
+    return {a for a in out if len(a) >= MIN_ALIAS_CHARS}
+
+
+@dataclass
+class Detection:
+    names: List[str]
+    # 別名が複数の人物に当たり、特定できなかった
+    ambiguous: bool
+
+
+class Matcher:
+    def __init__(self, characters: List[dict]):
+        self._owners: Dict[str, Set[str]] = {}
+        for c in characters or []:
+            name = c.get("name")
+            if not name:
+                continue
+            for a in aliases(name, c.get("aliases") or []):
+                self._owners.setdefault(a, set()).add(name)
+        self._ac = AhoCorasick(self._owners)
+
+    def detect(self, text: str) -> Detection:
+        hits = self._ac.find(text or "")
+        # 長い一致を優先し、それに含まれる短い一致（「李徴（虎）」の中の「李徴」）は数えない
+        hits.sort(key=lambda h: (h[0], -(h[1] - h[0])))
+        kept: List[Tuple[int, int, str]] = []
+        covered_until = -1
+        for start, end, p in hits:
+            if end <= covered_until:
+                continue
+            kept.append((start, end, p))
+            covered_until = max(covered_until, end)
+        resolved: List[str] = []
+        unresolved: List[FrozenSet[str]] = []
+        for _, _, p in kept:
+            owners = self._owners[p]
+            if len(owners) == 1:
+                (n,) = owners
+                if n not in resolved:
+                    resolved.append(n)
+            else:
+                unresolved.append(frozenset(owners))
+        # 同じ本文中で候補のどれかが特定済みなら、その人物を指しているとみなす
+        ambiguous = any(not (owners & set(resolved)) for owners in unresolved)
+        return Detection(names=resolved, ambiguous=ambiguous)
+
+
+_matchers: Dict[Tuple[int, str], Matcher] = {}
+_lock = threading.Lock()
+
+
+def matcher_for(book_id: int, version: str, characters: List[dict]) -> Matcher:
+    """作品×登場人物一覧の版ごとに1回だけ組み立てる。"""
+    key = (book_id, version)
+    with _lock:
+        m = _matchers.get(key)
+    if m is None:
+        m = Matcher(characters)
+        with _lock:
+            # 古い版は捨てる
+            for k in [k for k in _matchers if k[0] == book_id]:
+                del _matchers[k]
+            _matchers[key] = m
+    return m
+
+
+def detect(book_id: int, version: str, characters: List[dict], text: str) -> Detection:
+    return matcher_for(book_id, version, characters).detect(text)
+
+
+def merge(detections: Iterable[Optional[Detection]]) -> Optional[Detection]:
+    """段落ごとの結果をまとめる（1つでも未計算なら None）。"""
+    names: List[str] = []
+    ambiguous = False
+    for d in detections:
+        if d is None:
+            return None
+        ambiguous = ambiguous or d.ambiguous
+        names.extend(n for n in d.names if n not in names)
+    return Detection(names=names, ambiguous=ambiguous)
+
+
+def paragraph_detection(
+    db, book_id: int, version: str, para_ids: Sequence[int]
+) -> Optional[Detection]:
+    """事前計算済みの段落の結果をまとめて返す（未計算・版違いが1つでもあれば None）。"""
+    ids = [int(p) for p in para_ids or []]
+    if not ids:
+        return None
+    rows = db.execute(
+        text(
+            """
+            SELECT para_id, character_names, ambiguous FROM paragraph_characters
+            WHERE book_id = :bid AND characters_version = :ver AND para_id = ANY(:ids)
+            """
+        ),
+        {"bid": book_id, "ver": version, "ids": ids},
+    ).mappings().all()
+    found = {
+        r["para_id"]: Detection(names=list(r["character_names"] or []), ambiguous=r["ambiguous"])
+        for r in rows
+    }
+    return merge(found.get(pid) for pid in ids)
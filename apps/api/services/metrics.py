@@ -0,0 +1,93 @@
+"""プロセス内の簡易メトリクス（カウンタ・ゲージ・ヒストグラム）。
+
+`/v1/metrics` から JSON で参照する。複数インスタンス構成ではインスタンスごとの値になる。
+"""
+import threading
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+# ヒストグラムごとに保持する直近サンプル数（パーセンタイル算出用）
+_WINDOW = 2048
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+_gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+_histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], "_Histogram"] = {}
+
+
+class _Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples: Deque[float] = deque(maxlen=_WINDOW)
+
+    def observe(self, v: float) -> None:
+        self.count += 1
+        self.total += v
+        self.max = max(self.max, v)
+        self.samples.append(v)
+
+    def snapshot(self) -> dict:
+        ordered = sorted(self.samples)
+
+        def pct(p: float) -> float:
+            if not ordered:
+                return 0.0
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+        return {
+            "count": self.count,
+            "sum": round(self.total, 3),
+            "avg": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": pct(0.50),
+            "p95": pct(0.95),
+            "p99": pct(0.99),
+            "max": self.max,
+        }
+
+
+def _key(name: str, labels: dict) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt(key: Tuple[str, Tuple[Tuple[str, str], ...]]) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    k = _key(name, labels)
+    with _lock:
+        _counters[k] = _counters.get(k, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def add_gauge(name: str, delta: float, **labels) -> None:
+    k = _key(name, labels)
+    with _lock:
+        _gauges[k] = _gauges.get(k, 0) + delta
+
+
+def observe(name: str, value: float, **labels) -> None:
+    k = _key(name, labels)
+    with _lock:
+        h = _histograms.get(k)
+        if h is None:
+            h = _histograms[k] = _Histogram()
+        h.observe(value)
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "counters": {_fmt(k): v for k, v in sorted(_counters.items())},
+            "gauges": {_fmt(k): v for k, v in sorted(_gauges.items())},
+            "histograms": {_fmt(k): h.snapshot() for k, h in sorted(_histograms.items())},
+        }
@@ -0,0 +1,337 @@
+"""レイテンシ・エラー率を見てモデルを選ぶルーター（サーキットブレーカー＋フォールバック）。
+
+- モデルごとに直近の呼び出し（件数・時間で窓を区切る）のレイテンシとエラー率を保持
+- エラーが続く（連続失敗 or 窓内のエラー率がしきい値以上）とサーキットを開き、
+  一定時間はそのモデルを使わない。経過後は1本だけ試し（half-open）、成功すれば閉じる
+- 機能ごとのポリシー（POLICIES）で候補モデルを上位→高速な順に並べ、失敗・タイムアウト・
+  サーキット開放時は次のモデルへフォールバックする。リクエスト全体の締め切り（deadline）を守る
+- メトリクス: model_circuit_state{model}（0=closed,1=half_open,2=open）, model_latency_p95_ms{model},
+  model_error_rate{model}, model_router_fallback_total{feature,from_model,to_model},
+  model_router_exhausted_total{feature}
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from . import metrics, resilience
+
+PRO = "gemini-2.5-pro"
+FLASH = "gemini-2.5-flash"
+FLASH_LITE = "gemini-2.5-flash-lite"
+
+WINDOW_S = float(os.getenv("MODEL_ROUTER_WINDOW_S", "300"))
+WINDOW_SIZE = int(os.getenv("MODEL_ROUTER_WINDOW_SIZE", "100"))
+MIN_CALLS = int(os.getenv("MODEL_ROUTER_MIN_CALLS", "10"))
+ERROR_RATE_TO_OPEN = float(os.getenv("MODEL_ROUTER_ERROR_RATE", "0.5"))
+CONSECUTIVE_FAILURES_TO_OPEN = int(os.getenv("MODEL_ROUTER_CONSECUTIVE_FAILURES", "5"))
+OPEN_SECONDS = float(os.getenv("MODEL_ROUTER_OPEN_SECONDS", "30"))
+# 後続の候補がある場合、1モデルに使える時間は残り時間のこの割合まで
+ATTEMPT_SHARE = float(os.getenv("MODEL_ROUTER_ATTEMPT_SHARE", "0.6"))
+
+
+@dataclass
+class Policy:
+    models: List[str]
+    deadline_s: float
+
+
+def _models(env: str, default: List[str]) -> List[str]:
+    raw = os.getenv(env)
+    return [m.strip() for m in raw.split(",") if m.strip()] if raw else default
+
+
+# 機能ごとの候補（先頭が第一候補）と既定の締め切り。MODEL_POLICY_<FEATURE>="m1,m2" で上書き可
+POLICIES: Dict[str, Policy] = {
+    "qa": Policy(
+        _models("MODEL_POLICY_QA", [os.getenv("LLM_MODEL", PRO), FLASH, FLASH_LITE]), 60.0
+    ),
+    "translate": Policy(
+        _models("MODEL_POLICY_TRANSLATE", [os.getenv("TRANSLATE_MODEL", FLASH_LITE), FLASH]),
+        30.0,
+    ),
+    "check_characters": Policy(
+        _models("MODEL_POLICY_CHECK_CHARACTERS", [PRO, FLASH]), 60.0
+    ),
+    # 登場人物が名前の照合で決まった場面のプロンプトだけを作る（軽い仕事なので安いモデルから）
+    "scene_prompt": Policy(
+        _models("MODEL_POLICY_SCENE_PROMPT", [FLASH_LITE, FLASH]), 30.0
+    ),
+}
+
+
+class AllModelsFailed(Exception):
+    def __init__(self, feature: str, errors: List[Tuple[str, BaseException]]):
+        self.feature = feature
+        self.errors = errors
+        detail = ", ".join(f"{m}: {type(e).__name__}" for m, e in errors) or "no model available"
+        super().__init__(f"{feature}: all models failed ({detail})")
+
+
+@dataclass
+class _ModelState:
+    samples: Deque[Tuple[float, float, bool]] = field(
+        default_factory=lambda: deque(maxlen=WINDOW_SIZE)
+    )
+    consecutive_failures: int = 0
+    state: str = "closed"  # closed | open | half_open
+    opened_at: float = 0.0
+    probing: bool = False
+
+
+_STATE_CODE = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class ModelHealth:
+    """モデルごとの直近統計とサーキットブレーカー（スレッドセーフ）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models: Dict[str, _ModelState] = {}
+
+    def _get(self, model: str) -> _ModelState:
+        st = self._models.get(model)
+        if st is None:
+            st = self._models[model] = _ModelState()
+        return st
+
+    def _prune(self, st: _ModelState, now: float) -> None:
+        while st.samples and now - st.samples[0][0] > WINDOW_S:
+            st.samples.popleft()
+
+    def _set_state(self, model: str, st: _ModelState, state: str) -> None:
+        st.state = state
+        metrics.set_gauge("model_circuit_state", _STATE_CODE[state], model=model)
+
+    def acquire(self, model: str) -> bool:
+        """このモデルを今使ってよいか。half-open 中は試行を1本だけ許す。"""
+        now = time.time()
+        with self._lock:
+            st = self._get(model)
+            if st.state == "open":
+                if now - st.opened_at < OPEN_SECONDS:
+                    return False
+                self._set_state(model, st, "half_open")
+                st.probing = False
+            if st.state == "half_open":
+                if st.probing:
+                    return False
+                st.probing = True
+            return True
+
+    def release(self, model: str) -> None:
+        """結果を記録せずに試行を返す（呼び出し元のキャンセル）。ブレーカーの状態は変えない。"""
+        with self._lock:
+            self._get(model).probing = False
+
+    def record(self, model: str, latency_ms: float, ok: bool) -> None:
+        now = time.time()
+        with self._lock:
+            st = self._get(model)
+            st.samples.append((now, latency_ms, ok))
+            self._prune(st, now)
+            st.consecutive_failures = 0 if ok else st.consecutive_failures + 1
+            if st.state == "half_open":
+                st.probing = False
+                if ok:
+                    self._set_state(model, st, "closed")
+                else:
+                    st.opened_at = now
+                    self._set_state(model, st, "open")
+            elif st.state == "closed" and not ok:
+                errors = sum(1 for _, _, good in st.samples if not good)
+                rate = errors / len(st.samples)
+                if st.consecutive_failures >= CONSECUTIVE_FAILURES_TO_OPEN or (
+                    len(st.samples) >= MIN_CALLS and rate >= ERROR_RATE_TO_OPEN
+                ):
+                    st.opened_at = now
+                    self._set_state(model, st, "open")
+            p95, rate = self._stats(st)
+        if p95 is not None:
+            metrics.set_gauge("model_latency_p95_ms", p95, model=model)
+        metrics.set_gauge("model_error_rate", rate, model=model)
+
+    def _stats(self, st: _ModelState) -> Tuple[Optional[float], float]:
+        if not st.samples:
+            return None, 0.0
+        lat = sorted(l for _, l, good in st.samples if good)
+        p95 = lat[min(len(lat) - 1, int(0.95 * len(lat)))] if lat else None
+        rate = sum(1 for _, _, good in st.samples if not good) / len(st.samples)
+        return p95, rate
+
+    def p95_ms(self, model: str) -> Optional[float]:
+        with self._lock:
+            st = self._get(model)
+            self._prune(st, time.time())
+            return self._stats(st)[0]
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            out = {}
+            for model, st in self._models.items():
+                p95, rate = self._stats(st)
+                out[model] = {
+                    "state": st.state,
+                    "p95_ms": p95,
+                    "error_rate": round(rate, 3),
+                    "calls": len(st.samples),
+                }
+            return out
+
+
+health = ModelHealth()
+
+
+def _candidates(feature: str, remaining_s: float) -> List[str]:
+    """ポリシー順の候補。直近 p95 が残り時間を超えるモデルは、後ろに候補がある限り飛ばす。"""
+    models = POLICIES[feature].models
+    out = []
+    for i, model in enumerate(models):
+        p95 = health.p95_ms(model)
+        if p95 is not None and p95 / 1000 > remaining_s and i < len(models) - 1:
+            continue
+        out.append(model)
+    return out
+
+
+def _deadline_at(feature: str, deadline_s: Optional[float]) -> float:
+    """機能の締め切りと、呼び出し元の締め切り（resilience.deadline）の早い方。"""
+    budget = deadline_s or POLICIES[feature].deadline_s
+    outer = resilience.remaining()
+    if outer is not None:
+        budget = min(budget, outer)
+    return time.monotonic() + budget
+
+
+def _attempt_timeout(remaining_s: float, has_next: bool) -> float:
+    return remaining_s * ATTEMPT_SHARE if has_next else remaining_s
+
+
+def _fallback(feature: str, from_model: str, to_model: Optional[str]) -> None:
+    if to_model:
+        metrics.inc(
+            "model_router_fallback_total", feature=feature, from_model=from_model, to_model=to_model
+        )
+
+
+async def arun(
+    feature: str,
+    fn: Callable[[str], Awaitable[Any]],
+    deadline_s: Optional[float] = None,
+) -> Tuple[Any, str]:
+    """fn(model) をポリシー順に試し、(結果, 使ったモデル) を返す。"""
+    deadline = _deadline_at(feature, deadline_s)
+    errors: List[Tuple[str, BaseException]] = []
+    models = _candidates(feature, deadline - time.monotonic())
+    for i, model in enumerate(models):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not health.acquire(model):
+            _fallback(feature, model, models[i + 1] if i + 1 < len(models) else None)
+            continue
+        start = time.time()
+        try:
+            result = await asyncio.wait_for(
+                fn(model), timeout=_attempt_timeout(remaining, i + 1 < len(models))
+            )
+        except asyncio.CancelledError:
+            # 呼び出し元のキャンセルは成功とも失敗とも数えない（half-open の試行だけ返す）
+            health.release(model)
+            raise
+        except Exception as e:
+            health.record(model, (time.time() - start) * 1000, False)
+            errors.append((model, e))
+            _fallback(feature, model, models[i + 1] if i + 1 < len(models) else None)
+            continue
+        health.record(model, (time.time() - start) * 1000, True)
+        return result, model
+    metrics.inc("model_router_exhausted_total", feature=feature)
+    raise AllModelsFailed(feature, errors)
+
+
+async def astream(
+    feature: str,
+    fn: Callable[[str], AsyncIterator[str]],
+    info: Optional[dict] = None,
+    deadline_s: Optional[float] = None,
+) -> AsyncIterator[str]:
+    """ストリーム版。最初のチャンクが届くまでは失敗・締め切り超過で次のモデルに切り替える。
+    届いた後は切り替えない（途中までの出力が混ざるため）。使ったモデルは info["model"] に入れる。
+    """
+    deadline = _deadline_at(feature, deadline_s)
+    errors: List[Tuple[str, BaseException]] = []
+    models = _candidates(feature, deadline - time.monotonic())
+    for i, model in enumerate(models):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not health.acquire(model):
+            _fallback(feature, model, models[i + 1] if i + 1 < len(models) else None)
+            continue
+        start = time.time()
+        gen = fn(model).__aiter__()
+        try:
+            first = await asyncio.wait_for(
+                gen.__anext__(), timeout=_attempt_timeout(remaining, i + 1 < len(models))
+            )
+        except StopAsyncIteration:
+            first = None
+        except asyncio.CancelledError:
+            health.release(model)
+            await gen.aclose()
+            raise
+        except Exception as e:
+            await gen.aclose()
+            health.record(model, (time.time() - start) * 1000, False)
+            errors.append((model, e))
+            _fallback(feature, model, models[i + 1] if i + 1 < len(models) else None)
+            continue
+        if info is not None:
+            info["model"] = model
+        ok = False
+        cancelled = False
+        try:
+            if first is not None:
+                yield first
+                async for chunk in gen:
+                    yield chunk
+            ok = True
+        except (asyncio.CancelledError, GeneratorExit):
+            # クライアントの切断。所要時間はモデルの速さではないので記録しない
+            cancelled = True
+            raise
+        finally:
+            if cancelled:
+                health.release(model)
+            else:
+                health.record(model, (time.time() - start) * 1000, ok)
+            await gen.aclose()
+        return
+    metrics.inc("model_router_exhausted_total", feature=feature)
+    raise AllModelsFailed(feature, errors)
+
+
+def run(feature: str, fn: Callable[[str], Any]) -> Tuple[Any, str]:
+    """同期版（バッチ用）。締め切りでの打ち切りはせず、失敗とサーキット開放時のみ切り替える。"""
+    errors: List[Tuple[str, BaseException]] = []
+    models = POLICIES[feature].models
+    for i, model in enumerate(models):
+        if not health.acquire(model):
+            _fallback(feature, model, models[i + 1] if i + 1 < len(models) else None)
+            continue
+        start = time.time()
+        try:
+            result = fn(model)
+        except Exception as e:
+            health.record(model, (time.time() - start) * 1000, False)
+            errors.append((model, e))
+            _fallback(feature, model, models[i + 1] if i + 1 < len(models) else None)
+            continue
+        health.record(model, (time.time() - start) * 1000, True)
+        return result, model
+    metrics.inc("model_router_exhausted_total", feature=feature)
+    raise AllModelsFailed(feature, errors)
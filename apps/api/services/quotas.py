@@ -0,0 +1,298 @@
+"""高コストな機能（画像・動画生成、Q&A）の受け付け制御とユーザーごとの利用上限。
+
+- ユーザー×機能ごとのトークンバケット（プロセス内）で短時間の連打を抑え、1日の回数は
+  usage_counters（Postgres）で数える（再起動・複数インスタンスでも共有される）
+- 機能ごとの全体の同時実行数が上限なら待たせずに断る。生成は未完了のジョブ数（キューの長さ）、
+  Q&A はこのプロセスで実行中の数で判定する（時間切れになる仕事を積まない）
+- 断るときは QuotaExceeded を投げ、main.py のハンドラが Retry-After 付きの 429 にする
+- 失敗した生成ジョブ（落ちたワーカーから回収して failed にしたものも含む）の分は1日の回数から戻す（refund）。現在の状態は GET /v1/quotas で見られる
+- 上限は環境変数 QUOTAS で上書きできる（例: "image.daily=20,qa.burst=60,video.concurrency=2"）
+- メトリクス: admission_total{feature,result=ok|rate|daily|busy}, admission_in_flight{feature}
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import text
+
+from . import metrics
+
+# 1日の区切り（利用者の多い日本時間の0時）
+QUOTA_TZ = ZoneInfo(os.getenv("QUOTA_TZ", "Asia/Tokyo"))
+# トークンバケットを保持するユーザー×機能の数（古いものから捨てる）
+MAX_BUCKETS = 10000
+
+
+@dataclass(frozen=True)
+class Quota:
+    # バケットの容量（連続で使える回数）と、満タンまで戻る秒数
+    burst: int
+    refill_s: float
+    # 1日の上限（None なら数えない）
+    daily: Optional[int]
+    # 全体の同時実行数（生成は未完了ジョブ数）
+    concurrency: int
+
+
+# 要件: 画像 10枚/日・動画 2本/日・Q&A 30回/時（ユーザーごと）
+DEFAULT_QUOTAS: Dict[str, Quota] = {
+    "image": Quota(burst=3, refill_s=60, daily=10, concurrency=32),
+    "video": Quota(burst=1, refill_s=300, daily=2, concurrency=8),
+    "qa": Quota(burst=30, refill_s=3600, daily=None, concurrency=32),
+}
+
+
+def _load_quotas() -> Dict[str, Quota]:
+    quotas = dict(DEFAULT_QUOTAS)
+    raw = os.getenv("QUOTAS", "")
+    for item in raw.split(","):
+        if "=" not in item or "." not in item.split("=", 1)[0]:
+            continue
+        k, v = item.split("=", 1)
+        feature, field = (s.strip() for s in k.split(".", 1))
+        if feature not in quotas or field not in ("burst", "refill_s", "daily", "concurrency"):
+            continue
+        try:
+            value = float(v) if field == "refill_s" else int(v)
+        except ValueError:
+            continue
+        if field == "daily" and value <= 0:
+            value = None
+        quotas[feature] = replace(quotas[feature], **{field: value})
+    return quotas
+
+
+QUOTAS = _load_quotas()
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, feature: str, reason: str, retry_after_s: float, detail: str):
+        super().__init__(detail)
+        self.feature = feature
+        self.reason = reason
+        self.retry_after_s = max(1, int(retry_after_s + 0.999))
+        self.detail = detail
+
+
+# ---- トークンバケット（プロセス内） ----
+
+
+class TokenBucket:
+    def __init__(self, capacity: int, refill_s: float):
+        self.capacity = capacity
+        self.rate = capacity / refill_s if refill_s > 0 else float("inf")
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """取れたら 0、取れなければ次の1枚までの秒数。"""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def give_back(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def peek(self) -> float:
+        self._refill(time.monotonic())
+        return self.tokens
+
+
+_buckets: "OrderedDict[Tuple[str, str], TokenBucket]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _bucket(user_id: str, feature: str) -> TokenBucket:
+    key = (user_id, feature)
+    b = _buckets.get(key)
+    if b is None:
+        q = QUOTAS[feature]
+        b = _buckets[key] = TokenBucket(q.burst, q.refill_s)
+        while len(_buckets) > MAX_BUCKETS:
+            _buckets.popitem(last=False)
+    else:
+        _buckets.move_to_end(key)
+    return b
+
+
+# ---- 1日の回数（Postgres） ----
+
+
+def today() -> str:
+    return datetime.now(QUOTA_TZ).date().isoformat()
+
+
+def _seconds_until_reset() -> float:
+    now = datetime.now(QUOTA_TZ)
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (tomorrow - now).total_seconds()
+
+
+def _charge_daily(db, user_id: str, feature: str, limit: int, day: str) -> bool:
+    # 上限未満のときだけ加算する（同時に来ても上限を超えない）
+    row = db.execute(
+        text(
+            """
+            INSERT INTO usage_counters (user_id, feature, day, count)
+            VALUES (:uid, :feature, CAST(:day AS DATE), 1)
+            ON CONFLICT (user_id, feature, day) DO UPDATE
+              SET count = usage_counters.count + 1, updated_at = now()
+              WHERE usage_counters.count < :limit
+            RETURNING count
+            """
+        ),
+        {"uid": user_id, "feature": feature, "day": day, "limit": limit},
+    ).first()
+    db.commit()
+    return row is not None
+
+
+def refund(db, user_id: str, feature: str, day: Optional[str]) -> None:
+    """実行できなかった分を1日の回数から戻す。"""
+    if not day or QUOTAS.get(feature) is None or QUOTAS[feature].daily is None:
+        return
+    db.execute(
+        text(
+            """
+            UPDATE usage_counters SET count = GREATEST(count - 1, 0), updated_at = now()
+            WHERE user_id = :uid AND feature = :feature AND day = CAST(:day AS DATE)
+            """
+        ),
+        {"uid": user_id, "feature": feature, "day": day},
+    )
+    db.commit()
+
+
+def _used_today(db, user_id: str) -> Dict[str, int]:
+    rows = db.execute(
+        text(
+            "SELECT feature, count FROM usage_counters "
+            "WHERE user_id = :uid AND day = CAST(:day AS DATE)"
+        ),
+        {"uid": user_id, "day": today()},
+    ).all()
+    return {r[0]: int(r[1]) for r in rows}
+
+
+# ---- 全体の同時実行数 ----
+
+_in_flight: Dict[str, int] = {}
+
+
+def _backlog(db, feature: str) -> int:
+    return int(
+        db.execute(
+            text(
+                "SELECT COUNT(*) FROM generation_jobs "
+                "WHERE job_type = :type AND status IN ('queued', 'running')"
+            ),
+            {"type": feature},
+        ).scalar()
+        or 0
+    )
+
+
+def _reject(feature: str, reason: str, retry_after_s: float, detail: str) -> QuotaExceeded:
+    metrics.inc("admission_total", feature=feature, result=reason)
+    return QuotaExceeded(feature, reason, retry_after_s, detail)
+
+
+def admit(db, user_id: str, feature: str, queued: bool = False) -> Optional[str]:
+    """受け付けられるなら1回分を消費して、数えた日（refund 用）を返す。無理なら QuotaExceeded。
+
+    queued=True の機能（生成）は未完了ジョブ数で全体の上限を判定する。
+    """
+    q = QUOTAS[feature]
+    if queued and _backlog(db, feature) >= q.concurrency:
+        raise _reject(feature, "busy", 30, "混み合っています。しばらくしてからお試しください")
+    with _lock:
+        wait_s = _bucket(user_id, feature).take()
+    if wait_s > 0:
+        raise _reject(feature, "rate", wait_s, "短時間の利用回数の上限に達しました")
+    day = None
+    if q.daily is not None:
+        day = today()
+        if not _charge_daily(db, user_id, feature, q.daily, day):
+            with _lock:
+                _bucket(user_id, feature).give_back()
+            raise _reject(
+                feature, "daily", _seconds_until_reset(), f"本日の上限（{q.daily}回）に達しました"
+            )
+    metrics.inc("admission_total", feature=feature, result="ok")
+    return day
+
+
+def check_slot(feature: str) -> None:
+    """空きが無ければ待たずに QuotaExceeded（枠は取らない。ストリーミングの開始前に使う）。"""
+    with _lock:
+        full = _in_flight.get(feature, 0) >= QUOTAS[feature].concurrency
+    if full:
+        raise _reject(feature, "busy", 5, "混み合っています。しばらくしてからお試しください")
+
+
+def acquire_slot(feature: str, enforce: bool = True) -> None:
+    """このプロセスでの同時実行数の枠を取る。空きが無ければ待たずに QuotaExceeded。"""
+    limit = QUOTAS[feature].concurrency
+    with _lock:
+        n = _in_flight.get(feature, 0)
+        if enforce and n >= limit:
+            raise _reject(feature, "busy", 5, "混み合っています。しばらくしてからお試しください")
+        _in_flight[feature] = n + 1
+    metrics.set_gauge("admission_in_flight", n + 1, feature=feature)
+
+
+def release_slot(feature: str) -> None:
+    with _lock:
+        _in_flight[feature] = max(0, _in_flight.get(feature, 0) - 1)
+        n = _in_flight[feature]
+    metrics.set_gauge("admission_in_flight", n, feature=feature)
+
+
+@contextmanager
+def slot(feature: str, enforce: bool = True):
+    acquire_slot(feature, enforce)
+    try:
+        yield
+    finally:
+        release_slot(feature)
+
+
+def status(db, user_id: str) -> dict:
+    """ユーザーの現在の利用状況（GET /v1/quotas）。"""
+    used = _used_today(db, user_id)
+    reset_s = _seconds_until_reset()
+    out = {}
+    for feature, q in QUOTAS.items():
+        with _lock:
+            b = _buckets.get((user_id, feature))
+            tokens = b.peek() if b else float(q.burst)
+        entry = {
+            "burst": q.burst,
+            "burst_remaining": int(tokens),
+            "burst_refill_s": q.refill_s,
+        }
+        if q.daily is not None:
+            n = used.get(feature, 0)
+            entry.update(
+                {
+                    "daily_limit": q.daily,
+                    "used_today": n,
+                    "remaining_today": max(0, q.daily - n),
+                    "resets_in_s": int(reset_s),
+                }
+            )
+        out[feature] = entry
+    return out
@@ -0,0 +1,289 @@
+"""リトライ・締め切り・ヘッジの共通ヘルパー。
+
+- 指数バックオフ＋フルジッタ（RetryPolicy）。4xx（408/429 以外）は再試行しない
+- リトライ予算（RetryBudget）: 直近の呼び出し数に対する再試行の割合を制限し、障害時の再試行の嵐を防ぐ。
+  API のリクエスト向け。前処理のバッチは RetryPolicy(use_budget=False) で予算を使わず、回数とバックオフだけで待つ
+- 締め切り（deadline）: contextvar で入れ子の呼び出しに伝わり、残り時間を超えて待たない・試さない
+- 入れ子のリトライは外側だけが再試行する（内側は1回だけ試す）ため、3×3=9回のような掛け算にならない
+- ヘッジ（ahedged）: 直近の p95 を過ぎても返らなければ2本目を投げ、先に成功した方を採る
+- メトリクス: retry_attempts_total{op}, retry_budget_exhausted_total{op},
+  retry_gave_up_total{op}, hedge_launched_total{op}, hedge_won_total{op}
+"""
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple, Type
+
+from . import metrics
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "resilience_deadline", default=None
+)
+_in_retry: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "resilience_in_retry", default=False
+)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """この中の呼び出し全体の締め切りを設定する（外側の締め切りより延ばすことはない）。"""
+    if seconds is None:
+        yield
+        return
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(current, at))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """締め切りまでの残り秒数（締め切りなしは None）。"""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def status_code(e: BaseException) -> Optional[int]:
+    for attr in ("status_code", "code", "status"):
+        v = getattr(e, attr, None)
+        if isinstance(v, int):
+            return v
+    resp = getattr(e, "response", None)
+    v = getattr(resp, "status_code", None)
+    return v if isinstance(v, int) else None
+
+
+def is_retryable(e: BaseException) -> bool:
+    """クライアント側の誤り（4xx、ただしタイムアウト 408 とレート制限 429 は除く）は再試行しない。"""
+    code = status_code(e)
+    if code is not None and 400 <= code < 500 and code not in (408, 429):
+        return False
+    return True
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 3
+    base_delay_s: float = 0.5
+    max_delay_s: float = 8.0
+    multiplier: float = 2.0
+    retry_on: Tuple[Type[BaseException], ...] = (Exception,)
+    should_retry: Callable[[BaseException], bool] = is_retryable
+    # False ならリトライ予算を使わない（レート制限が続いても max_attempts まで待って試す前処理用）
+    use_budget: bool = True
+
+    def backoff(self, attempt: int) -> float:
+        """attempt 回目の失敗後の待ち時間（フルジッタ）。"""
+        cap = min(self.max_delay_s, self.base_delay_s * self.multiplier ** (attempt - 1))
+        return random.uniform(0, cap)
+
+
+class RetryBudget:
+    """直近 window_s 秒の呼び出し数に対して ratio まで（最低 min_retries 回）再試行を許す。"""
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 3, window_s: float = 10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window_s = window_s
+        self._lock = threading.Lock()
+        self._calls: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+
+    def _prune(self, now: float) -> None:
+        for q in (self._calls, self._retries):
+            while q and now - q[0] > self.window_s:
+                q.popleft()
+
+    def record_call(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            self._calls.append(now)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            allowed = max(self.min_retries, self.ratio * len(self._calls))
+            if len(self._retries) >= allowed:
+                return False
+            self._retries.append(now)
+            return True
+
+
+_budgets: Dict[str, RetryBudget] = {}
+_budgets_lock = threading.Lock()
+
+
+def budget(name: str) -> RetryBudget:
+    with _budgets_lock:
+        b = _budgets.get(name)
+        if b is None:
+            b = _budgets[name] = RetryBudget()
+        return b
+
+
+def _may_retry(
+    name: str, policy: RetryPolicy, attempt: int, e: BaseException, delay: float
+) -> bool:
+    if attempt >= policy.max_attempts:
+        return False
+    if not isinstance(e, policy.retry_on) or not policy.should_retry(e):
+        return False
+    rem = remaining()
+    if rem is not None and rem <= delay:
+        return False
+    if policy.use_budget and not budget(name).try_spend():
+        metrics.inc("retry_budget_exhausted_total", op=name)
+        return False
+    return True
+
+
+async def aretry(
+    name: str,
+    fn: Callable[[int], Awaitable[Any]],
+    policy: Optional[RetryPolicy] = None,
+) -> Any:
+    """fn(attempt) を方針に従って再試行する。各試行は締め切りの残り時間で打ち切る。"""
+    policy = policy or RetryPolicy()
+    if _in_retry.get():
+        # 外側で再試行しているので内側は1回だけ
+        policy = RetryPolicy(max_attempts=1)
+    budget(name).record_call()
+    token = _in_retry.set(True)
+    try:
+        attempt = 0
+        while True:
+            attempt += 1
+            rem = remaining()
+            if rem is not None and rem <= 0:
+                raise DeadlineExceeded(f"{name}: deadline exceeded")
+            try:
+                if rem is None:
+                    return await fn(attempt)
+                return await asyncio.wait_for(fn(attempt), timeout=rem)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = policy.backoff(attempt)
+                if not _may_retry(name, policy, attempt, e, delay):
+                    if attempt > 1:
+                        metrics.inc("retry_gave_up_total", op=name)
+                    raise
+                metrics.inc("retry_attempts_total", op=name)
+                print(f"{name}: {attempt}回目に失敗、{delay:.1f}秒後に再試行します: {e}")
+                await asyncio.sleep(delay)
+    finally:
+        _in_retry.reset(token)
+
+
+def retry(
+    name: str,
+    fn: Callable[[int], Any],
+    policy: Optional[RetryPolicy] = None,
+) -> Any:
+    """同期版（前処理スクリプト用）。締め切りは待ち時間の判定にのみ使う。"""
+    policy = policy or RetryPolicy()
+    if _in_retry.get():
+        policy = RetryPolicy(max_attempts=1)
+    budget(name).record_call()
+    token = _in_retry.set(True)
+    try:
+        attempt = 0
+        while True:
+            attempt += 1
+            rem = remaining()
+            if rem is not None and rem <= 0:
+                raise DeadlineExceeded(f"{name}: deadline exceeded")
+            try:
+                return fn(attempt)
+            except Exception as e:
+                delay = policy.backoff(attempt)
+                if not _may_retry(name, policy, attempt, e, delay):
+                    if attempt > 1:
+                        metrics.inc("retry_gave_up_total", op=name)
+                    raise
+                metrics.inc("retry_attempts_total", op=name)
+                print(f"{name}: {attempt}回目に失敗、{delay:.1f}秒後に再試行します: {e}")
+                time.sleep(delay)
+    finally:
+        _in_retry.reset(token)
+
+
+class LatencyTracker:
+    """成功した呼び出しの直近レイテンシ（ヘッジの発火タイミング用）。"""
+
+    def __init__(self, size: int = 200):
+        self._lock = threading.Lock()
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < 20:
+                return None
+            data = sorted(self._samples)
+        return data[min(len(data) - 1, int(q * len(data)))]
+
+
+_trackers: Dict[str, LatencyTracker] = {}
+
+
+def tracker(name: str) -> LatencyTracker:
+    with _budgets_lock:
+        t = _trackers.get(name)
+        if t is None:
+            t = _trackers[name] = LatencyTracker()
+        return t
+
+
+async def ahedged(
+    name: str,
+    fn: Callable[[], Awaitable[Any]],
+    percentile: float = 0.95,
+    default_delay_s: Optional[float] = None,
+) -> Any:
+    """fn() を投げ、直近の percentile を過ぎても返らなければ同じ呼び出しをもう1本投げる。
+    先に成功した方を返し、残りはキャンセルする。統計が溜まるまでは default_delay_s（None ならヘッジしない）。
+    """
+    delay = tracker(name).percentile(percentile) or default_delay_s
+    rem = remaining()
+    start = time.monotonic()
+    first = asyncio.ensure_future(fn())
+    tasks = [first]
+    try:
+        if delay is not None and (rem is None or delay < rem):
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                metrics.inc("hedge_launched_total", op=name)
+                tasks.append(asyncio.ensure_future(fn()))
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    if t is not first:
+                        metrics.inc("hedge_won_total", op=name)
+                    tracker(name).observe(time.monotonic() - start)
+                    return t.result()
+                error = t.exception()
+        raise error  # type: ignore[misc]
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
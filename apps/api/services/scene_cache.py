@@ -0,0 +1,118 @@
+"""画像・動画生成の前処理（登場人物の抽出とシーンのプロンプト）のキャッシュ。
+
+- 作品ごとの登場人物一覧と参照画像 URI はプロセス内に CHARACTER_CACHE_TTL_S 秒保持し、
+  生成のたびに books を引き直さない
+- 選択テキストから作ったプロンプトと登場人物は scene_prompts に保存し、同じ箇所の再生成では LLM を呼ばない。
+  キーは (作品, 本文のハッシュ, 登場人物一覧のハッシュ) なので、一覧が書き換わると古い行は使われない
+- 06_generate_characters_list.py は一覧を書き換えた作品の scene_prompts を消す。API のプロセス内の
+  一覧・参照画像 URI は消せないので、最大 CHARACTER_CACHE_TTL_S 秒は古いものを使う
+- メトリクス: scene_cache_total{result=hit|miss}, book_characters_cache_total{result=hit|miss}
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from ..models.models import ScenePrompt
+from . import metrics
+
+CHARACTER_CACHE_TTL_S = float(os.getenv("CHARACTER_CACHE_TTL_S", "300"))
+CHARACTER_BUCKET = os.getenv("CHARACTERS_BUCKET")
+# 登場人物抽出のプロンプトを変えたら上げる
+SCENE_PROMPT_VERSION = "v1"
+
+
+@dataclass
+class BookCharacters:
+    title: str
+    names: List[str]
+    # 登場人物一覧のハッシュ（scene_prompts のキーに使う）
+    version: str
+    ref_uris: Dict[str, str] = field(default_factory=dict)
+    # books.characters の各要素（name, aliases など。言及の照合に使う）
+    characters: List[dict] = field(default_factory=list)
+
+
+_books: Dict[int, Tuple[float, BookCharacters]] = {}
+_lock = threading.Lock()
+
+
+def characters_version(characters) -> str:
+    raw = json.dumps(characters or [], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _ref_uri(title: str, name: str) -> str:
+    return f"gs://{CHARACTER_BUCKET}/{title}/{name}.png"
+
+
+def book_characters(db, book_id: int) -> Optional[BookCharacters]:
+    """作品のタイトル・登場人物名・参照画像 URI（存在しない作品は None）。"""
+    now = time.monotonic()
+    with _lock:
+        hit = _books.get(book_id)
+    if hit and now - hit[0] < CHARACTER_CACHE_TTL_S:
+        metrics.inc("book_characters_cache_total", result="hit")
+        return hit[1]
+    metrics.inc("book_characters_cache_total", result="miss")
+    row = db.execute(
+        text("SELECT title, characters FROM books WHERE id = :bid"),
+        {"bid": book_id},
+    ).mappings().first()
+    if not row:
+        return None
+    characters = row["characters"] or []
+    names = [c["name"] for c in characters]
+    book = BookCharacters(
+        title=row["title"],
+        names=names,
+        version=characters_version(characters),
+        ref_uris={n: _ref_uri(row["title"], n) for n in names},
+        characters=characters,
+    )
+    with _lock:
+        _books[book_id] = (now, book)
+    return book
+
+
+def text_hash(source: str) -> str:
+    # 全角/半角・空白の揺れは同じ箇所とみなす
+    s = "".join(unicodedata.normalize("NFKC", source or "").split())
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+
+def get_scene(db, book_id: int, book: BookCharacters, source: str) -> Optional[Tuple[str, List[str]]]:
+    try:
+        row = db.get(ScenePrompt, (book_id, text_hash(source), book.version))
+    except Exception:
+        row = None
+    if not row or row.prompt_version != SCENE_PROMPT_VERSION:
+        metrics.inc("scene_cache_total", result="miss")
+        return None
+    metrics.inc("scene_cache_total", result="hit")
+    # 一覧から消えた名前は参照画像が無いので落とす
+    names = [n for n in (row.character_names or []) if n in book.ref_uris]
+    return row.prompt, names
+
+
+def save_scene(
+    db, book_id: int, book: BookCharacters, source: str, prompt: str, names: List[str], model: str
+) -> None:
+    db.merge(
+        ScenePrompt(
+            book_id=book_id,
+            text_hash=text_hash(source),
+            characters_version=book.version,
+            prompt=prompt,
+            character_names=names,
+            model=model,
+            prompt_version=SCENE_PROMPT_VERSION,
+        )
+    )
+    db.commit()
@@ -0,0 +1,137 @@
+"""Q&A の意味的キャッシュ（プロセス内）。
+
+言い換え（「この時代背景は？」と「時代背景を教えて」など）をまとめるため、正規化した質問の
+埋め込みで同じ book_id・同じ文脈ハッシュの既存回答を近傍検索し、類似度がしきい値以上なら再利用する。
+
+- 全体の件数上限と作品ごとの上限を持ち、作品内は LRU で追い出す
+  （全体上限を超えたときは最も件数の多い作品から追い出す）
+- 作品の本文・タイトルが書き換わっても消さない（プロセス内だけなので、再起動か追い出しで入れ替わる）
+- メトリクス: qa_semantic_cache_total{result=hit|miss}, qa_semantic_cache_saved_ms,
+  qa_semantic_cache_hit_rate, qa_semantic_cache_similarity, qa_semantic_cache_entries
+"""
+import hashlib
+import math
+import operator
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from . import embeddings, metrics
+from .canned_qa import normalize
+
+THRESHOLD = float(os.getenv("QA_SEMANTIC_CACHE_THRESHOLD", "0.92"))
+MAX_ENTRIES = int(os.getenv("QA_SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+MAX_PER_BOOK = int(os.getenv("QA_SEMANTIC_CACHE_MAX_PER_BOOK", "200"))
+ENABLED = os.getenv("QA_SEMANTIC_CACHE", "true").lower() == "true"
+
+
+@dataclass
+class Entry:
+    question: str
+    vector: List[float]  # L2 正規化済み
+    answer: str
+    model: str
+    latency_ms: int
+    created_at: float
+
+
+def context_hash(context: Optional[str]) -> str:
+    return hashlib.sha256(normalize(context or "").encode("utf-8")).hexdigest()[:16]
+
+
+def _unit(vec: List[float]) -> Optional[List[float]]:
+    norm = math.sqrt(sum(v * v for v in vec))
+    if not norm:
+        return None
+    return [v / norm for v in vec]
+
+
+def _dot(a: List[float], b: List[float]) -> float:
+    return sum(map(operator.mul, a, b))
+
+
+class SemanticCache:
+    def __init__(self, threshold: float, max_entries: int, max_per_book: int):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_per_book = max_per_book
+        self._lock = threading.Lock()
+        # book_id -> OrderedDict[(ctx_hash, question) -> Entry]（末尾が最近使ったもの）
+        self._books: Dict[int, "OrderedDict[Tuple[str, str], Entry]"] = {}
+        self._size = 0
+        self._hits = 0
+        self._lookups = 0
+
+    def _record(self, hit: bool) -> None:
+        self._lookups += 1
+        self._hits += int(hit)
+        metrics.set_gauge("qa_semantic_cache_hit_rate", self._hits / self._lookups)
+
+    def lookup(
+        self, book_id: int, ctx_hash: str, vector: List[float]
+    ) -> Optional[Tuple[Entry, float]]:
+        with self._lock:
+            entries = self._books.get(book_id)
+            best: Optional[Tuple[Tuple[str, str], Entry, float]] = None
+            if entries:
+                for key, entry in entries.items():
+                    if key[0] != ctx_hash:
+                        continue
+                    score = _dot(vector, entry.vector)
+                    if best is None or score > best[2]:
+                        best = (key, entry, score)
+            if best is not None:
+                metrics.observe("qa_semantic_cache_similarity", best[2])
+            if best is None or best[2] < self.threshold:
+                self._record(False)
+                metrics.inc("qa_semantic_cache_total", result="miss")
+                return None
+            entries.move_to_end(best[0])
+            self._record(True)
+        metrics.inc("qa_semantic_cache_total", result="hit")
+        metrics.inc("qa_semantic_cache_saved_ms", best[1].latency_ms)
+        return best[1], best[2]
+
+    def put(
+        self,
+        book_id: int,
+        ctx_hash: str,
+        question: str,
+        vector: List[float],
+        answer: str,
+        model: str,
+        latency_ms: int,
+    ) -> None:
+        entry = Entry(question, vector, answer, model, latency_ms, time.time())
+        with self._lock:
+            entries = self._books.setdefault(book_id, OrderedDict())
+            key = (ctx_hash, question)
+            if key not in entries:
+                self._size += 1
+            entries[key] = entry
+            entries.move_to_end(key)
+            while len(entries) > self.max_per_book:
+                entries.popitem(last=False)
+                self._size -= 1
+            while self._size > self.max_entries:
+                victim = max(self._books, key=lambda b: len(self._books[b]))
+                self._books[victim].popitem(last=False)
+                self._size -= 1
+                if not self._books[victim]:
+                    del self._books[victim]
+            metrics.set_gauge("qa_semantic_cache_entries", self._size)
+
+cache = SemanticCache(THRESHOLD, MAX_ENTRIES, MAX_PER_BOOK)
+
+
+async def aembed_question(question: str) -> Optional[List[float]]:
+    vec = await embeddings.aembed_text(normalize(question))
+    return _unit(vec) if vec else None
+
+
+def cacheable(history: Optional[list]) -> bool:
+    """履歴付きの質問（「それはなぜ？」等）は会話に依存するため対象外。"""
+    return ENABLED and not history
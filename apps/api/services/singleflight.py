@@ -0,0 +1,96 @@
+"""同一リクエストの相乗り（single-flight）。
+
+同じキーの呼び出しが実行中なら上流を呼ばずに完了を待ち、結果を共有する。
+スレッド（同期呼び出し）と asyncio タスクのどちらからでも使え、両者の間でも相乗りできる。
+先行呼び出し（リーダー）がキャンセル・失敗した場合は、待機中の呼び出しの1つが新たなリーダーになって再実行する。
+"""
+import asyncio
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Tuple, TypeVar
+
+from . import metrics
+
+T = TypeVar("T")
+
+
+class _Handoff(Exception):
+    """リーダーが結果を出せずに抜けたことを待機側へ知らせる。"""
+
+
+def make_key(model: str, *parts: Any) -> str:
+    raw = json.dumps([model, parts], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+
+    def _join(self, key: str) -> Tuple[Future, bool]:
+        with self._lock:
+            fut = self._calls.get(key)
+            if fut is None:
+                fut = self._calls[key] = Future()
+                return fut, True
+            return fut, False
+
+    def _finish(self, key: str, fut: Future, result: Any = None, handoff: bool = False) -> None:
+        with self._lock:
+            if self._calls.get(key) is fut:
+                del self._calls[key]
+        if handoff:
+            fut.set_exception(_Handoff())
+        else:
+            fut.set_result(result)
+
+    def do(self, key: str, fn: Callable[[], T]) -> T:
+        """同期版。リーダーなら fn() を実行し、そうでなければ結果を待つ。"""
+        while True:
+            fut, leader = self._join(key)
+            if leader:
+                try:
+                    metrics.inc("singleflight_leader_total", flight=self.name)
+                    result = fn()
+                except BaseException:
+                    self._finish(key, fut, handoff=True)
+                    raise
+                self._finish(key, fut, result)
+                return result
+            try:
+                result = fut.result()
+            except _Handoff:
+                metrics.inc("singleflight_handoff_total", flight=self.name)
+                continue
+            metrics.inc("singleflight_coalesced_total", flight=self.name)
+            return result
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """非同期版。待機側がキャンセルされてもリーダーには影響しない。"""
+        while True:
+            fut, leader = self._join(key)
+            if leader:
+                try:
+                    metrics.inc("singleflight_leader_total", flight=self.name)
+                    result = await fn()
+                except BaseException:
+                    self._finish(key, fut, handoff=True)
+                    raise
+                self._finish(key, fut, result)
+                return result
+            try:
+                # shield しないと待機側のキャンセルが共有 Future に伝播してしまう
+                result = await asyncio.shield(asyncio.wrap_future(fut))
+            except _Handoff:
+                metrics.inc("singleflight_handoff_total", flight=self.name)
+                continue
+            metrics.inc("singleflight_coalesced_total", flight=self.name)
+            return result
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,25 @@
+import json
+from typing import Any, Optional
+
+# プロキシ/ブラウザでのバッファリングを避けるための共通ヘッダ
+SSE_HEADERS = {
+    "Cache-Control": "no-cache, no-transform",
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+}
+
+
+def sse_event(data: Any, event: Optional[str] = None) -> str:
+    """Server-Sent Events の1イベントを組み立てる。dict 等は JSON 化する。"""
+    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    for ln in payload.split("\n"):
+        lines.append(f"data: {ln}")
+    return "\n".join(lines) + "\n\n"
+
+
+def sse_comment(text: str = "") -> str:
+    """コメント行（クライアントには無視される）。ハートビートに使う。"""
+    return f": {text}\n\n"
@@ -0,0 +1,145 @@
+"""起動（コールドスタート）の計測とウォームアップ。
+
+- mark(phase) でプロセス開始（/proc の開始時刻、取れなければこのモジュールの読み込み時刻）からの経過を
+  記録する。起動時に1行で出力し、GET /healthz/startup でも見られる
+- 重い SDK（google-genai、google-cloud-storage、firebase-admin、httpx）は使う関数の中で import する。
+  PIL はサムネイル用のプロセスプールの中でしか読み込まない
+- warm_up() は lifespan の中で DB プールの接続・Gemini クライアント・Firebase・GCS クライアントを並列に
+  準備する。uvicorn は lifespan が終わるまで待ち受けないので、起動プローブが通った時点で最初の
+  リクエストが初期化を払うことはない（WARMUP=0 で無効、最初に使うリクエストが読み込む）
+- 全体を WARMUP_TIMEOUT_S で打ち切り、失敗しても起動は続ける（最初の呼び出しで改めて初期化される）
+- メトリクス: startup_ms{phase}（プロセス開始からの経過）, startup_phase_ms{phase}（各段階の所要時間）
+"""
+import asyncio
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+
+from . import metrics
+
+WARMUP = os.getenv("WARMUP", "1") == "1"
+WARMUP_TIMEOUT_S = float(os.getenv("WARMUP_TIMEOUT_S", "20"))
+# 先に開いておく DB 接続の数（プールの大きさ 5 まで）
+WARMUP_DB_CONNECTIONS = int(os.getenv("WARMUP_DB_CONNECTIONS", "2"))
+
+
+def _process_started() -> float:
+    try:
+        with open("/proc/self/stat") as f:
+            # 2番目の項目（コマンド名）は空白を含みうるので ")" の後ろから数える。22番目が開始時刻
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+PROCESS_STARTED = _process_started()
+_timeline: List[Dict[str, object]] = []
+_lock = threading.Lock()
+
+
+def mark(phase: str, took_ms: Optional[float] = None) -> None:
+    at_ms = (time.time() - PROCESS_STARTED) * 1000
+    entry = {"phase": phase, "at_ms": round(at_ms, 1)}
+    if took_ms is not None:
+        entry["took_ms"] = round(took_ms, 1)
+        metrics.set_gauge("startup_phase_ms", took_ms, phase=phase)
+    with _lock:
+        _timeline.append(entry)
+    metrics.set_gauge("startup_ms", at_ms, phase=phase)
+
+
+def timeline() -> List[Dict[str, object]]:
+    with _lock:
+        return list(_timeline)
+
+
+def summary() -> str:
+    return " ".join(
+        f"{e['phase']}={e['at_ms']:.0f}ms" + (f"({e['took_ms']:.0f})" if "took_ms" in e else "")
+        for e in timeline()
+    )
+
+
+# ---- ウォームアップの各段階（スレッドで実行） ----
+
+
+def _db() -> None:
+    from ..db.session import engine
+
+    conns = []
+    try:
+        for _ in range(max(0, WARMUP_DB_CONNECTIONS)):
+            conn = engine.connect()
+            conns.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        # 閉じるとプールに戻り、最初のリクエストはそのまま使える
+        for conn in conns:
+            conn.close()
+
+
+def _genai() -> None:
+    from . import embeddings, llm
+
+    llm.get_client()
+    llm.get_client_for_nano_banana()
+    embeddings.get_client()
+    from google.genai import types  # noqa: F401  画像生成で使う
+
+
+def _firebase() -> None:
+    from ..security import auth
+
+    if not auth.AUTH_DISABLED:
+        auth.init_firebase()
+
+
+def _storage() -> None:
+    from . import assets
+
+    assets.storage_client()
+
+
+def _http() -> None:
+    import httpx  # noqa: F401
+
+
+STEPS: Dict[str, Callable[[], None]] = {
+    "db": _db,
+    "genai": _genai,
+    "firebase": _firebase,
+    "storage": _storage,
+    "http": _http,
+}
+
+
+async def _run(name: str, fn: Callable[[], None]) -> None:
+    t0 = time.perf_counter()
+    try:
+        await run_in_threadpool(fn)
+    except Exception as e:
+        print(f"warm-up {name} failed: {type(e).__name__}: {e}")
+    mark(f"warmup.{name}", (time.perf_counter() - t0) * 1000)
+
+
+async def warm_up() -> None:
+    """待ち受けを始める前に、最初のリクエストが払う初期化を済ませる。"""
+    if not WARMUP:
+        return
+    t0 = time.perf_counter()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(_run(name, fn) for name, fn in STEPS.items())),
+            timeout=WARMUP_TIMEOUT_S,
+        )
+    except asyncio.TimeoutError:
+        # 残りはスレッドで続き、終わったものから使われる
+        print(f"warm-up timed out after {WARMUP_TIMEOUT_S:.0f}s; continuing startup")
+    mark("warmup", (time.perf_counter() - t0) * 1000)
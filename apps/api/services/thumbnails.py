@@ -0,0 +1,176 @@
+"""ギャラリーのアセットからサムネイル（WebP・幅違い）と動画のポスター画像を作る。
+
+- 縮小・エンコード（PIL）とフレーム抽出（ffmpeg）はプロセスプールで実行し、イベントループを止めない
+- 画像は THUMB_WIDTHS の各幅（元より大きい幅は作らない）、動画は先頭付近の1フレームをポスターにして同じ幅で保存
+- gallery.thumb_url には THUMB_URL_WIDTH 以下で最大の幅を入れ、meta に
+  {"thumbs": {"320": url, ...}, "width": w, "height": h}（動画は "poster" も）をマージする
+- 新しいアセットは生成ジョブから schedule() で裏で作り、既存行は
+  preprocessing/12_backfill_gallery_thumbnails.py で埋める
+- メトリクス: thumbnails_total{type,result}, thumbnail_ms{type}
+"""
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+
+from ..db.session import engine
+from . import assets, metrics
+
+THUMB_WIDTHS = tuple(
+    int(w) for w in os.getenv("THUMB_WIDTHS", "320,640").split(",") if w.strip()
+)
+THUMB_URL_WIDTH = int(os.getenv("THUMB_URL_WIDTH", "640"))
+THUMB_QUALITY = int(os.getenv("THUMB_QUALITY", "80"))
+THUMB_PROCESSES = int(os.getenv("THUMB_PROCESSES", "2"))
+# ポスターに使うフレームの位置（秒）。冒頭の黒フレームを避ける
+POSTER_AT_S = float(os.getenv("THUMB_POSTER_AT_S", "0.5"))
+
+Derivative = Tuple[int, int, bytes]  # (width, height, webp)
+
+
+# ---- プロセスプール側（トップレベル関数のみ） ----
+
+
+def _resize_webp(data: bytes, widths: Tuple[int, ...], quality: int) -> Tuple[Tuple[int, int], List[Derivative]]:
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as im:
+        im.load()
+        size = im.size
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGB")
+        out: List[Derivative] = []
+        for w in sorted(set(widths)):
+            if w >= size[0] and out:
+                break
+            w = min(w, size[0])
+            h = max(1, round(size[1] * w / size[0]))
+            buf = BytesIO()
+            im.resize((w, h), Image.LANCZOS).save(buf, format="WEBP", quality=quality, method=4)
+            out.append((w, h, buf.getvalue()))
+    return size, out
+
+
+def _extract_frame(video_url: str, at_s: float) -> bytes:
+    # 動画全体は落とさず、ffmpeg に URL から必要な所だけ読ませる
+    proc = subprocess.run(
+        [
+            "ffmpeg", "-loglevel", "error", "-ss", str(at_s), "-i", video_url,
+            "-frames:v", "1", "-f", "image2pipe", "-vcodec", "png", "-",
+        ],
+        capture_output=True,
+        timeout=60,
+        check=True,
+    )
+    if not proc.stdout:
+        raise RuntimeError("ffmpeg returned no frame")
+    return proc.stdout
+
+
+def _video_poster(video_url: str, widths: Tuple[int, ...], quality: int, at_s: float):
+    return _resize_webp(_extract_frame(video_url, at_s), widths, quality)
+
+
+# ---- イベントループ側 ----
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _executor() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=THUMB_PROCESSES)
+    return _pool
+
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which("ffmpeg") is not None
+
+
+def _update_gallery(gallery_id: int, thumb_url: Optional[str], patch: dict) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                UPDATE gallery
+                SET thumb_url = COALESCE(:thumb, thumb_url),
+                    meta = COALESCE(meta, '{}'::jsonb) || CAST(:patch AS JSONB)
+                WHERE id = :id
+                """
+            ),
+            {"id": gallery_id, "thumb": thumb_url, "patch": json.dumps(patch, ensure_ascii=False)},
+        )
+
+
+async def generate(
+    gallery_id: int, asset_url: str, asset_type: str, data: Optional[bytes] = None
+) -> Optional[str]:
+    """1件分の派生物を作って保存し、thumb_url を返す。data があればダウンロードしない。"""
+    start = time.time()
+    loop = asyncio.get_running_loop()
+    try:
+        if asset_type == "video":
+            if not ffmpeg_available():
+                metrics.inc("thumbnails_total", type=asset_type, result="skipped")
+                return None
+            size, derivs = await loop.run_in_executor(
+                _executor(), _video_poster, asset_url, THUMB_WIDTHS, THUMB_QUALITY, POSTER_AT_S
+            )
+            prefix = "posters"
+        else:
+            if data is None:
+                data = await run_in_threadpool(assets.download_bytes, asset_url)
+            size, derivs = await loop.run_in_executor(
+                _executor(), _resize_webp, data, THUMB_WIDTHS, THUMB_QUALITY
+            )
+            prefix = "thumbs"
+        urls: Dict[str, str] = {}
+        for w, _, webp in derivs:
+            uri = await run_in_threadpool(
+                assets.upload_bytes, webp, f"{prefix}/{gallery_id}_{w}.webp", "image/webp"
+            )
+            urls[str(w)] = assets.public_url(uri)
+        fitting = [w for w, _, _ in derivs if w <= THUMB_URL_WIDTH] or [derivs[0][0]]
+        thumb_url = urls[str(max(fitting))] if urls else None
+        patch = {"thumbs": urls, "width": size[0], "height": size[1]}
+        if asset_type == "video":
+            patch["poster"] = thumb_url
+        await run_in_threadpool(_update_gallery, gallery_id, thumb_url, patch)
+        metrics.inc("thumbnails_total", type=asset_type, result="ok")
+        return thumb_url
+    except Exception as e:
+        metrics.inc("thumbnails_total", type=asset_type, result="error")
+        print(f"サムネイル生成に失敗しました (gallery {gallery_id}): {e}")
+        return None
+    finally:
+        metrics.observe("thumbnail_ms", (time.time() - start) * 1000, type=asset_type)
+
+
+_tasks: Set[asyncio.Task] = set()
+
+
+def schedule(
+    gallery_id: Optional[int], asset_url: str, asset_type: str, data: Optional[bytes] = None
+) -> None:
+    """生成ジョブの応答を待たせないよう、派生物は裏で作る。"""
+    if not gallery_id or not asset_url:
+        return
+    task = asyncio.create_task(generate(gallery_id, asset_url, asset_type, data))
+    # タスクへの参照を保持して GC で消えないようにする
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
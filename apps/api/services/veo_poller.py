@@ -0,0 +1,199 @@
+"""Veo の長時間オペレーション（predictLongRunning）を1本のタスクでまとめて監視するポーラー。
+
+- 未完了のオペレーションをすべて1つのループで管理し、期限が来たものを同じ周回でまとめて
+  fetchPredictOperation する（同時数は POLL_CONCURRENCY まで）。待つ側は Future を await するだけ
+- 間隔は適応的: 最初の確認は直近の完了所要時間の中央値の8割（統計が無ければ FIRST_POLL_S）まで待ち、
+  以降は MIN_INTERVAL_S から倍々で MAX_INTERVAL_S まで伸ばす
+- HTTP クライアントは接続プール付きの1つを使い回し、ADC のトークンは期限が近づいたときだけ更新する
+- メトリクス: veo_poll_requests_total{result}, veo_outstanding_ops, veo_operation_ms
+"""
+import asyncio
+import os
+import statistics
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import timezone
+from typing import TYPE_CHECKING, Deque, Dict, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from . import metrics
+
+if TYPE_CHECKING:
+    import httpx
+
+FIRST_POLL_S = float(os.getenv("VEO_FIRST_POLL_S", "20"))
+MIN_INTERVAL_S = float(os.getenv("VEO_MIN_POLL_INTERVAL_S", "3"))
+MAX_INTERVAL_S = float(os.getenv("VEO_MAX_POLL_INTERVAL_S", "15"))
+POLL_CONCURRENCY = int(os.getenv("VEO_POLL_CONCURRENCY", "8"))
+# 連続してこの回数だけ確認に失敗したオペレーションは諦める
+MAX_POLL_ERRORS = 5
+# トークンの期限がこの秒数以内なら更新する
+TOKEN_REFRESH_MARGIN_S = 300
+
+
+class VeoPollError(RuntimeError):
+    pass
+
+
+class _Credentials:
+    """ADC のトークンをキャッシュし、期限が近いときだけ更新する（API キー利用時は何もしない）。"""
+
+    def __init__(self):
+        self._creds = None
+        self._lock = asyncio.Lock()
+
+    def _refresh(self) -> None:
+        import google.auth
+        import google.auth.transport.requests
+
+        if self._creds is None:
+            self._creds, _ = google.auth.default(
+                scopes=["https://www.googleapis.com/auth/cloud-platform"]
+            )
+        self._creds.refresh(google.auth.transport.requests.Request())
+
+    def _fresh(self) -> bool:
+        c = self._creds
+        if c is None or not c.token:
+            return False
+        expiry = getattr(c, "expiry", None)
+        if expiry is None:
+            return True
+        # google-auth の expiry は naive UTC
+        return expiry.replace(tzinfo=timezone.utc).timestamp() - time.time() > TOKEN_REFRESH_MARGIN_S
+
+    async def headers(self) -> Tuple[dict, dict]:
+        """(headers, params) を返す。"""
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if api_key:
+            return {}, {"key": api_key}
+        if not self._fresh():
+            async with self._lock:
+                if not self._fresh():
+                    try:
+                        await run_in_threadpool(self._refresh)
+                    except Exception as e:
+                        print(f"ADC トークンの取得に失敗しました: {e}")
+                        return {}, {}
+        return {"Authorization": f"Bearer {self._creds.token}"}, {}
+
+
+@dataclass
+class _Op:
+    op_url: str
+    name: str
+    future: asyncio.Future
+    started: float = field(default_factory=time.monotonic)
+    next_at: float = 0.0
+    interval: float = MIN_INTERVAL_S
+    errors: int = 0
+
+
+class VeoPoller:
+    def __init__(self):
+        self._creds = _Credentials()
+        self._client: Optional["httpx.AsyncClient"] = None
+        self._ops: Dict[str, _Op] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._durations: Deque[float] = deque(maxlen=50)
+
+    def _http(self) -> "httpx.AsyncClient":
+        if self._client is None or self._client.is_closed:
+            import httpx
+
+            self._client = httpx.AsyncClient(
+                timeout=60, limits=httpx.Limits(max_connections=POLL_CONCURRENCY * 2)
+            )
+        return self._client
+
+    async def post(self, url: str, body: dict) -> "httpx.Response":
+        headers, params = await self._creds.headers()
+        return await self._http().post(url, headers=headers, params=params, json=body)
+
+    def _first_delay(self) -> float:
+        if len(self._durations) >= 3:
+            return max(MIN_INTERVAL_S, 0.8 * statistics.median(self._durations))
+        return FIRST_POLL_S
+
+    async def wait(self, op_url: str, name: str, timeout_s: float) -> dict:
+        """オペレーションの完了（done=True の応答）を待って返す。"""
+        loop = asyncio.get_running_loop()
+        op = _Op(op_url=op_url, name=name, future=loop.create_future())
+        op.next_at = op.started + self._first_delay()
+        self._ops[name] = op
+        metrics.set_gauge("veo_outstanding_ops", len(self._ops))
+        self._ensure_running()
+        try:
+            return await asyncio.wait_for(asyncio.shield(op.future), timeout=timeout_s)
+        finally:
+            self._ops.pop(name, None)
+            metrics.set_gauge("veo_outstanding_ops", len(self._ops))
+
+    def _ensure_running(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    async def _poll(self, op: _Op, sem: asyncio.Semaphore) -> None:
+        async with sem:
+            try:
+                r = await self.post(op.op_url, {"operationName": op.name})
+                if r.status_code >= 300:
+                    raise VeoPollError(f"Veo poll error: {r.text[:200]}")
+                od = r.json()
+            except Exception as e:
+                metrics.inc("veo_poll_requests_total", result="error")
+                op.errors += 1
+                if op.errors >= MAX_POLL_ERRORS and not op.future.done():
+                    op.future.set_exception(
+                        e if isinstance(e, VeoPollError) else VeoPollError(str(e))
+                    )
+                op.next_at = time.monotonic() + op.interval
+                return
+        op.errors = 0
+        if od.get("done"):
+            metrics.inc("veo_poll_requests_total", result="done")
+            elapsed = time.monotonic() - op.started
+            self._durations.append(elapsed)
+            metrics.observe("veo_operation_ms", elapsed * 1000)
+            if not op.future.done():
+                op.future.set_result(od)
+            return
+        metrics.inc("veo_poll_requests_total", result="pending")
+        op.next_at = time.monotonic() + op.interval
+        op.interval = min(MAX_INTERVAL_S, op.interval * 2)
+
+    async def _run(self) -> None:
+        sem = asyncio.Semaphore(POLL_CONCURRENCY)
+        while self._ops:
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = [
+                op for op in self._ops.values() if op.next_at <= now and not op.future.done()
+            ]
+            if due:
+                # 期限が来たものを同じ周回でまとめて確認する
+                await asyncio.gather(*(self._poll(op, sem) for op in due))
+                continue
+            pending = [op.next_at for op in self._ops.values() if not op.future.done()]
+            sleep_s = max(0.0, min(pending) - now) if pending else MAX_INTERVAL_S
+            try:
+                # 新しいオペレーションが来たら起きて予定を組み直す
+                await asyncio.wait_for(self._wakeup.wait(), timeout=sleep_s)
+            except asyncio.TimeoutError:
+                pass
+
+    async def aclose(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+poller = VeoPoller()
@@ -0,0 +1,41 @@
+"""生成ジョブ専用のワーカープロセス。
+
+API とは別に起動し、generation_jobs から `FOR UPDATE SKIP LOCKED` でジョブを取り出して実行する。
+インスタンスを増やせばそのまま並列度が上がる（API 側は GENERATION_WORKERS=0 にしてもよい）。
+
+起動:
+  python -m apps.api.worker --concurrency 4
+"""
+import argparse
+import asyncio
+import signal
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from .routers.v1 import generate  # noqa: E402,F401  ハンドラ登録のため
+from .services import generation_queue, log_writer, thumbnails, veo_poller  # noqa: E402
+
+
+async def main(concurrency: int) -> None:
+    log_writer.start_all()
+    worker = generation_queue.Worker(concurrency)
+    worker.start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    print("stopping generation worker...")
+    await worker.stop()
+    await veo_poller.poller.aclose()
+    thumbnails.shutdown()
+    await log_writer.stop_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generation job worker")
+    parser.add_argument("--concurrency", type=int, default=generation_queue.WORKERS or 2)
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency))
@@ -190,6 +190,18 @@ CREATE TABLE IF NOT EXISTS generation_jobs (
 
 CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs (status, created_at);
 
+-- ジョブキュー用: ワーカーの生存確認（heartbeat_at）・取得したワーカー・失敗理由
+DO $$ BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_schema = 'public' AND table_name='generation_jobs' AND column_name='heartbeat_at'
+  ) THEN
+    EXECUTE 'ALTER TABLE generation_jobs ADD COLUMN heartbeat_at TIMESTAMP';
+    EXECUTE 'ALTER TABLE generation_jobs ADD COLUMN worker_id VARCHAR(64)';
+    EXECUTE 'ALTER TABLE generation_jobs ADD COLUMN error TEXT';
+  END IF;
+END $$ LANGUAGE plpgsql;
+
 -- Translations (per-user, per-paragraph modern translation)
 CREATE TABLE IF NOT EXISTS translations (
     id SERIAL PRIMARY KEY,
@@ -205,6 +217,80 @@ CREATE INDEX IF NOT EXISTS idx_translations_user_book ON translations (user_id,
 
 CREATE UNIQUE INDEX IF NOT EXISTS uniq_translations_user_para ON translations (user_id, para_id);
 
+-- Shared paragraph translation cache (reused across users; filled by /v1/translate and the pre-translation batch)
+CREATE TABLE IF NOT EXISTS paragraph_translations (
+    para_id INTEGER PRIMARY KEY REFERENCES paragraphs (id) ON DELETE CASCADE,
+    book_id INTEGER NOT NULL REFERENCES books (id) ON DELETE CASCADE,
+    text TEXT NOT NULL,
+    model VARCHAR(128),
+    prompt_version VARCHAR(32),
+    created_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_paragraph_translations_book ON paragraph_translations (book_id);
+
+-- Precomputed answers to canned questions (e.g. 「本書の背景を説明して」); filled by the batch and refreshed by /v1/qa
+CREATE TABLE IF NOT EXISTS canned_answers (
+    book_id INTEGER NOT NULL REFERENCES books (id) ON DELETE CASCADE,
+    question_key VARCHAR(64) NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    model VARCHAR(128),
+    prompt_version VARCHAR(32),
+    created_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (book_id, question_key)
+);
+
+-- Scene prompts / detected characters for image & video generation, keyed by the selected text.
+-- characters_version is a hash of books.characters, so rewriting the character list invalidates old rows
+CREATE TABLE IF NOT EXISTS scene_prompts (
+    book_id INTEGER NOT NULL REFERENCES books (id) ON DELETE CASCADE,
+    text_hash CHAR(64) NOT NULL,
+    characters_version VARCHAR(16) NOT NULL,
+    prompt TEXT NOT NULL,
+    character_names JSONB NOT NULL DEFAULT '[]'::jsonb,
+    model VARCHAR(128),
+    prompt_version VARCHAR(32),
+    created_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (book_id, text_hash, characters_version)
+);
+
+-- Characters mentioned in each paragraph, matched offline against books.characters (names and aliases).
+-- ambiguous = an alias matched several characters (e.g. 李徴（人間）/李徴（虎）); generation falls back to the LLM
+CREATE TABLE IF NOT EXISTS paragraph_characters (
+    para_id INTEGER PRIMARY KEY REFERENCES paragraphs (id) ON DELETE CASCADE,
+    book_id INTEGER NOT NULL REFERENCES books (id) ON DELETE CASCADE,
+    character_names JSONB NOT NULL DEFAULT '[]'::jsonb,
+    ambiguous BOOLEAN NOT NULL DEFAULT FALSE,
+    characters_version VARCHAR(16) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_paragraph_characters_book ON paragraph_characters (book_id);
+
+-- Reusable generation results (opt-in dedup). dedup_key = hash of (type, book, normalized text, template version, params).
+-- shared_count = number of users whose gallery links this asset (capped by GENERATION_DEDUP_MAX_SHARES)
+CREATE TABLE IF NOT EXISTS generation_assets (
+    dedup_key CHAR(64) PRIMARY KEY,
+    job_type VARCHAR(16) NOT NULL, -- image | video
+    book_id INTEGER REFERENCES books (id) ON DELETE CASCADE,
+    asset_url VARCHAR(1024) NOT NULL,
+    result JSONB NOT NULL,
+    gallery_id INTEGER REFERENCES gallery (id) ON DELETE SET NULL,
+    shared_count INTEGER NOT NULL DEFAULT 1,
+    created_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+-- Per-user daily usage of expensive features (image | video), counted at admission.
+-- day is the local date in QUOTA_TZ; failed generation jobs are refunded
+CREATE TABLE IF NOT EXISTS usage_counters (
+    user_id VARCHAR(128) NOT NULL,
+    feature VARCHAR(32) NOT NULL,
+    day DATE NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_id, feature, day)
+);
+
 -- updated_at auto-update triggers (reading_progress, generation_jobs)
 CREATE OR REPLACE FUNCTION set_updated_at() RETURNS TRIGGER AS $$
 BEGIN
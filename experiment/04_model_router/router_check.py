@@ -0,0 +1,97 @@
+"""
+代替モデルサーバー（stub_model_server.py）に遅延・エラーを注入し、
+apps/api/services/model_router.py のフォールバック・サーキットブレーカー・締め切りを確認する。
+
+実行:
+  python experiment/04_model_router/router_check.py
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+
+# 確認を速く回すため、判定条件を小さくしてから読み込む
+os.environ.setdefault("MODEL_ROUTER_OPEN_SECONDS", "2")
+os.environ.setdefault("MODEL_ROUTER_CONSECUTIVE_FAILURES", "3")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.append(os.path.dirname(__file__))
+
+from apps.api.services import model_router  # noqa: E402
+from stub_model_server import serve  # noqa: E402
+
+PORT = 8089
+BASE = f"http://127.0.0.1:{PORT}"
+
+
+def _post(path: str, body: dict, timeout: float = 30) -> dict:
+    req = urllib.request.Request(
+        BASE + path,
+        data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req, timeout=timeout) as r:
+        return json.loads(r.read())
+
+
+def configure(**body) -> None:
+    _post("/_config", body)
+
+
+async def call_model(model: str) -> str:
+    resp = await asyncio.to_thread(
+        _post,
+        f"/v1beta/models/{model}:generateContent",
+        {"contents": [{"role": "user", "parts": [{"text": "質問"}]}]},
+    )
+    return resp["candidates"][0]["content"]["parts"][0]["text"]
+
+
+async def ask(label: str, deadline_s: float = 10.0) -> None:
+    t0 = time.time()
+    try:
+        _, model = await model_router.arun("qa", call_model, deadline_s=deadline_s)
+        result = model
+    except model_router.AllModelsFailed as e:
+        result = f"FAILED ({e})"
+    states = {m: s["state"] for m, s in model_router.health.snapshot().items()}
+    print(f"{label:<40} -> {result:<24} {int((time.time() - t0) * 1000):>6} ms  {states}")
+
+
+async def main():
+    serve(PORT)
+    print("policy qa:", model_router.POLICIES["qa"].models)
+
+    configure(latency_ms={"gemini-2.5-pro": 300, "gemini-2.5-flash": 100, "gemini-2.5-flash-lite": 50})
+    await ask("healthy")
+
+    configure(error_rate={"gemini-2.5-pro": 1.0})
+    for i in range(4):
+        await ask(f"pro erroring #{i + 1}")
+
+    print("...wait for half-open")
+    await asyncio.sleep(2.1)
+    configure(error_rate={"gemini-2.5-pro": 0.0})
+    await ask("pro recovered (half-open probe)")
+    await ask("after recovery")
+
+    configure(latency_ms={"gemini-2.5-pro": 5000})
+    await ask("pro slow, deadline 3s", deadline_s=3.0)
+
+    configure(
+        latency_ms={"gemini-2.5-pro": 300},
+        error_rate={"gemini-2.5-pro": 1.0, "gemini-2.5-flash": 1.0, "gemini-2.5-flash-lite": 1.0},
+    )
+    await ask("everything down")
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except urllib.error.URLError as e:
+        print(f"stub server error: {e}", file=sys.stderr)
@@ -0,0 +1,162 @@
+"""
+Gemini API（generateContent / streamGenerateContent）の代わりに応答するローカルのモデルサーバー。
+モデルごとに遅延とエラー率、毎分のクォータ（超えると 429 RESOURCE_EXHAUSTED）を注入でき、
+ルーター・リトライ・スケジューラの挙動確認に使う。
+
+起動:
+  python experiment/04_model_router/stub_model_server.py --port 8089 \
+      --latency gemini-2.5-pro=8000,gemini-2.5-flash=800 --error-rate gemini-2.5-pro=0.5 \
+      --rpm gemini-2.5-flash=120
+
+API から使う場合は GENAI_BASE_URL=http://127.0.0.1:8089 を設定して起動する。
+実行中の設定変更: POST /_config {"latency_ms": {"gemini-2.5-pro": 0}, "error_rate": {...}, "rpm": {...}}
+（クォータの窓は "quota_window_s" で短くできる。既定60秒）
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from typing import Deque, Dict
+
+_lock = threading.Lock()
+CONFIG: Dict[str, Dict[str, float]] = {"latency_ms": {}, "error_rate": {}, "rpm": {}}
+QUOTA_WINDOW_S = {"value": 60.0}
+CALLS: Dict[str, int] = {}
+REJECTED: Dict[str, int] = {}
+_recent: Dict[str, Deque[float]] = {}
+
+_PATH = re.compile(r"/models/([^/:]+):(generateContent|streamGenerateContent)")
+
+
+def _parse_pairs(raw: str) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for item in (raw or "").split(","):
+        if "=" in item:
+            k, v = item.split("=", 1)
+            out[k.strip()] = float(v)
+    return out
+
+
+def _response(model: str, text: str) -> dict:
+    return {
+        "candidates": [
+            {"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}
+        ],
+        "usageMetadata": {
+            "promptTokenCount": 100,
+            "candidatesTokenCount": len(text),
+            "totalTokenCount": 100 + len(text),
+        },
+        "modelVersion": model,
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):  # 静かにする
+        pass
+
+    def _json(self, status: int, body: dict) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _over_quota(self, model: str) -> bool:
+        # 直近 QUOTA_WINDOW_S 秒に受け付けた数（窓の長さに合わせて rpm を按分）
+        limit = CONFIG["rpm"].get(model)
+        if not limit:
+            return False
+        window = QUOTA_WINDOW_S["value"]
+        now = time.monotonic()
+        q = _recent.setdefault(model, deque())
+        while q and q[0] <= now - window:
+            q.popleft()
+        if len(q) >= max(1, limit * window / 60.0):
+            REJECTED[model] = REJECTED.get(model, 0) + 1
+            return True
+        q.append(now)
+        return False
+
+    def do_GET(self):
+        if self.path.startswith("/_stats"):
+            with _lock:
+                return self._json(200, {"calls": CALLS, "rejected": REJECTED, **CONFIG})
+        self._json(404, {"error": {"code": 404, "message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.startswith("/_config"):
+            with _lock:
+                for key in ("latency_ms", "error_rate", "rpm"):
+                    CONFIG[key].update(body.get(key) or {})
+                if body.get("quota_window_s"):
+                    QUOTA_WINDOW_S["value"] = float(body["quota_window_s"])
+                if body.get("reset_calls"):
+                    CALLS.clear()
+                    REJECTED.clear()
+                    _recent.clear()
+            return self._json(200, CONFIG)
+        m = _PATH.search(self.path)
+        if not m:
+            return self._json(404, {"error": {"code": 404, "message": "not found"}})
+        model, method = m.group(1), m.group(2)
+        with _lock:
+            CALLS[model] = CALLS.get(model, 0) + 1
+            latency = CONFIG["latency_ms"].get(model, 50.0)
+            error_rate = CONFIG["error_rate"].get(model, 0.0)
+            over_quota = self._over_quota(model)
+        if over_quota:
+            return self._json(
+                429,
+                {"error": {"code": 429, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED"}},
+            )
+        time.sleep(latency / 1000)
+        if random.random() < error_rate:
+            return self._json(
+                503, {"error": {"code": 503, "message": "injected error", "status": "UNAVAILABLE"}}
+            )
+        text = f"[{model}] 応答です。"
+        if method == "generateContent":
+            return self._json(200, _response(model, text))
+        # streamGenerateContent?alt=sse
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for ch in (text[: len(text) // 2], text[len(text) // 2 :]):
+            self.wfile.write(f"data: {json.dumps(_response(model, ch), ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(0.05)
+
+
+def serve(port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in model server")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", default="", help="model=ms,...")
+    parser.add_argument("--error-rate", default="", help="model=rate,...")
+    parser.add_argument("--rpm", default="", help="model=requests_per_minute,...")
+    args = parser.parse_args()
+    CONFIG["latency_ms"].update(_parse_pairs(args.latency))
+    CONFIG["error_rate"].update(_parse_pairs(args.error_rate))
+    CONFIG["rpm"].update(_parse_pairs(args.rpm))
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    print(f"stub model server on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
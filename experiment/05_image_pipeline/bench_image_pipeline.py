@@ -0,0 +1,93 @@
+"""
+生成画像をアップロード・Veo に渡すまでの経路のメモリとレイテンシを比較する。
+
+- before: PIL でデコード → /tmp に PNG で再エンコード → Veo 用に読み直して base64（旧実装）
+- after : モデルが返したバイト列をそのまま upload / base64（assets.Blob）
+
+モデル出力の代わりに、Nano Banana の出力と同程度（1024x1024 の PNG）の画像を作って使う。
+--bucket を指定すると実際に GCS へのアップロードも計測する（before は毎回 storage.Client() を作る）。
+
+実行:
+  python experiment/05_image_pipeline/bench_image_pipeline.py --runs 20
+  python experiment/05_image_pipeline/bench_image_pipeline.py --runs 5 --bucket <ASSETS_BUCKET>
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import uuid
+from io import BytesIO
+from typing import Callable, Optional
+
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def sample_png(size: int = 1024) -> bytes:
+    # 単色だと圧縮が効きすぎるのでノイズを混ぜる
+    img = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def before(data: bytes, bucket: Optional[str]) -> int:
+    local_path = f"/tmp/{uuid.uuid4().hex}.png"
+    image = Image.open(BytesIO(data))
+    image.save(local_path)
+    if bucket:
+        from google.cloud import storage
+
+        storage.Client().bucket(bucket).blob(f"bench/{os.path.basename(local_path)}").upload_from_filename(local_path)
+    with open(local_path, "rb") as f:
+        encoded = base64.b64encode(f.read()).decode("utf-8")
+    # 旧実装は shutil.rmtree(ファイル) で消えていなかった。計測を繰り返せるようここでは消す
+    os.remove(local_path)
+    return len(encoded)
+
+
+def after(data: bytes, bucket: Optional[str]) -> int:
+    from apps.api.services import assets
+
+    blob = assets.Blob(data, "image/png")
+    if bucket:
+        assets.upload_bytes(blob.data, f"bench/{uuid.uuid4().hex}.{blob.extension}", blob.mime_type, bucket)
+    encoded = base64.b64encode(blob.data).decode("utf-8")
+    return len(encoded)
+
+
+def measure(label: str, fn: Callable[[bytes, Optional[str]], int], data: bytes, runs: int, bucket: Optional[str]) -> None:
+    times, peaks = [], []
+    for _ in range(runs):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        fn(data, bucket)
+        times.append((time.perf_counter() - t0) * 1000)
+        peaks.append(tracemalloc.get_traced_memory()[1] / 1024 / 1024)
+        tracemalloc.stop()
+    print(
+        f"{label:<7} p50 {statistics.median(times):8.1f} ms  max {max(times):8.1f} ms  "
+        f"peak alloc {statistics.median(peaks):6.1f} MiB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Image pipeline memory/latency bench")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--bucket", default=None)
+    args = parser.parse_args()
+    data = sample_png(args.size)
+    print(f"image: {args.size}x{args.size} PNG, {len(data) / 1024 / 1024:.1f} MiB")
+    measure("before", before, data, args.runs, args.bucket)
+    measure("after", after, data, args.runs, args.bucket)
+
+
+if __name__ == "__main__":
+    main()
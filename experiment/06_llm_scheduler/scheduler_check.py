@@ -0,0 +1,208 @@
+"""
+代替モデルサーバー（experiment/04_model_router/stub_model_server.py）に対して
+apps/api/services/llm_scheduler.py を動かし、スループット・優先度・公平性・batch の後退を確認する。
+
+- 負荷: batch（前処理相当）のスレッド群、連打するユーザー1人、ときどき聞く軽いユーザー数人
+- 比較: 全員を同じクラス・同じユーザーに入れた場合（＝素の FIFO）と待ち時間を並べる
+- クォータ: サーバー側の上限をスケジューラの配分より低くし、429 で batch だけが止まることを見る
+
+実行:
+  python experiment/06_llm_scheduler/scheduler_check.py
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+# 確認を速く回すため、バケットと後退時間を小さくしてから読み込む
+os.environ.setdefault("LLM_BURST_S", "1")
+os.environ.setdefault("LLM_BATCH_BACKOFF_BASE_S", "1")
+os.environ.setdefault("LLM_BATCH_BACKOFF_MAX_S", "4")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "04_model_router"))
+
+from apps.api.services import llm_scheduler  # noqa: E402
+from stub_model_server import serve  # noqa: E402
+
+PORT = 8090
+BASE = f"http://127.0.0.1:{PORT}"
+MODEL = "gemini-2.5-flash"
+RPM = 600  # 10 req/s
+RUN_S = 8.0
+
+
+def _post(path: str, body: dict, timeout: float = 30) -> dict:
+    req = urllib.request.Request(
+        BASE + path,
+        data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req, timeout=timeout) as r:
+        return json.loads(r.read())
+
+
+def configure_stub(**body) -> None:
+    _post("/_config", body)
+
+
+def call_model() -> None:
+    try:
+        _post(
+            f"/v1beta/models/{MODEL}:generateContent",
+            {"contents": [{"role": "user", "parts": [{"text": "質問"}]}]},
+        )
+    except urllib.error.HTTPError as e:
+        llm_scheduler.report(MODEL, e)
+        raise
+    llm_scheduler.report(MODEL)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waits = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, who: str, wait_s: float, ok: bool) -> None:
+        with self.lock:
+            self.waits[who].append(wait_s * 1000)
+            if not ok:
+                self.errors[who] += 1
+
+    def print(self, label: str) -> None:
+        print(f"--- {label}")
+        for who in sorted(self.waits):
+            w = sorted(self.waits[who])
+            p95 = w[min(len(w) - 1, int(len(w) * 0.95))]
+            print(
+                f"  {who:<10} calls={len(w):>4} ({len(w) / RUN_S:5.1f}/s) errors={self.errors[who]:>3}"
+                f"  wait p50={statistics.median(w):7.0f}ms p95={p95:7.0f}ms"
+            )
+
+
+def batch_worker(stats: Stats, stop: threading.Event, priority: str, user: str) -> None:
+    while not stop.is_set():
+        t0 = time.monotonic()
+        try:
+            llm_scheduler.acquire(MODEL, priority, user, timeout=RUN_S)
+        except llm_scheduler.resilience.DeadlineExceeded:
+            continue
+        wait = time.monotonic() - t0
+        try:
+            call_model()
+            stats.add("batch", wait, True)
+        except urllib.error.HTTPError:
+            stats.add("batch", wait, False)
+
+
+async def interactive(stats: Stats, who: str, priority: str, user: str, count: int, gap_s: float):
+    for _ in range(count):
+        t0 = time.monotonic()
+        await llm_scheduler.aacquire(MODEL, priority, user, timeout=RUN_S * 2)
+        wait = time.monotonic() - t0
+        try:
+            await asyncio.to_thread(call_model)
+            stats.add(who, wait, True)
+        except urllib.error.HTTPError:
+            stats.add(who, wait, False)
+        await asyncio.sleep(gap_s)
+
+
+async def scenario(label: str, fair: bool) -> None:
+    llm_scheduler.configure(rpm={MODEL: RPM})
+    stats = Stats()
+    stop = threading.Event()
+
+    def who(priority: str, user: str):
+        # fair=False は全員を同じ待ち行列に入れる（素の FIFO）
+        return (priority, user) if fair else (llm_scheduler.INTERACTIVE, "-")
+
+    threads = [
+        threading.Thread(target=batch_worker, args=(stats, stop, *who(llm_scheduler.BATCH, "batch")))
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    t0 = time.monotonic()
+    tasks = [
+        # 連打するユーザー（同時に12本を投げ続ける）
+        *[
+            interactive(stats, "heavy", *who(llm_scheduler.INTERACTIVE, "heavy"), 10**6, 0)
+            for _ in range(12)
+        ],
+        # ときどき聞くユーザー
+        *[
+            interactive(stats, f"light{i}", *who(llm_scheduler.INTERACTIVE, f"light{i}"), 10**6, 0.5)
+            for i in range(3)
+        ],
+    ]
+    try:
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=RUN_S)
+    except asyncio.TimeoutError:
+        pass
+    stop.set()
+    for t in threads:
+        t.join()
+    stats.print(f"{label} ({time.monotonic() - t0:.1f}s, budget {RPM / 60:.0f}/s)")
+
+
+async def batch_after_interactive() -> None:
+    """interactive が止んだら batch が配分いっぱいまで戻るか（飢餓が続かないこと）。"""
+    llm_scheduler.configure(rpm={MODEL: RPM})
+    stats = Stats()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=batch_worker, args=(stats, stop, llm_scheduler.BATCH, "batch"))
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                *[interactive(stats, "heavy", llm_scheduler.INTERACTIVE, "heavy", 10**6, 0) for _ in range(12)]
+            ),
+            timeout=RUN_S / 2,
+        )
+    except asyncio.TimeoutError:
+        pass
+    during = len(stats.waits["batch"])
+    await asyncio.sleep(RUN_S / 2)
+    stop.set()
+    for t in threads:
+        t.join()
+    after = len(stats.waits["batch"]) - during
+    print("--- batch after interactive stops")
+    print(f"  batch calls while heavy user active: {during}, after: {after} ({after / (RUN_S / 2):.1f}/s)")
+
+
+async def main():
+    serve(PORT)
+    configure_stub(latency_ms={MODEL: 100}, reset_calls=True)
+
+    await scenario("FIFO (no priority / fairness)", fair=False)
+    await scenario("scheduler (priority + per-user round robin)", fair=True)
+    await batch_after_interactive()
+
+    # サーバー側の上限を配分の半分にする → 429 が出て batch だけが止まる
+    configure_stub(rpm={MODEL: RPM / 2}, quota_window_s=1, reset_calls=True)
+    await scenario("server quota at half the budget", fair=True)
+    stub = json.loads(urllib.request.urlopen(BASE + "/_stats").read())
+    print(f"  server: accepted={stub['calls'].get(MODEL, 0) - stub['rejected'].get(MODEL, 0)} "
+          f"rejected={stub['rejected'].get(MODEL, 0)}")
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except urllib.error.URLError as e:
+        print(f"stub server error: {e}", file=sys.stderr)
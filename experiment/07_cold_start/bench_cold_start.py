@@ -0,0 +1,135 @@
+"""
+API コンテナのコールドスタートを計測する。
+
+- importtime: `python -X importtime -c "import apps.api.main"` を流し、読み込みの重いパッケージを
+  累積時間の順に並べる（--report に生の出力を保存）
+- startup   : uvicorn を --runs 回起動し直し、プロセス開始から /healthz が 200 を返すまでの時間と、
+  GET /healthz/startup の段階ごとの時刻（imports, warmup.*, ready）の中央値を出す。
+  --compare-warmup で WARMUP=1 と WARMUP=0 を並べる
+
+DB などの接続先は .env の設定をそのまま使う（ウォームアップが失敗しても起動は続く）。
+
+実行:
+  python experiment/07_cold_start/bench_cold_start.py importtime --top 25 --report /tmp/importtime.txt
+  python experiment/07_cold_start/bench_cold_start.py startup --runs 5 --compare-warmup
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+PORT = 8091
+MAIN_MODULE = "apps.api.main"
+
+
+def importtime(top: int, report: Optional[str]) -> None:
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MAIN_MODULE}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    lines = [l for l in proc.stderr.splitlines() if l.startswith("import time:")]
+    if report:
+        with open(report, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:], file=sys.stderr)
+        sys.exit(proc.returncode)
+    # (self, cumulative, 字下げの深さ, モジュール名)。子は親より先に出力される
+    rows = []
+    for line in lines[1:]:
+        parts = line.split("|")
+        raw = parts[2]
+        depth = (len(raw) - len(raw.lstrip()) - 1) // 2
+        rows.append((int(parts[0].split(":")[1]), int(parts[1]), depth, raw.strip()))
+    total = sum(r[0] for r in rows)
+    self_us: Dict[str, int] = defaultdict(int)
+    for self_v, _, _, module in rows:
+        self_us[module.split(".")[0]] += self_v
+    # main が直接 import したもの（main より1段深い行）の cumulative
+    main_depth = next((d for _, _, d, m in rows if m == MAIN_MODULE), 0)
+    cumulative_us: Dict[str, int] = {}
+    for _, cum_v, depth, module in rows:
+        if depth == main_depth + 1:
+            cumulative_us[module] = max(cumulative_us.get(module, 0), cum_v)
+    print(f"total import time: {total / 1000:.0f} ms ({len(lines) - 1} modules)")
+    print(f"--- top {top} packages by self time")
+    for package, us in sorted(self_us.items(), key=lambda kv: -kv[1])[:top]:
+        print(f"  {package:<32} {us / 1000:8.1f} ms")
+    print(f"--- top {top} imports made by {MAIN_MODULE} (cumulative)")
+    for module, us in sorted(cumulative_us.items(), key=lambda kv: -kv[1])[:top]:
+        print(f"  {module:<48} {us / 1000:8.1f} ms")
+
+
+def _get(path: str, timeout: float = 1.0) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{PORT}{path}", timeout=timeout) as r:
+        return json.loads(r.read())
+
+
+def start_once(warmup: bool, timeout_s: float = 60) -> Dict[str, float]:
+    env = {**os.environ, "WARMUP": "1" if warmup else "0", "GENERATION_WORKERS": "0"}
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "apps.api.main:app", "--port", str(PORT), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with {proc.returncode}")
+            if time.perf_counter() - t0 > timeout_s:
+                raise RuntimeError("server did not become ready")
+            try:
+                _get("/healthz", timeout=0.5)
+                break
+            except (urllib.error.URLError, ConnectionError, OSError):
+                time.sleep(0.02)
+        out = {"healthz": (time.perf_counter() - t0) * 1000}
+        for e in _get("/healthz/startup")["timeline"]:
+            out[e["phase"]] = e.get("took_ms", e["at_ms"]) if e["phase"].startswith("warmup") else e["at_ms"]
+        return out
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def startup(runs: int, warmup: bool) -> None:
+    results: List[Dict[str, float]] = [start_once(warmup) for _ in range(runs)]
+    print(f"--- startup (WARMUP={int(warmup)}, runs={runs}): median / max ms")
+    phases = [p for p in results[0]]
+    for p in phases:
+        values = [r[p] for r in results if p in r]
+        label = f"{p} (took)" if p.startswith("warmup") else p
+        print(f"  {label:<24} {statistics.median(values):8.0f} {max(values):8.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for the API container")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_imp = sub.add_parser("importtime")
+    p_imp.add_argument("--top", type=int, default=25)
+    p_imp.add_argument("--report", default=None, help="Write the raw -X importtime output here")
+    p_start = sub.add_parser("startup")
+    p_start.add_argument("--runs", type=int, default=5)
+    p_start.add_argument("--compare-warmup", action="store_true")
+    args = parser.parse_args()
+    if args.cmd == "importtime":
+        importtime(args.top, args.report)
+    else:
+        startup(args.runs, warmup=True)
+        if args.compare_warmup:
+            startup(args.runs, warmup=False)
@@ -0,0 +1,120 @@
+"""
+本文 HTML（web/books_html）の転送量と、最初の段落が表示できるまでの時間の見積もり。
+
+- 事前圧縮版（preprocessing/14_precompress_books_html.py の出力）のサイズを、大きい本から --top 冊並べる
+- 最初の段落までの時間 = RTT + 転送（サイズ / 帯域）+ 展開。本全体の HTML は全部受け取ってから描画する。
+  分割（seg）は目次の JSON と、続きを含む分割1つ（ここでは真ん中）を順に受け取った時点。
+  展開はこのマシンで実測（ブラウザの展開もほぼ同じ桁）
+- 回線は --profiles で指定（名前=Mbps:RTTms）
+
+実行:
+  python preprocessing/14_precompress_books_html.py
+  python experiment/08_books_html/bench_books_html.py --top 8
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import os
+import sys
+import time
+from typing import Callable, Dict, Optional
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from apps.api.services import book_files  # noqa: E402
+
+
+def _decoders() -> Dict[Optional[str], Callable[[bytes], bytes]]:
+    out: Dict[Optional[str], Callable[[bytes], bytes]] = {None: lambda b: b, "gzip": gzip.decompress}
+    try:
+        import brotli  # type: ignore
+
+        out["br"] = brotli.decompress
+    except ImportError:
+        pass
+    return out
+
+
+def decode_ms(data: bytes, decode: Callable[[bytes], bytes], runs: int = 3) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        decode(data)
+        best = min(best, (time.perf_counter() - t0) * 1000)
+    return best
+
+
+def parse_profiles(raw: str) -> Dict[str, tuple]:
+    out = {}
+    for item in raw.split(","):
+        name, _, spec = item.partition("=")
+        mbps, _, rtt = spec.partition(":")
+        out[name.strip()] = (float(mbps), float(rtt or 0))
+    return out
+
+
+def _load(path, encoding) -> bytes:
+    return (path.with_name(path.name + dict(book_files.ENCODINGS)[encoding]) if encoding else path).read_bytes()
+
+
+def main(top: int, profiles: Dict[str, tuple]) -> None:
+    books = book_files._books()
+    if not books:
+        sys.exit("dist/manifest.json がありません。先に preprocessing/14_precompress_books_html.py を実行してください")
+    decoders = _decoders()
+    best = next((e for e, _ in book_files.ENCODINGS if e in decoders), None)
+    encodings = [None] + [e for e, _ in book_files.ENCODINGS if e in decoders]
+    largest = sorted(books.items(), key=lambda kv: -kv[1]["size"])[:top]
+    # 分割: 目次（segments.json）を読んでから、続きを含む分割（ここでは真ん中）を1つ読む
+    cols = [e or "raw" for e in encodings] + ["seg"]
+    head = f"{'book':<28}" + "".join(f"{c:>9}" for c in cols)
+    for name in profiles:
+        head += "".join(f"{name + ':' + c:>14}" for c in cols)
+    print(f"sizes in KB, time to first paragraph in ms (seg = segments.json + middle segment, {best or 'raw'})")
+    print(head)
+    totals = {c: 0 for c in cols}
+    for slug, entry in largest:
+        base = book_files.DIST_DIR / f"{slug}.{entry['hash']}.html"
+        # (バイト列, 往復回数, 符号化)
+        loads = {e or "raw": ([_load(base, e)] if e is None or e in entry else None, e) for e in encodings}
+        m = book_files.segment_manifest(slug)
+        if m:
+            mid = len(m["segments"]) // 2
+            seg_path = book_files.DIST_DIR / f"{slug}.{entry['hash']}.seg{mid}.html"
+            seg_enc = best if best in m["segments"][mid] else None
+            manifest = (book_files.DIST_DIR / f"{slug}.{entry['hash']}.segments.json").read_bytes()
+            loads["seg"] = ([manifest, _load(seg_path, seg_enc)], seg_enc)
+        else:
+            loads["seg"] = (None, None)
+        row = f"{slug[:26]:<28}"
+        for c in cols:
+            parts, _ = loads[c]
+            if parts is None:
+                row += f"{'-':>9}"
+                continue
+            size = sum(len(p) for p in parts)
+            totals[c] += size
+            row += f"{size / 1024:9.0f}"
+        for mbps, rtt_ms in profiles.values():
+            for c in cols:
+                parts, enc = loads[c]
+                if parts is None:
+                    row += f"{'-':>14}"
+                    continue
+                ms = 0.0
+                for i, data in enumerate(parts):
+                    # 目次の JSON は無圧縮、本文は符号化どおりに展開
+                    decode = decoders[enc] if i == len(parts) - 1 else decoders[None]
+                    ms += rtt_ms + len(data) * 8 / (mbps * 1e6) * 1000 + decode_ms(data, decode)
+                row += f"{ms:14.0f}"
+        print(row)
+    print("total (top books): " + ", ".join(f"{c}={totals[c] / 1e6:.2f} MB" for c in cols))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transfer size / time-to-first-paragraph for book HTML")
+    parser.add_argument("--top", type=int, default=8)
+    parser.add_argument("--profiles", default="4g=10:70,slow3g=1.6:300")
+    args = parser.parse_args()
+    main(args.top, parse_profiles(args.profiles))
@@ -41,6 +41,9 @@ except Exception:
 import sqlalchemy
 from google.cloud.sql.connector import Connector, IPTypes
 
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from apps.api.services import llm_scheduler, llm_telemetry, resilience  # noqa: E402
+
 
 # Tunables
 MAX_CHARS = 5000  # paragraph chunk upper bound
@@ -183,9 +186,11 @@ def generate_meta(
         }
     # Web検索
     grounding_tool = genai.types.Tool(google_search=genai.types.GoogleSearch())
-    retry_num = 5
-    while retry_num > 0:
-        try:
+
+    def attempt(n: int) -> Dict[str, Any]:
+        with llm_scheduler.slot("gemini-2.5-flash"), llm_telemetry.track(
+            "gemini-2.5-flash", "ingest_meta", attempt=n
+        ) as t:
             resp = client.models.generate_content(
                 model="gemini-2.5-flash",
                 contents=[prompt],
@@ -195,13 +200,15 @@ def generate_meta(
                     "tools": [grounding_tool],
                 },
             )
-            out = resp.text
-            data = json.loads(out)
-            break
-        except Exception as e:
-            print(f"{title}でエラー、{6 - retry_num}回目", file=sys.stderr)
-            retry_num -= 1
-            continue
+            t.record(resp)
+        return json.loads(resp.text)
+
+    try:
+        data = resilience.retry("ingest_meta", attempt, resilience.RetryPolicy(max_attempts=5, use_budget=False))
+    except Exception as e:
+        # 取れなかった作品も最低限のメタデータで取り込む
+        print(f"{title}でエラー: {e}", file=sys.stderr)
+        data = {"title": title, "author": author or "", "era": "", "tags": [], "summary": ""}
     data["citation"] = "青空文庫"
     return data
 
@@ -328,9 +335,11 @@ def _ascend_to_main_child(main, el):
 
 def html_to_paragraphs_with_poem(
     html: str,
+    headings_out: Optional[Dict[int, int]] = None,
 ) -> Tuple[List[str], Optional[str], Optional[str]]:
     """HTML→段落配列。ルビは基底のみ。詩ブロックは見出しごとに1段落。
     詩判定: ブロック内の非空行のうち、句読点を含まない行が閾値以上（0.6）
+    headings_out を渡すと、見出しの段落の位置 → 見出しのレベル（h1-6 の数字）を入れる（目次用）
     """
     soup = BeautifulSoup(html, "html.parser")
     title = None
@@ -465,6 +474,8 @@ def html_to_paragraphs_with_poem(
         # タイトル抽出
         hx = cont.find([f"h{i}" for i in range(1, 7)])
         if hx and hx.get_text(strip=True):
+            if headings_out is not None:
+                headings_out[len(parts)] = int(hx.name[1])
             parts.append(hx.get_text(strip=True))
         if not block_text.strip():
             continue
@@ -531,10 +542,18 @@ def chunk_paragraphs(paras: List[str], max_chars: int = MAX_CHARS) -> List[str]:
 
 def extract_and_chunk(
     html_path: Path,
+    headings_out: Optional[Dict[int, int]] = None,
 ) -> Tuple[List[str], Optional[str], Optional[str]]:
+    """headings_out には分割後の段落インデックス → 見出しのレベルを入れる。"""
     html = html_path.read_text(encoding="utf-8", errors="ignore")
-    paras, title_in_doc, author_in_doc = html_to_paragraphs_with_poem(html)
-    chunks = chunk_paragraphs(paras, MAX_CHARS)
+    headings: Dict[int, int] = {}
+    paras, title_in_doc, author_in_doc = html_to_paragraphs_with_poem(html, headings)
+    # 段落ごとに分割して、見出しの位置を分割後のインデックスに付け替える
+    chunks: List[str] = []
+    for i, p in enumerate(paras):
+        if headings_out is not None and i in headings:
+            headings_out[len(chunks)] = headings[i]
+        chunks.extend(chunk_paragraphs([p], MAX_CHARS))
     return chunks, title_in_doc, author_in_doc
 
 
@@ -646,7 +665,7 @@ def write_csv(
 
     with paras_path.open("w", encoding="utf-8", newline="") as f:
         w = csv.writer(f)
-        w.writerow(["slug", "idx", "text", "char_start", "char_end"])
+        w.writerow(["slug", "idx", "text", "char_start", "char_end", "heading_level"])
         for r in paras_rows:
             w.writerow(
                 [
@@ -655,6 +674,7 @@ def write_csv(
                     r.get("text"),
                     r.get("char_start"),
                     r.get("char_end"),
+                    r.get("heading_level") or "",
                 ]
             )
 
@@ -683,6 +703,8 @@ def main():
         help="Directory to write books.csv and paragraphs.csv",
     )
     args = parser.parse_args()
+    # API の呼び出しを優先し、429 が返ったら止まる
+    llm_scheduler.configure(priority=llm_scheduler.BATCH, user="03_ingest")
 
     html_dir = Path("aozora_html")
     files: List[Path] = []
@@ -709,7 +731,8 @@ def main():
 
     for i, path in enumerate(files, 1):
         base_title, author_from_name = derive_title_author_from_filename(path)
-        chunks, title_in_doc, _author_in_doc = extract_and_chunk(path)
+        headings: Dict[int, int] = {}
+        chunks, title_in_doc, _author_in_doc = extract_and_chunk(path, headings)
         sample = "\n\n".join(chunks[:3])
         meta = generate_meta(
             title_in_doc or base_title, author_from_name or "", sample, client
@@ -752,6 +775,7 @@ def main():
                     "text": text,
                     "char_start": start,
                     "char_end": end,
+                    "heading_level": headings.get(idx),
                 }
             )
             offset = end + 2
@@ -761,6 +785,8 @@ def main():
     out_dir = Path(args.out_dir)
     write_csv(out_dir, books_rows, paras_rows)
     print(f"CSV written: {out_dir}/books.csv and {out_dir}/paragraphs.csv")
+    if client is not None:
+        print(f"LLM usage: {llm_telemetry.totals('ingest_meta')}")
 
 
 if __name__ == "__main__":
@@ -26,6 +26,9 @@ from google import genai  # type: ignore
 
 from google.cloud.sql.connector import Connector, IPTypes  # type: ignore
 
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from apps.api.services import llm_scheduler, llm_telemetry  # noqa: E402
+
 
 MODEL = "gemini-embedding-001"
 FETCH_SIZE = 1000
@@ -77,9 +80,10 @@ def make_embed_client():
 
 
 def embed_batch(client, texts: List[str]) -> List[List[float]]:
-    resp = client.models.embed_content(
-        model=MODEL, contents=texts, config={"output_dimensionality": 768}
-    )
+    with llm_scheduler.slot(MODEL), llm_telemetry.track(MODEL, "vectorize"):
+        resp = client.models.embed_content(
+            model=MODEL, contents=texts, config={"output_dimensionality": 768}
+        )
     if hasattr(resp, "embeddings"):
         out: List[List[float]] = []
         for e in resp.embeddings:
@@ -176,10 +180,13 @@ def vectorize(table):
 
 
 def main():
+    # API の呼び出しを優先し、429 が返ったら止まる
+    llm_scheduler.configure(priority=llm_scheduler.BATCH, user="05_vectorize")
     print("Vectorizing book summaries...")
     vectorize("books")
     print("Vectorizing paragraphs...")
     vectorize("paragraphs")
+    print(f"LLM usage: {llm_telemetry.totals('vectorize')}")
 
 
 if __name__ == "__main__":
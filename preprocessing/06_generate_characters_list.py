@@ -8,6 +8,7 @@ import sys
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from apps.api.db.session import SessionLocal
+from apps.api.services import llm_scheduler, llm_telemetry, resilience
 
 
 dotenv.load_dotenv()
@@ -23,13 +24,15 @@ client = genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION)
 class Character(BaseModel):
     name: str
     appearance: list[str]
+    # 本文中での別の呼ばれ方（登場人物の言及の照合に使う。13_build_character_mentions.py）
+    aliases: list[str] = []
 
 
 class Characters(BaseModel):
     characters: list[Character]
 
 
-def generate_characters_list(title, author):
+def generate_characters_list(title, author, attempt=1):
     # プロンプト作成
     system = (
         "与えられた『作品タイトル』と『著者名』から、主要な登場人物の名前と、見た目の特徴をJSONで返してください。\n"
@@ -39,11 +42,12 @@ def generate_characters_list(title, author):
         "- 1キャラクターごとに、nameとappearanceを1スキーマ、出力してください。複数キャラクターを1スキーマまで出力することはできません。\n"
         "- 場面ごとに外見(髪型・顔などの通常変化し得ない要素)や年齢が大きく変化する場合、「name」を別の名前にして、複数回出力してください。\n"
         "- 画像生成の際、当該キャラクター1人のみが出力されるようなappearanceを出力してください。他の人物の情報が含まれないようにしてください。\n"
+        "- 本文中で「name」以外の呼ばれ方（姓のみ・名のみ・あだ名・役職名など）をする場合は、aliasesに列挙してください。複数のキャラクターに当てはまる呼び方は含めないでください。\n"
         # "- 解答の際は必要に応じてWeb検索を行い、情報を補完してください。\n"
         "# 出力形式\n"
         "- JSON形式で、以下のスキーマに従ってください。\n"
         '  {"characters": [\n'
-        '    {"name": "キャラクター名", "appearance": ["特徴1", "特徴2", ...]},\n'
+        '    {"name": "キャラクター名", "appearance": ["特徴1", "特徴2", ...], "aliases": ["呼び名1", ...]},\n'
         "    ...\n"
         "  ]}\n"
         "- JSON以外のテキストを含めないでください。\n"
@@ -83,6 +87,7 @@ def generate_characters_list(title, author):
                 "冷静で思いやりのある眼差し",
                 "旅装（外套・薄いマント）",
             ],
+            "aliases": ["監察御史"],
         },
     ]
     system_prompt = f"{system}\n\n例 タイトル=山月記 作者=中島敦:\n{json.dumps(example, ensure_ascii=False)}\n\n"
@@ -90,51 +95,67 @@ def generate_characters_list(title, author):
 
     # 生成
     grounding_tool = genai.types.Tool(google_search=genai.types.GoogleSearch())
-    resp = client.models.generate_content(
-        model=LLM_MODEL,
-        contents=user_prompt,
-        config={
-            "system_instruction": system_prompt,
-            "response_mime_type": "application/json",
-            "response_schema": Characters,
-            "tools": [grounding_tool],
-            "temperature": 0.05,
-        },
-    )
+    with llm_scheduler.slot(LLM_MODEL), llm_telemetry.track(
+        LLM_MODEL, "characters_list", attempt=attempt
+    ) as t:
+        resp = client.models.generate_content(
+            model=LLM_MODEL,
+            contents=user_prompt,
+            config={
+                "system_instruction": system_prompt,
+                "response_mime_type": "application/json",
+                "response_schema": Characters,
+                "tools": [grounding_tool],
+                "temperature": 0.05,
+            },
+        )
+        t.record(resp)
     return resp.text
 
 
 def main():
+    # API の呼び出しを優先し、429 が返ったら止まる
+    llm_scheduler.configure(priority=llm_scheduler.BATCH, user="06_characters_list")
     db = SessionLocal()
     result = db.execute(text("SELECT title, author FROM books"))
     title_author_list = [(row.title, row.author) for row in result]
     for title, author in title_author_list:
         print(f"タイトル: {title}, 著者: {author}")
-        retry_count = 0
-        while retry_count < 5:
-            try:
-                characters = generate_characters_list(title, author)
-                characters = json.loads(characters)["characters"]
-                # DBに保存
-                db.execute(
-                    text(
-                        "UPDATE books SET characters = :characters WHERE title = :title"
-                    ),
-                    {
-                        "characters": json.dumps(characters, ensure_ascii=False),
-                        "title": title,
-                    },
-                )
-                db.commit()
-                print(
-                    json.dumps(characters, ensure_ascii=False),
-                )
-                break
-            except Exception as e:
-                print(f"Error: {e}")
-                retry_count += 1
-                continue
+
+        def attempt(n: int) -> list:
+            characters = generate_characters_list(title, author, attempt=n)
+            return json.loads(characters)["characters"]
+
+        try:
+            characters = resilience.retry(
+                "characters_list", attempt, resilience.RetryPolicy(max_attempts=5, use_budget=False)
+            )
+        except Exception as e:
+            print(f"Error: {e}")
+            continue
+        # DBに保存
+        db.execute(
+            text("UPDATE books SET characters = :characters WHERE title = :title"),
+            {
+                "characters": json.dumps(characters, ensure_ascii=False),
+                "title": title,
+            },
+        )
+        # 旧一覧で抽出したシーンのキャッシュ・段落の登場人物は使えないので消す（API のプロセス内キャッシュは TTL で追随）
+        for table in ("scene_prompts", "paragraph_characters"):
+            db.execute(
+                text(
+                    f"DELETE FROM {table} WHERE book_id IN (SELECT id FROM books WHERE title = :title)"
+                ),
+                {"title": title},
+            )
+        db.commit()
+        print(
+            json.dumps(characters, ensure_ascii=False),
+        )
     db.close()
+    print(f"LLM usage: {llm_telemetry.totals('characters_list')}")
+    print("段落の登場人物は preprocessing/13_build_character_mentions.py で作り直してください")
 
 
 if __name__ == "__main__":
@@ -12,12 +12,16 @@ import sys
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from apps.api.db.session import SessionLocal
+from apps.api.services import llm_telemetry
 
 dotenv.load_dotenv()
 
 PROJECT_ID = os.getenv("PROJECT_ID", "")
 LOCATION = os.getenv("LOCATION", "")
 BUCKET_NAME = os.getenv("CHARACTERS_BUCKET", "")
+IMAGE_MODEL = "imagen-4.0-fast-generate-001"
+# Imagen は枚数課金（USD / 枚）。コスト見積もり用
+IMAGE_PRICE_PER_IMAGE = 0.02
 
 
 def upload_to_gcs(local_path, bucket_name, gcs_path):
@@ -30,7 +34,7 @@ def upload_to_gcs(local_path, bucket_name, gcs_path):
 
 def generate_image(title, character, appearance):
     vertexai.init(project=PROJECT_ID, location=LOCATION)
-    model = ImageGenerationModel.from_pretrained("imagen-4.0-fast-generate-001")
+    model = ImageGenerationModel.from_pretrained(IMAGE_MODEL)
     template = Path(f"preprocessing/07_generate_characters_image.md").read_text(
         encoding="utf-8"
     )
@@ -40,7 +44,9 @@ def generate_image(title, character, appearance):
         "language": "ja",
         "person_generation": "allow_all",
     }
-    images = model.generate_images(prompt=prompt, **kwargs)
+    with llm_telemetry.track(IMAGE_MODEL, "character_image") as t:
+        images = model.generate_images(prompt=prompt, **kwargs)
+        t.add_cost(IMAGE_PRICE_PER_IMAGE * kwargs["number_of_images"])
     filename = f"preprocessing/tmp/{title}/{character}.png"
     images[0].save(location=filename, include_generation_parameters=False)
 
@@ -75,6 +81,7 @@ def main():
                 continue
             print(f"Generating image for {title} - {character} ({appearance})")
             generate_image(title, character, appearance)
+    print(f"LLM usage: {llm_telemetry.totals('character_image')}")
 
 
 if __name__ == "__main__":
@@ -3,8 +3,10 @@
 paragraphs.csv から書籍ごとの段落HTMLを事前生成します。
 出力先: web/books_html/<slug>.html
  - 各段落を <div class="para" id="p-<idx>" data-idx="<idx>">...</div> の形で出力
+ - 見出しの段落（paragraphs.csv の heading_level）には data-heading="<レベル>" を付ける（目次・章ごとの分割用）
  - テキスト内の改行は <br/> に変換
  - HTML特殊文字はエスケープ
+ - 最後に配信用の事前圧縮版（web/books_html/dist/、14_precompress_books_html.py と同じ）を作る
 使い方:
   python preprocessing/06_build_full_html.py
 前提:
@@ -13,10 +15,15 @@ paragraphs.csv から書籍ごとの段落HTMLを事前生成します。
 from __future__ import annotations
 import csv
 import html
+import sys
 from collections import defaultdict
 from pathlib import Path
 
 ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from apps.api.services import book_files  # noqa: E402
+
 BOOKS_CSV = ROOT / "preprocessing" / "books.csv"
 PARAS_CSV = ROOT / "preprocessing" / "paragraphs.csv"
 OUT_DIR = ROOT / "web" / "books_html"
@@ -60,7 +67,8 @@ def generate() -> None:
             except Exception:
                 idx = 0
             text = row.get("text") or ""
-            by_slug[slug].append({"idx": idx, "text": text})
+            level = row.get("heading_level") or ""
+            by_slug[slug].append({"idx": idx, "text": text, "heading": level if level.isdigit() else None})
     for slug, items in by_slug.items():
         items.sort(key=lambda x: x["idx"])
         parts: list[str] = []
@@ -73,14 +81,17 @@ def generate() -> None:
             idx = it["idx"]
             # 改行を <br/> に。またHTML特殊文字をエスケープ。
             body = html.escape(it["text"]).replace("\n", "<br/>")
+            heading = f' data-heading="{it["heading"]}"' if it["heading"] else ""
             parts.append(
-                f'<div class="para rounded hover:bg-gray-50 p-2" id="p-{idx}" data-idx="{idx}">\n'
+                f'<div class="para rounded hover:bg-gray-50 p-2" id="p-{idx}" data-idx="{idx}"{heading}>\n'
                 f'  <div class="leading-relaxed">{body}</div>\n'
                 f"</div>"
             )
         out = OUT_DIR / f"{slug}.html"
         out.write_text("\n".join(parts) + "\n", encoding="utf-8")
         print(f"wrote {out.relative_to(ROOT)} ({len(items)} paras)")
+    manifest = book_files.build()
+    print(f"precompressed {len(manifest['books'])} books -> {book_files.DIST_DIR.relative_to(ROOT)}")
 
 
 if __name__ == "__main__":
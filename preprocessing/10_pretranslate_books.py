@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+人気作品（reading_progress の読者数順）または指定作品の段落を事前に現代語訳し、
+/v1/translate が参照する共有キャッシュ `paragraph_translations` に書き込みます。
+
+- 並列数・レート（リクエスト/分）を制限し、失敗時は指数バックオフで再試行
+- 1段落ごとにDBへコミットするため、中断しても再実行で未翻訳の段落から再開
+  （チェックポイントファイルには恒久的に失敗した段落と累計統計を保存）
+- 旧字体・歴史的仮名遣いの密度が高い「読みにくい」段落から優先して翻訳
+- 進捗として 段落/分 と概算コストを表示
+
+使い方:
+  python preprocessing/10_pretranslate_books.py --top 10
+  python preprocessing/10_pretranslate_books.py --book-ids 3 5 8 --concurrency 4 --rpm 120
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import dotenv
+from sqlalchemy import text
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+dotenv.load_dotenv()
+
+from apps.api.db.session import engine  # noqa: E402
+from apps.api.services import llm, llm_scheduler, llm_telemetry, resilience  # noqa: E402
+
+
+CHECKPOINT_PATH = Path("preprocessing/tmp/pretranslate_checkpoint.json")
+
+# 概算単価（USD / 1M tokens）。日本語は概ね 1文字 ≒ 1token として見積もる
+PRICE_INPUT_PER_1M = 0.10
+PRICE_OUTPUT_PER_1M = 0.40
+
+# 旧字体（新字体と字形が異なる代表的なもの）と歴史的仮名遣い・踊り字
+OLD_KANJI = set(
+    "國學體會舊來當與爲變聲實臺圖廣應團氣讀醫戰驛鐵樂壓圍榮營藝寫處眞點發澤號萬數竝歸辭續擧齒黨"
+    "亞惡兩對將從狀縣廳龍戀豐覺觀歡關顯鹽圓假畫辯邊賣屆廢拜晝佛傳勞區參卷恆戲濟濕獸盡禮總嚴"
+    "歐毆櫻藏雜斷證聽靜鬪擔據擇譯驗險檢劍權勸勵觸囑髮彈廣繪壞懷膽隱豫譽餘爐蠶蟲禪纖"
+)
+OLD_KANA = set("ゐゑヰヱゝゞヽヾ〻")
+
+
+def difficulty_score(s: str) -> float:
+    """旧字体・歴史的仮名の密度。高いほど読みにくいとみなす。"""
+    if not s:
+        return 0.0
+    old_kanji = sum(1 for ch in s if ch in OLD_KANJI)
+    old_kana = sum(1 for ch in s if ch in OLD_KANA)
+    return (2.0 * old_kanji + old_kana) / len(s)
+
+
+def load_checkpoint() -> Dict[str, object]:
+    if CHECKPOINT_PATH.exists():
+        try:
+            return json.loads(CHECKPOINT_PATH.read_text(encoding="utf-8"))
+        except Exception:
+            pass
+    return {"failed": {}, "done": 0, "input_chars": 0, "output_chars": 0}
+
+
+def save_checkpoint(state: Dict[str, object]) -> None:
+    CHECKPOINT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = CHECKPOINT_PATH.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+    tmp.replace(CHECKPOINT_PATH)
+
+
+def select_books(conn, args) -> List[Tuple[int, str]]:
+    if args.book_ids:
+        rows = conn.execute(
+            text("SELECT id, title FROM books WHERE id = ANY(:ids) ORDER BY id"),
+            {"ids": list(args.book_ids)},
+        ).fetchall()
+    elif args.slugs:
+        rows = conn.execute(
+            text("SELECT id, title FROM books WHERE slug = ANY(:slugs) ORDER BY id"),
+            {"slugs": list(args.slugs)},
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            text(
+                """
+                SELECT b.id, b.title
+                FROM books b
+                JOIN reading_progress rp ON rp.book_id = b.id
+                GROUP BY b.id, b.title
+                ORDER BY COUNT(*) DESC, b.id ASC
+                LIMIT :lim
+                """
+            ),
+            {"lim": args.top},
+        ).fetchall()
+    return [(r[0], r[1]) for r in rows]
+
+
+def fetch_untranslated(conn, book_id: int) -> List[Tuple[int, str]]:
+    rows = conn.execute(
+        text(
+            """
+            SELECT p.id, p.text
+            FROM paragraphs p
+            LEFT JOIN paragraph_translations t
+              ON t.para_id = p.id AND t.prompt_version = :pv
+            WHERE p.book_id = :bid
+              AND t.para_id IS NULL
+              AND p.text !~ '底本\\s*[：:]'
+            ORDER BY p.idx ASC
+            """
+        ),
+        {"bid": book_id, "pv": llm.TRANSLATE_PROMPT_VERSION},
+    ).fetchall()
+    return [(r[0], r[1]) for r in rows]
+
+
+def save_translation(book_id: int, para_id: int, translated: str, model: str) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                INSERT INTO paragraph_translations (para_id, book_id, text, model, prompt_version)
+                VALUES (:pid, :bid, :text, :model, :pv)
+                ON CONFLICT (para_id) DO UPDATE SET
+                  text = EXCLUDED.text,
+                  model = EXCLUDED.model,
+                  prompt_version = EXCLUDED.prompt_version,
+                  created_at = now()
+                """
+            ),
+            {
+                "pid": para_id,
+                "bid": book_id,
+                "text": translated,
+                "model": model,
+                "pv": llm.TRANSLATE_PROMPT_VERSION,
+            },
+        )
+
+
+def translate_with_retry(title: str, paragraph: str, max_retries: int) -> Tuple[str, str]:
+    """(訳文, 使ったモデル)。"""
+    def attempt(n: int) -> Tuple[str, str]:
+        # ペース配分は llm_scheduler、モデルの切り替えは model_router（llm.translate_paragraph の中）
+        translated, _, model = llm.translate_paragraph(title, paragraph)
+        if not translated:
+            raise RuntimeError("empty translation")
+        return translated, model
+
+    # 指数バックオフ + ジッタ（最大60秒）
+    return resilience.retry(
+        "pretranslate",
+        attempt,
+        resilience.RetryPolicy(
+            max_attempts=max_retries + 1, base_delay_s=2.0, max_delay_s=60.0, use_budget=False
+        ),
+    )
+
+
+def estimate_cost(input_chars: int, output_chars: int) -> float:
+    return (
+        input_chars * PRICE_INPUT_PER_1M + output_chars * PRICE_OUTPUT_PER_1M
+    ) / 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-translate paragraphs of popular books")
+    parser.add_argument("--book-ids", type=int, nargs="*", help="Explicit book ids")
+    parser.add_argument("--slugs", nargs="*", help="Explicit book slugs")
+    parser.add_argument("--top", type=int, default=10, help="Top N books by readers")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=int, default=300, help="Max requests per minute")
+    parser.add_argument("--max-retries", type=int, default=4)
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Retry paragraphs recorded as failed in the checkpoint",
+    )
+    args = parser.parse_args()
+
+    state = load_checkpoint()
+    failed: Dict[str, str] = state.setdefault("failed", {})  # type: ignore[assignment]
+    if args.retry_failed:
+        failed.clear()
+
+    with engine.connect() as conn:
+        books = select_books(conn, args)
+        jobs: List[Tuple[float, int, str, int, str]] = []
+        for book_id, title in books:
+            for pid, ptext in fetch_untranslated(conn, book_id):
+                if str(pid) in failed:
+                    continue
+                jobs.append((difficulty_score(ptext), book_id, title, pid, ptext))
+    # 読みにくい段落から先に
+    jobs.sort(key=lambda j: j[0], reverse=True)
+    print(f"books: {len(books)}, paragraphs to translate: {len(jobs)}")
+    if not jobs:
+        return
+
+    # API の呼び出しを優先し、429 が返ったら止まる
+    llm_scheduler.configure(
+        priority=llm_scheduler.BATCH, user="10_pretranslate", rpm={llm.TRANSLATE_MODEL: args.rpm}
+    )
+    lock = threading.Lock()
+    done = 0
+    in_chars = 0
+    out_chars = 0
+    t0 = time.time()
+    # 過去の実行分（再開時の累計表示用）
+    base = {k: int(state.get(k, 0)) for k in ("done", "input_chars", "output_chars")}
+
+    def flush() -> None:
+        state["done"] = base["done"] + done
+        state["input_chars"] = base["input_chars"] + in_chars
+        state["output_chars"] = base["output_chars"] + out_chars
+        save_checkpoint(state)
+
+    def work(job) -> Tuple[int, Optional[str], int, int]:
+        _, book_id, title, pid, ptext = job
+        translated, model = translate_with_retry(title, ptext, args.max_retries)
+        save_translation(book_id, pid, translated, model)
+        prompt_chars = len(llm.build_translate_prompt(title, ptext))
+        return pid, translated, prompt_chars, len(translated)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+        futures = {ex.submit(work, job): job for job in jobs}
+        for fut in as_completed(futures):
+            job = futures[fut]
+            with lock:
+                try:
+                    _, _, ic, oc = fut.result()
+                    done += 1
+                    in_chars += ic
+                    out_chars += oc
+                except Exception as e:
+                    failed[str(job[3])] = str(e)[:200]
+                    print(f"failed para_id={job[3]}: {e}", file=sys.stderr)
+                if (done + len(failed)) % 50 == 0:
+                    flush()
+                    dt = max(1e-6, time.time() - t0)
+                    print(
+                        f"translated {done}/{len(jobs)} "
+                        f"({done / dt * 60:.1f} paras/min, est. ${estimate_cost(in_chars, out_chars):.4f})"
+                    )
+
+    flush()
+    dt = max(1e-6, time.time() - t0)
+    print(
+        f"Done. translated={done} failed={len(failed)} in {dt:.1f}s "
+        f"({done / dt * 60:.1f} paras/min), est. cost ${estimate_cost(in_chars, out_chars):.4f} "
+        f"(cumulative ${estimate_cost(int(state['input_chars']), int(state['output_chars'])):.4f})"
+    )
+    # 実トークン数（usage_metadata）に基づく今回分の集計
+    print(f"LLM usage: {llm_telemetry.totals('translate')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+定型質問（apps/api/services/canned_qa.py の QUESTIONS、CANNED_QUESTIONS で変更可）への回答を
+全作品（または指定作品）について事前に生成し、`canned_answers` に保存します。
+
+- 現行のモデル・プロンプト版で、最大経過日数以内の回答がある組はスキップ（--force で全件）
+- 並列数・レートを制限し、失敗時は指数バックオフで再試行
+
+使い方:
+  python preprocessing/11_precompute_canned_answers.py
+  python preprocessing/11_precompute_canned_answers.py --book-ids 3 5 --keys background --force
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Tuple
+
+import dotenv
+from sqlalchemy import text
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+dotenv.load_dotenv()
+
+from apps.api.db.session import engine  # noqa: E402
+from apps.api.services import canned_qa, llm, llm_scheduler, llm_telemetry, resilience  # noqa: E402
+
+
+def select_books(conn, book_ids: List[int] | None) -> List[Tuple[int, str]]:
+    if book_ids:
+        rows = conn.execute(
+            text("SELECT id, title FROM books WHERE id = ANY(:ids) ORDER BY id"),
+            {"ids": list(book_ids)},
+        ).fetchall()
+    else:
+        rows = conn.execute(text("SELECT id, title FROM books ORDER BY id")).fetchall()
+    return [(r[0], r[1]) for r in rows]
+
+
+def fresh_pairs(conn) -> set[Tuple[int, str]]:
+    rows = conn.execute(
+        text(
+            """
+            SELECT book_id, question_key
+            FROM canned_answers
+            WHERE model = :model AND prompt_version = :pv
+              AND created_at > now() - make_interval(secs => :max_age)
+            """
+        ),
+        {
+            "model": llm.LLM_MODEL,
+            "pv": llm.QA_PROMPT_VERSION,
+            "max_age": canned_qa.MAX_AGE_DAYS * 86400,
+        },
+    ).fetchall()
+    return {(r[0], r[1]) for r in rows}
+
+
+def save_answer(book_id: int, key: str, answer: str, model: str) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                INSERT INTO canned_answers
+                  (book_id, question_key, question, answer, model, prompt_version)
+                VALUES (:bid, :key, :q, :a, :model, :pv)
+                ON CONFLICT (book_id, question_key) DO UPDATE SET
+                  question = EXCLUDED.question,
+                  answer = EXCLUDED.answer,
+                  model = EXCLUDED.model,
+                  prompt_version = EXCLUDED.prompt_version,
+                  created_at = now()
+                """
+            ),
+            {
+                "bid": book_id,
+                "key": key,
+                "q": canned_qa.QUESTIONS[key],
+                "a": answer,
+                "model": model,
+                "pv": llm.QA_PROMPT_VERSION,
+            },
+        )
+
+
+def answer_with_retry(title: str, question: str, max_retries: int) -> Tuple[str, str]:
+    """(回答, 使ったモデル)。"""
+    def attempt(n: int) -> Tuple[str, str]:
+        answer, _, model = llm.answer_question(title, question)
+        if not answer:
+            raise RuntimeError("empty answer")
+        return answer, model
+
+    return resilience.retry(
+        "canned_qa",
+        attempt,
+        resilience.RetryPolicy(
+            max_attempts=max_retries + 1, base_delay_s=2.0, max_delay_s=60.0, use_budget=False
+        ),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute answers to canned questions")
+    parser.add_argument("--book-ids", type=int, nargs="*", help="Explicit book ids")
+    parser.add_argument("--keys", nargs="*", help=f"Question keys (default: {list(canned_qa.QUESTIONS)})")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--force", action="store_true", help="Regenerate fresh answers too")
+    args = parser.parse_args()
+    # API の呼び出しを優先し、429 が返ったら止まる
+    llm_scheduler.configure(priority=llm_scheduler.BATCH, user="11_canned_answers")
+
+    keys = args.keys or list(canned_qa.QUESTIONS)
+    unknown = [k for k in keys if k not in canned_qa.QUESTIONS]
+    if unknown:
+        parser.error(f"unknown question keys: {unknown}")
+
+    with engine.connect() as conn:
+        books = select_books(conn, args.book_ids)
+        fresh = set() if args.force else fresh_pairs(conn)
+    jobs = [
+        (book_id, title, key)
+        for book_id, title in books
+        for key in keys
+        if (book_id, key) not in fresh
+    ]
+    print(f"books: {len(books)}, answers to generate: {len(jobs)}")
+
+    def work(job) -> None:
+        book_id, title, key = job
+        answer, model = answer_with_retry(title, canned_qa.QUESTIONS[key], args.max_retries)
+        save_answer(book_id, key, answer, model)
+
+    done = failed = 0
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+        futures = {ex.submit(work, job): job for job in jobs}
+        for fut in as_completed(futures):
+            book_id, title, key = futures[fut]
+            try:
+                fut.result()
+                done += 1
+                print(f"[{done}/{len(jobs)}] {title} / {key}")
+            except Exception as e:
+                failed += 1
+                print(f"failed book_id={book_id} key={key}: {e}", file=sys.stderr)
+    print(f"Done. generated={done} failed={failed} in {time.time() - t0:.1f}s")
+    print(f"LLM usage: {llm_telemetry.totals('qa')}")
+
+
+if __name__ == "__main__":
+    main()
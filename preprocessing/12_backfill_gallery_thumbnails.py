@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+既存のギャラリーアセット（thumb_url が未設定の行）にサムネイル・ポスター画像を作って埋めます。
+新しいアセットは生成ジョブが作るため、導入時や THUMB_WIDTHS を変えたときに一度流す想定です。
+
+- 画像は GCS から取得して WebP に縮小、動画は ffmpeg で先頭付近のフレームを抜いてポスターにする
+- 縮小・フレーム抽出は apps/api/services/thumbnails.py と同じくプロセスプールで並列実行
+
+使い方:
+  python preprocessing/12_backfill_gallery_thumbnails.py
+  python preprocessing/12_backfill_gallery_thumbnails.py --type image --limit 500 --concurrency 8
+  python preprocessing/12_backfill_gallery_thumbnails.py --all   # 既に thumb_url がある行も作り直す
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import List, Optional, Tuple
+
+import dotenv
+from sqlalchemy import text
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+dotenv.load_dotenv()
+
+from apps.api.db.session import engine  # noqa: E402
+from apps.api.services import thumbnails  # noqa: E402
+
+
+def select_rows(asset_type: Optional[str], include_done: bool, limit: Optional[int]) -> List[Tuple[int, str, str]]:
+    sql = "SELECT id, asset_url, type FROM gallery WHERE 1 = 1"
+    params = {}
+    if not include_done:
+        sql += " AND thumb_url IS NULL"
+    if asset_type:
+        sql += " AND type = :type"
+        params["type"] = asset_type
+    sql += " ORDER BY created_at DESC"
+    if limit:
+        sql += " LIMIT :limit"
+        params["limit"] = limit
+    with engine.connect() as conn:
+        return [(r.id, r.asset_url, r.type) for r in conn.execute(text(sql), params)]
+
+
+async def run(rows: List[Tuple[int, str, str]], concurrency: int) -> Tuple[int, int]:
+    sem = asyncio.Semaphore(concurrency)
+    done = failed = 0
+
+    async def one(row) -> None:
+        nonlocal done, failed
+        gid, url, asset_type = row
+        async with sem:
+            thumb = await thumbnails.generate(gid, url, asset_type)
+        if thumb:
+            done += 1
+            print(f"[{done}/{len(rows)}] {gid} {asset_type} -> {thumb}")
+        else:
+            failed += 1
+
+    await asyncio.gather(*(one(r) for r in rows))
+    return done, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill gallery thumbnails and poster frames")
+    parser.add_argument("--type", choices=["image", "video"], default=None)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=thumbnails.THUMB_PROCESSES * 2)
+    parser.add_argument("--all", action="store_true", help="Regenerate rows that already have thumbnails")
+    args = parser.parse_args()
+
+    if args.type != "image" and not thumbnails.ffmpeg_available():
+        print("ffmpeg が見つからないため動画はスキップします", file=sys.stderr)
+    rows = select_rows(args.type, args.all, args.limit)
+    print(f"gallery rows to process: {len(rows)}")
+    t0 = time.time()
+    try:
+        done, failed = asyncio.run(run(rows, args.concurrency))
+    finally:
+        thumbnails.shutdown()
+    print(f"Done. ok={done} failed_or_skipped={failed} in {time.time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+段落ごとに登場する人物（books.characters の名前・別名）を照合し、paragraph_characters に保存します。
+画像・動画生成はこの結果と選択範囲の照合で登場人物を決め、曖昧な箇所だけ LLM に聞きます。
+
+- 作品ごとに Aho-Corasick の照合器を組み立て（apps/api/services/mentions.py）、全段落を1回ずつ走査する
+- 行には登場人物一覧のハッシュ（characters_version）を入れ、一覧が変わった作品は作り直す
+- 06_generate_characters_list.py で一覧を作り直したら流す
+
+使い方:
+  python preprocessing/13_build_character_mentions.py
+  python preprocessing/13_build_character_mentions.py --book-id 123
+  python preprocessing/13_build_character_mentions.py --all   # 版が同じ作品も作り直す
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+import dotenv
+from sqlalchemy import text
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+dotenv.load_dotenv()
+
+from apps.api.db.session import engine  # noqa: E402
+from apps.api.services import mentions, scene_cache  # noqa: E402
+
+BATCH_SIZE = 1000
+
+
+def up_to_date(conn, book_id: int, version: str) -> bool:
+    row = conn.execute(
+        text(
+            """
+            SELECT COUNT(p.id) AS total, COUNT(pc.para_id) AS done
+            FROM paragraphs p
+            LEFT JOIN paragraph_characters pc
+              ON pc.para_id = p.id AND pc.characters_version = :ver
+            WHERE p.book_id = :bid
+            """
+        ),
+        {"bid": book_id, "ver": version},
+    ).first()
+    return row.total > 0 and row.total == row.done
+
+
+def build_book(conn, book_id: int, characters: list, version: str) -> tuple[int, int, int]:
+    matcher = mentions.Matcher(characters)
+    paragraphs = conn.execute(
+        text("SELECT id, text FROM paragraphs WHERE book_id = :bid ORDER BY idx"),
+        {"bid": book_id},
+    ).all()
+    rows = []
+    with_names = ambiguous = 0
+    for pid, body in paragraphs:
+        found = matcher.detect(body)
+        with_names += bool(found.names)
+        ambiguous += found.ambiguous
+        rows.append(
+            {
+                "pid": pid,
+                "bid": book_id,
+                "names": json.dumps(found.names, ensure_ascii=False),
+                "amb": found.ambiguous,
+                "ver": version,
+            }
+        )
+    conn.execute(text("DELETE FROM paragraph_characters WHERE book_id = :bid"), {"bid": book_id})
+    for i in range(0, len(rows), BATCH_SIZE):
+        conn.execute(
+            text(
+                """
+                INSERT INTO paragraph_characters
+                  (para_id, book_id, character_names, ambiguous, characters_version)
+                VALUES (:pid, :bid, CAST(:names AS JSONB), :amb, :ver)
+                """
+            ),
+            rows[i : i + BATCH_SIZE],
+        )
+    return len(rows), with_names, ambiguous
+
+
+def main(book_id: Optional[int] = None, rebuild_all: bool = False):
+    sql = "SELECT id, title, characters FROM books WHERE characters IS NOT NULL"
+    params = {}
+    if book_id:
+        sql += " AND id = :bid"
+        params["bid"] = book_id
+    with engine.connect() as conn:
+        books = conn.execute(text(sql + " ORDER BY id"), params).all()
+    print(f"books to process: {len(books)}")
+    t0 = time.time()
+    for bid, title, characters in books:
+        version = scene_cache.characters_version(characters)
+        with engine.begin() as conn:
+            if not rebuild_all and up_to_date(conn, bid, version):
+                print(f"skip (up to date): {title}")
+                continue
+            start = time.time()
+            total, with_names, ambiguous = build_book(conn, bid, characters or [], version)
+        print(
+            f"{title}: paragraphs={total} with_characters={with_names} "
+            f"ambiguous={ambiguous} ({(time.time() - start) * 1000:.0f}ms)"
+        )
+    print(f"Done in {time.time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build per-paragraph character mentions")
+    parser.add_argument("--book-id", type=int, default=None)
+    parser.add_argument("--all", action="store_true", help="Rebuild books that are already up to date")
+    args = parser.parse_args()
+    main(args.book_id, args.all)
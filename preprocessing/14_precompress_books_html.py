@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+web/books_html/*.html から配信用の事前圧縮版を作ります（apps/api/services/book_files.py）。
+出力先: web/books_html/dist/
+ - <slug>.<内容ハッシュ>.html と、その .gz / .br（brotli が入っていれば）
+ - manifest.json（slug → ハッシュ・各サイズ）。API はこれを見て圧縮版を返し、ハッシュ付きの URL を配る
+ - para_ids/<slug>.json（15_export_para_ids.py）があれば <slug>.<ハッシュ>.ids.json とその圧縮版
+08_build_full_html.py の最後でも実行されます。09_patch_books_html_citation.py などで HTML を
+書き換えたら流し直してください（Docker ビルドでも実行）。
+使い方:
+  python preprocessing/14_precompress_books_html.py
+"""
+from __future__ import annotations
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from apps.api.services import book_files  # noqa: E402
+
+
+def main() -> None:
+    t0 = time.time()
+    manifest = book_files.build()
+    books = manifest["books"]
+    total = sum(e["size"] for e in books.values())
+    print(f"books: {len(books)}  html: {total / 1e6:.1f} MB")
+    for encoding, _ in book_files.ENCODINGS:
+        sizes = [e[encoding] for e in books.values() if encoding in e]
+        if sizes:
+            print(f"  {encoding:<5} {sum(sizes) / 1e6:.1f} MB ({len(sizes)} files)")
+    print(f"Done in {time.time() - t0:.1f}s -> {book_files.DIST_DIR}")
+
+
+if __name__ == "__main__":
+    main()
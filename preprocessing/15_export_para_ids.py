@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+DB の段落 ID を本ごとの対応ファイルに書き出します（段落インデックス → paragraphs.id）。
+出力先: web/books_html/para_ids/<slug>.json
+ - {"book_id", "count", "min_id", "max_id", "runs": [[先頭の idx, 先頭の ID, 長さ], ...]}
+   （apps/api/services/book_files.py の encode_para_ids）
+ - 最後に配信用の dist/ を作り直す（14_precompress_books_html.py と同じ。圧縮済みの本文はそのまま）
+read.html は本を開くたびに DB を引く代わりに、これを ?v=<hash> 付きの URL でキャッシュして使います。
+04_copy_csv_to_db.py は段落 ID を振り直すので、流し直したらこれも流してください
+（古いままだと API が件数・ID の範囲の不一致に気づいて DB から返します）。
+使い方:
+  python preprocessing/15_export_para_ids.py
+  python preprocessing/15_export_para_ids.py --no-build   # dist/ は作り直さない
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+import dotenv
+from sqlalchemy import text
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+dotenv.load_dotenv()
+
+from apps.api.db.session import engine  # noqa: E402
+from apps.api.services import book_files  # noqa: E402
+
+
+def main(build: bool) -> None:
+    t0 = time.time()
+    out_dir = book_files.BOOKS_HTML_DIR / book_files.PARA_IDS_DIR
+    out_dir.mkdir(parents=True, exist_ok=True)
+    slugs = {p.stem for p in book_files.BOOKS_HTML_DIR.glob("*.html")}
+    books = {}
+    rows = defaultdict(list)
+    with engine.connect() as conn:
+        for book_id, slug in conn.execute(text("SELECT id, slug FROM books WHERE slug IS NOT NULL")):
+            if slug in slugs:
+                books[book_id] = slug
+        result = conn.execution_options(stream_results=True).execute(
+            text("SELECT book_id, idx, id FROM paragraphs ORDER BY book_id, idx")
+        )
+        for book_id, idx, pid in result:
+            if book_id in books:
+                rows[book_id].append((idx, pid))
+    written = unchanged = 0
+    for book_id, slug in books.items():
+        data = json.dumps(
+            book_files.encode_para_ids(book_id, rows[book_id]), separators=(",", ":")
+        ).encode("utf-8")
+        path = out_dir / f"{slug}.json"
+        if path.exists() and path.read_bytes() == data:
+            unchanged += 1
+            continue
+        path.write_bytes(data)
+        written += 1
+    # DB から消えた本の対応は残さない（違う ID を返さないように）
+    removed = 0
+    for path in out_dir.glob("*.json"):
+        if path.stem not in books.values():
+            path.unlink()
+            removed += 1
+    print(f"para_ids: wrote {written}, unchanged {unchanged}, removed {removed} -> {out_dir}")
+    if build:
+        manifest = book_files.build()
+        with_ids = sum(1 for e in manifest["books"].values() if "ids" in e)
+        print(f"precompressed {len(manifest['books'])} books ({with_ids} with para ids) -> {book_files.DIST_DIR}")
+    print(f"Done in {time.time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export paragraph DB ids for the static book HTML")
+    parser.add_argument("--no-build", action="store_true", help="Do not rebuild web/books_html/dist")
+    args = parser.parse_args()
+    main(build=not args.no_build)